@@ -7,27 +7,49 @@ from typing import List, Dict, Any
 
 from tools import ResearchTools  # <- you will implement this module
 from llm import summarize_chunks  # <- simple summarizer using Ollama LLM
+from reply_filter import ReplyClassifier
+from tracing import trace_node
 
 
 # === Agent Functions ===
 def retrieve_chunks(state: dict, tools: ResearchTools) -> dict:
-    results = tools.search_vector_db(state["query"], top_k=10)
+    # query variants (rephrasings, expansions) go in the same batch and are fused by rank
+    queries = [state["query"], *state.get("query_variants", [])]
+    if len(queries) > 1:
+        results = tools.search_fused(queries, top_k=10, filter=state.get("filter"), with_scores=True)
+    else:
+        results = tools.search_vector_db(state["query"], top_k=10, filter=state.get("filter"), with_scores=True)
     state["retrieved_chunks"] = results
     return state
 
+def expand_graph(state: dict, tools: ResearchTools) -> dict:
+    # one UNWIND query for every hit: sender / thread / reply-to context plus neighbour chunks
+    state["retrieved_chunks"] = tools.expand_with_graph(state["retrieved_chunks"])
+    return state
+
+def filter_replies(state: dict, classifier: ReplyClassifier) -> dict:
+    state["retrieved_chunks"] = classifier.filter(state["retrieved_chunks"])
+    return state
+
 def summarize(state: dict) -> dict:
     state["summary"] = summarize_chunks(state["retrieved_chunks"])
     return state
 
 # === Workflow Definition ===
-def create_graph(tools):
+def create_graph(tools, classifier: ReplyClassifier = None):
+    classifier = classifier or ReplyClassifier()
     builder = StateGraph(dict)
 
-    builder.add_node("retrieve_chunks", RunnableLambda(lambda s: retrieve_chunks(s, tools)))
-    builder.add_node("summarize", RunnableLambda(summarize))
+    # each node is timed as a tracing span (tracing.py)
+    builder.add_node("retrieve_chunks", RunnableLambda(trace_node("retrieve_chunks", lambda s: retrieve_chunks(s, tools), graph="research")))
+    builder.add_node("expand_graph", RunnableLambda(trace_node("expand_graph", lambda s: expand_graph(s, tools), graph="research")))
+    builder.add_node("filter_replies", RunnableLambda(trace_node("filter_replies", lambda s: filter_replies(s, classifier), graph="research")))
+    builder.add_node("summarize", RunnableLambda(trace_node("summarize", summarize, graph="research")))
 
     builder.set_entry_point("retrieve_chunks")
-    builder.add_edge("retrieve_chunks", "summarize")
+    builder.add_edge("retrieve_chunks", "expand_graph")
+    builder.add_edge("expand_graph", "filter_replies")
+    builder.add_edge("filter_replies", "summarize")
     builder.add_edge("summarize", END)
 
     return builder.compile()
@@ -0,0 +1,382 @@
+# benchmark.py
+#
+# Benchmarks for the simulation and research pipelines.
+#
+#   python benchmark.py                          # every case
+#   python benchmark.py referee --llm-latency-ms 80 --concurrency 16
+#   python benchmark.py --compare .cache/benchmarks/<older commit>.json
+#
+# Cases:
+#   embedding      llm.get_embedding throughput per batch size (cold: every text is new)
+#   vector_search  ResearchTools.search_vector_db against an in-memory Qdrant seeded with
+#                  synthetic chunks (--qdrant memory), the embedded store (vector_store.py)
+#                  seeded the same way (--qdrant embedded), or the configured server (--qdrant local)
+#   research       the agentic_research_ai graph end to end, on the same store
+#   referee        headless sessions of every sample_simulations SOP
+#
+# All LLM calls go to the "fake" backend (llm_backends.py) with the latency set here, so
+# runs are offline and reproducible and measure the orchestration rather than a model
+# server. Without sentence_transformers (or with --embedder hash) embeddings come from a
+# hashing stand-in; the embedder used is recorded with the results.
+#
+# Every case reports p50 / p95 / p99 latency and ops/sec. Results are written as JSON
+# (default .cache/benchmarks/<commit>.json) and --compare prints the change against an
+# earlier results file.
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+SAMPLE_QUERIES = [
+    "Can you provide some really good examples of email responses to customers?",
+    "Replies that follow up on a refund request",
+    "Emails answering a question about an invoice",
+    "Responses that apologise for a delay and give a timeline",
+    "Messages confirming an appointment the customer asked for",
+]
+
+_SUBJECTS = ["Re: your refund request", "Re: invoice #{n}", "Fwd: case file {n}", "Meeting agenda",
+             "Re: appointment on {day}", "Newsletter", "Regarding your inquiry", "Document request"]
+_BODIES = ["Thank you for reaching out, following up on your message below.",
+           "As requested, I've attached the documents regarding your inquiry.",
+           "Our office will be closed on {day} for the holiday.",
+           "Please find the updated invoice attached; payment is due in 30 days.",
+           "We have processed the refund; it should reach your account within 5 business days.",
+           "The partners review is scheduled for {day}, agenda attached for internal circulation.",
+           "Sorry for the delay. Your case is with our team and we expect an answer this week."]
+_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+
+
+# ====================  measurement  ====================
+
+def latency_stats(samples: List[float], ops: Optional[int] = None, wall_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """Latency percentiles (ms) of `samples` (seconds) and throughput: ops over wall time (default: their sum)."""
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    wall = wall_seconds if wall_seconds is not None else float(np.sum(samples))
+    return {
+        "count": len(samples),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "mean_ms": round(float(values.mean()), 3),
+        "max_ms": round(float(values.max()), 3),
+        "ops_per_sec": round((ops if ops is not None else len(samples)) / wall, 3) if wall else 0.0,
+    }
+
+
+def timed(fn: Callable[[int], Any], iterations: int, warmup: int) -> List[float]:
+    for i in range(warmup):
+        fn(-1 - i)
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+# ====================  stand-ins  ====================
+
+class HashingEncoder:
+    """
+    Deterministic bag-of-words encoder with a SentenceTransformer-like interface, for
+    machines without the embedding model. Measures the pipeline, not embedding quality.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = False, **kwargs: Any) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        if normalize_embeddings:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+
+def setup_embedder(choice: str) -> str:
+    from embeddings import get_engine
+    if choice == "auto":
+        try:
+            import sentence_transformers  # noqa: F401
+            choice = "model"
+        except ImportError:
+            choice = "hash"
+    if choice == "hash":
+        get_engine().use_model(HashingEncoder())
+    return choice
+
+
+def synthetic_chunks(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        day = rng.choice(_DAYS)
+        subject = rng.choice(_SUBJECTS).format(n=rng.randint(100, 999), day=day)
+        body = " ".join(rng.choice(_BODIES).format(day=day) for _ in range(rng.randint(1, 3)))
+        chunks.append({"chunk_id": i, "text": f"Subject: {subject}\n\n{body}", "source": f"mail-{i // 4}.eml"})
+    return chunks
+
+
+def build_store(args: argparse.Namespace):
+    """An in-memory Qdrant or embedded collection of synthetic chunks, or the configured server."""
+    from ingest import DEFAULT_COLLECTION
+    from qdrant_client import QdrantClient
+    from qdrant_client.http import models
+
+    if args.qdrant == "local":
+        from drivers import qdrant_driver
+        return qdrant_driver
+
+    from embeddings import get_engine
+    chunks = synthetic_chunks(args.points, args.seed)
+    vectors = get_engine().encode([c["text"] for c in chunks], use_cache=False)
+    if args.qdrant == "embedded":
+        import atexit
+        import shutil
+        import tempfile
+        from vector_store import LocalVectorStore
+        path = tempfile.mkdtemp(prefix="bench-vectors-")
+        atexit.register(shutil.rmtree, path, True)
+        qdrant = LocalVectorStore.from_env(path=path)
+    else:
+        qdrant = QdrantClient(":memory:")
+    qdrant.create_collection(DEFAULT_COLLECTION, vectors_config=models.VectorParams(
+        size=vectors.shape[1], distance=models.Distance.COSINE))
+    qdrant.upload_collection(DEFAULT_COLLECTION, vectors=vectors, payload=chunks, ids=list(range(len(chunks))))
+    return qdrant
+
+
+# ====================  cases  ====================
+
+def bench_embedding(args: argparse.Namespace, context: Dict[str, Any]) -> Dict[str, Any]:
+    from llm import get_embedding
+    corpus = [c["text"] for c in synthetic_chunks(256, args.seed)]
+    results = {}
+    for batch_size in args.batch_sizes:
+        # a run tag per call keeps every text new, so no cache tier can serve it
+        def call(run: int) -> None:
+            get_embedding([f"{corpus[i % len(corpus)]} [{batch_size}:{run}:{i}]" for i in range(batch_size)])
+        samples = timed(call, args.iterations, args.warmup)
+        stats = latency_stats(samples, ops=batch_size * len(samples))
+        stats["unit"] = "texts"
+        results[f"batch_{batch_size}"] = stats
+    return results
+
+
+def bench_vector_search(args: argparse.Namespace, context: Dict[str, Any]) -> Dict[str, Any]:
+    from tools import ResearchTools
+    tools = ResearchTools(context["store"], None)
+    samples = timed(lambda i: tools.search_vector_db(SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)], top_k=args.top_k),
+                    args.iterations, args.warmup)
+    return {"search": latency_stats(samples), "points": args.points if args.qdrant != "local" else None,
+            "top_k": args.top_k}
+
+
+def bench_research(args: argparse.Namespace, context: Dict[str, Any]) -> Dict[str, Any]:
+    from agentic_research_ai import create_graph
+    from tools import ResearchTools
+    graph = create_graph(ResearchTools(context["store"], None))
+    iterations = max(1, args.iterations // 5)
+    with quiet_stdout(args):
+        samples = timed(lambda i: graph.invoke({"query": SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]}),
+                        iterations, min(args.warmup, 1))
+    return {"invoke": latency_stats(samples)}
+
+
+def bench_referee(args: argparse.Namespace, context: Dict[str, Any]) -> Dict[str, Any]:
+    import headless_runner as runner
+    import tracing
+    from prompts import registry as prompt_registry
+    from sop import load_sop
+
+    if (memory := tracing.aggregator()) is not None:
+        memory.reset()      # stages of this case only
+    results: Dict[str, Any] = {}
+    all_sessions, all_grading, wall_total = [], [], 0.0
+    for sop_path in sorted(glob.glob(os.path.join(args.sops, "*.json"))):
+        sop = load_sop(sop_path)
+        prompt_registry.precompile(sop.sop_id)
+        transcripts = runner.load_transcripts(runner.default_transcript_path(sop_path))
+        jobs = [(sop.sop_id, dict(t, session_id=f"{t['session_id']}#{i}"))
+                for i in range(args.repeat) for t in transcripts]
+        started = time.perf_counter()
+        with quiet_stdout(args):
+            sessions = runner.run_sessions(jobs, args.concurrency)
+        wall = time.perf_counter() - started
+        wall_total += wall
+        durations = [s.wall_seconds for s in sessions]
+        grading = [v for s in sessions for v in s.node_latency.get("grading", [])]
+        all_sessions.extend(durations)
+        all_grading.extend(grading)
+        results[sop.sop_id] = {
+            "sessions": latency_stats(durations, wall_seconds=wall),
+            "grading": latency_stats(grading, wall_seconds=wall),
+            "completed": sum(s.completed for s in sessions),
+            "errors": sum(s.error is not None for s in sessions),
+        }
+    results["all"] = {
+        "sessions": latency_stats(all_sessions, wall_seconds=wall_total),
+        "grading": latency_stats(all_grading, wall_seconds=wall_total),
+        "stages": tracing.snapshot(),
+    }
+    return results
+
+
+CASES: Dict[str, Callable[[argparse.Namespace, Dict[str, Any]], Dict[str, Any]]] = {
+    "embedding": bench_embedding,
+    "vector_search": bench_vector_search,
+    "research": bench_research,
+    "referee": bench_referee,
+}
+
+
+# ====================  reporting  ====================
+
+@contextlib.contextmanager
+def quiet_stdout(args: argparse.Namespace) -> Iterator[None]:
+    if args.verbose:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """case/…/metric -> value for the compared metrics."""
+    out = {}
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            out.update(flatten(value, path))
+        elif key in ("p50_ms", "p95_ms", "p99_ms", "ops_per_sec"):
+            out[path] = value
+    return out
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> List[str]:
+    before, after = flatten(old["cases"]), flatten(new["cases"])
+    lines = [f"Compared with {old['meta'].get('commit')} ({old['meta'].get('timestamp')}):"]
+    for path in sorted(set(before) & set(after)):
+        if not before[path]:
+            continue
+        change = (after[path] - before[path]) / before[path] * 100
+        # latency going up and throughput going down are both regressions
+        worse = change > 0 if path.endswith("_ms") else change < 0
+        flag = "  ⚠️" if worse and abs(change) >= 10 else ""
+        lines.append(f"  {path:<48} {before[path]:>12.3f} -> {after[path]:>12.3f}  {change:+7.1f}%{flag}")
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Benchmark the simulation and research pipelines.")
+    parser.add_argument("cases", nargs="*", help=f"any of {', '.join(CASES)} (default: all)")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embedder", choices=["auto", "model", "hash"], default="auto")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--qdrant", choices=["memory", "embedded", "local"], default="memory")
+    parser.add_argument("--points", type=int, default=2000, help="synthetic chunks in the in-memory store")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--sops", default="sample_simulations", help="folder of SOP files with transcripts/")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=2, help="replay every transcript this many times")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="fake LLM median time to first token")
+    parser.add_argument("--llm-latency-sigma", type=float, default=0.3)
+    parser.add_argument("--llm-token-ms", type=float, default=0.0)
+    parser.add_argument("--response-cache", action="store_true", help="keep the verdict cache on (off by default)")
+    parser.add_argument("--fast-grader", action="store_true",
+                        help="run the embedding pre-grader (it only settles turns with calibrated thresholds)")
+    parser.add_argument("--out", default=os.path.join(".cache", "benchmarks", "{commit}.json"))
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipelines' console output")
+    args = parser.parse_args(argv)
+    cases = args.cases or list(CASES)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+
+    # settings read when the shared clients / caches are first built, so set them up front
+    os.environ.update({
+        "FAKE_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "FAKE_LLM_LATENCY_SIGMA": str(args.llm_latency_sigma),
+        "FAKE_LLM_TOKEN_MS": str(args.llm_token_ms),
+        "FAKE_LLM_SEED": str(args.seed),
+        "EMBEDDING_CACHE": "false",
+        "RESPONSE_CACHE": "true" if args.response_cache else "false",
+        "FAST_GRADER": "on" if args.fast_grader else "off",
+    })
+    from llm_backends import use_backend
+    use_backend("fake")
+    embedder = setup_embedder(args.embedder)
+
+    context: Dict[str, Any] = {}
+    if {"vector_search", "research"} & set(cases):
+        context["store"] = build_store(args)
+
+    results: Dict[str, Any] = {}
+    for name in cases:
+        started = time.perf_counter()
+        try:
+            results[name] = CASES[name](args, context)
+        except ImportError as e:
+            results[name] = {"skipped": str(e)}
+        print(f"⏱️  {name}: {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "embedder": embedder,
+            "llm_backend": "fake",
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "verbose")},
+        },
+        "cases": results,
+    }
+    out = args.out.format(commit=commit)
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"📝 Results written to {out}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print("\n".join(compare(json.load(f), report)))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# conversation.py
+#
+# Append-only conversation log for long training sessions.
+#
+# Graph state used to carry the transcript as a list and every node rebuilt it with
+# `state["history"] + [...]`, so each turn copied the whole conversation and each prompt
+# re-formatted it from scratch. Here a session's messages live once, in a log owned by
+# the process-wide store below; graph state only carries the conversation id and how
+# many messages of each log it has committed (`history_len`, `dialogue_len`).
+#
+# The store is not checkpointed, so a session can't outlive its process: restoring its
+# graph state elsewhere would find no log. session_server only accepts in-memory savers.
+#
+# Every message is formatted once, when it is appended, and the rendered transcript is
+# cached and only extended by the lines added since the last render.
+#
+# A node that is re-run (e.g. user_node resuming after an interrupt) appends at the length
+# recorded in its input state, which drops whatever the interrupted run had appended.
+#
+# Prompts don't take the whole log: a HistoryWindow keeps the most recent turns verbatim
+# within a per-role token budget and folds older turns into a running summary, one
+# batch of turns at a time, so per-turn prompt size (and latency) stays bounded however
+# long the session runs.
+
+import bisect
+import os
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from tokens import count_tokens, truncate_to_tokens
+
+# Token budget for the conversation part of each role's prompt (summary + verbatim turns)
+HISTORY_TOKEN_BUDGETS = {
+    "coach": int(os.getenv("COACH_HISTORY_TOKENS", "1500")),
+    "grader": int(os.getenv("GRADER_HISTORY_TOKENS", "1500")),
+    "customer": int(os.getenv("CUSTOMER_HISTORY_TOKENS", "2000")),
+}
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "300"))
+
+ROLLING_SUMMARY_PROMPT = """
+You keep a running summary of a role-play training conversation.
+
+Current summary:
+{summary}
+
+Newer turns to fold in:
+{turns}
+
+Rewrite the summary so it also covers the newer turns. Keep who said what, what the
+trainee has already done or been told, and any open questions. At most {max_words} words.
+Reply with the summary only.
+"""
+
+
+class Message:
+    __slots__ = ("role", "content", "meta")
+
+    def __init__(self, role: str, content: str, meta: Optional[Dict[str, Any]] = None):
+        self.role = role
+        self.content = content
+        self.meta = meta
+
+    @classmethod
+    def from_dict(cls, message: Dict[str, Any]) -> "Message":
+        return cls(message["role"], message.get("content", message.get("message", "")))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {**(self.meta or {}), "role": self.role, "content": self.content}
+
+    def render(self) -> str:
+        return f"{self.role.capitalize()}: {self.content}"
+
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content!r})"
+
+
+class ConversationLog:
+    """Messages in order, each with its rendered line; the joined transcript is cached."""
+
+    __slots__ = ("_messages", "_lines", "_token_prefix", "_rendered", "_rendered_upto")
+
+    def __init__(self, messages: Optional[List[Message]] = None):
+        self._messages: List[Message] = []
+        self._lines: List[str] = []
+        self._token_prefix: List[int] = [0]     # tokens of the first i rendered lines
+        self._rendered = ""
+        self._rendered_upto = 0
+        for message in messages or []:
+            self.append(message)
+
+    def append(self, message: Message, at: Optional[int] = None) -> int:
+        """
+        Append a message and return the new length. With `at`, anything past that position
+        (left behind by an interrupted run of the node) is discarded first.
+        """
+        if at is not None and at < len(self._messages):
+            del self._messages[at:]
+            del self._lines[at:]
+            del self._token_prefix[at + 1:]
+            if self._rendered_upto > at:
+                self._rendered, self._rendered_upto = "", 0
+        self._messages.append(message)
+        line = message.render()
+        self._lines.append(line)
+        self._token_prefix.append(self._token_prefix[-1] + count_tokens(line) + 1)
+        return len(self._messages)
+
+    def tokens(self, start: int, end: int) -> int:
+        """Tokens of messages [start, end) when rendered (one newline each)."""
+        return self._token_prefix[end] - self._token_prefix[start]
+
+    def render_range(self, start: int, end: int) -> str:
+        return "\n".join(self._lines[start:end])
+
+    def render(self, upto: Optional[int] = None) -> str:
+        """The first `upto` messages (default: all) as "Role: content" lines."""
+        upto = len(self._messages) if upto is None else min(upto, len(self._messages))
+        if upto < self._rendered_upto:
+            return "\n".join(self._lines[:upto])
+        if upto > self._rendered_upto:
+            new = "\n".join(self._lines[self._rendered_upto:upto])
+            self._rendered = f"{self._rendered}\n{new}" if self._rendered_upto else new
+            self._rendered_upto = upto
+        return self._rendered
+
+    def messages(self, upto: Optional[int] = None) -> Iterator[Message]:
+        upto = len(self._messages) if upto is None else min(upto, len(self._messages))
+        for i in range(upto):
+            yield self._messages[i]
+
+    def last(self) -> Optional[Message]:
+        return self._messages[-1] if self._messages else None
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Message]:
+        return iter(self._messages)
+
+
+class HistoryWindow:
+    """
+    A token-budgeted view of a ConversationLog for one role's prompts.
+
+    Messages [summarized_upto, upto) are kept verbatim. When they no longer fit next to
+    the summary, the oldest ones are folded into the summary with one `summarize(prompt)`
+    call, down to half the budget, so folding happens every few turns rather than every
+    turn and each call only sees the turns being folded.
+    """
+
+    __slots__ = ("log", "budget", "summary_tokens", "summarize", "summary", "summarized_upto")
+
+    def __init__(self, log: ConversationLog, budget: int, summarize: Callable[[str], str],
+                 summary_tokens: int = HISTORY_SUMMARY_TOKENS):
+        self.log = log
+        self.budget = budget
+        self.summary_tokens = min(summary_tokens, budget // 2)
+        self.summarize = summarize
+        self.summary = ""
+        self.summarized_upto = 0
+
+    def render(self, upto: Optional[int] = None) -> str:
+        upto = len(self.log) if upto is None else min(upto, len(self.log))
+        if upto < self.summarized_upto:
+            # the log was rolled back past what the summary covers
+            self.summary, self.summarized_upto = "", 0
+        start = self.summarized_upto
+        verbatim_budget = self.budget - self.summary_tokens
+        if self.log.tokens(start, upto) > verbatim_budget and upto - start > 1:
+            self._fold(start, upto, verbatim_budget // 2)
+            start = self.summarized_upto
+        text = self.log.render_range(start, upto)
+        if self.log.tokens(start, upto) > verbatim_budget:
+            # a single oversized message
+            text = truncate_to_tokens(text, verbatim_budget)
+        if self.summary:
+            return f"Summary of the earlier conversation: {self.summary}\n\n{text}"
+        return text
+
+    def _fold(self, start: int, upto: int, keep_tokens: int) -> None:
+        prefix = self.log._token_prefix
+        # first message such that everything from it to `upto` fits in keep_tokens;
+        # the latest message always stays verbatim
+        keep_from = bisect.bisect_left(prefix, prefix[upto] - keep_tokens, lo=start, hi=upto)
+        keep_from = max(start + 1, min(keep_from, upto - 1))
+        turns = truncate_to_tokens(self.log.render_range(start, keep_from), self.budget)
+        summary = self.summarize(ROLLING_SUMMARY_PROMPT.format(
+            summary=self.summary or "(nothing yet)",
+            turns=turns,
+            max_words=self.summary_tokens * 3 // 4,
+        ))
+        self.summary = truncate_to_tokens((summary or "").strip(), self.summary_tokens)
+        self.summarized_upto = keep_from
+
+
+class Conversation:
+    """One session's logs: the full `history` and the coach/trainee `dialogue` the coach sees."""
+
+    __slots__ = ("conversation_id", "history", "dialogue", "windows")
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.history = ConversationLog()
+        self.dialogue = ConversationLog()
+        self.windows: Dict[str, HistoryWindow] = {}
+
+    def window(self, role: str, log: ConversationLog, summarize: Callable[[str], str]) -> HistoryWindow:
+        """The role's budgeted window over `log`, created on first use."""
+        window = self.windows.get(role)
+        if window is None:
+            window = self.windows[role] = HistoryWindow(log, HISTORY_TOKEN_BUDGETS[role], summarize)
+        return window
+
+
+_store: Dict[str, Conversation] = {}
+_store_lock = threading.Lock()
+
+
+def new_conversation(conversation_id: Optional[str] = None) -> str:
+    conversation_id = conversation_id or uuid.uuid4().hex
+    with _store_lock:
+        _store.setdefault(conversation_id, Conversation(conversation_id))
+    return conversation_id
+
+
+def get_conversation(conversation_id: str) -> Conversation:
+    try:
+        return _store[conversation_id]
+    except KeyError:
+        raise KeyError(f"Unknown conversation {conversation_id!r}") from None
+
+
+def drop_conversation(conversation_id: str) -> None:
+    """Free a finished session's logs; the store keeps them until this is called."""
+    with _store_lock:
+        _store.pop(conversation_id, None)
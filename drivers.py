@@ -3,22 +3,45 @@
 import os
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient
-from neo4j import GraphDatabase
+from neo4j import AsyncDriver, AsyncGraphDatabase, GraphDatabase
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Qdrant setup
-qdrant_driver = QdrantClient(
-    host=os.getenv("QDRANT_HOST", "localhost"),
-    port=int(os.getenv("QDRANT_PORT", "6333"))
-)
-
-# Neo4j setup
-graph_driver = GraphDatabase.driver(
-    os.getenv("NEO4J_URI", "bolt://localhost:7687"),
-    auth=(
-        os.getenv("NEO4J_USER", "neo4j"),
-        os.getenv("NEO4J_PASSWORD", "neo4j")
+# Qdrant setup; VECTOR_STORE=local swaps in the embedded store (vector_store.py), no server needed
+if os.getenv("VECTOR_STORE", "qdrant") == "local":
+    from vector_store import LocalVectorStore
+    qdrant_driver = LocalVectorStore.from_env()
+else:
+    qdrant_driver = QdrantClient(
+        host=os.getenv("QDRANT_HOST", "localhost"),
+        port=int(os.getenv("QDRANT_PORT", "6333"))
     )
+
+# Neo4j setup; the async driver (graph_client.py) shares these pool settings
+NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
+NEO4J_AUTH = (
+    os.getenv("NEO4J_USER", "neo4j"),
+    os.getenv("NEO4J_PASSWORD", "neo4j")
+)
+NEO4J_POOL = dict(
+    max_connection_pool_size=int(os.getenv("NEO4J_MAX_POOL_SIZE", "50")),
+    connection_acquisition_timeout=float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "30")),
+    connection_timeout=float(os.getenv("NEO4J_CONNECTION_TIMEOUT", "15")),
+    # recycle connections before a load balancer or firewall drops them as idle
+    max_connection_lifetime=float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600")),
+    liveness_check_timeout=float(os.getenv("NEO4J_LIVENESS_CHECK_TIMEOUT", "60")),
+    keep_alive=True,
 )
+
+graph_driver = GraphDatabase.driver(NEO4J_URI, auth=NEO4J_AUTH, **NEO4J_POOL)
+
+_async_graph_driver = None
+
+
+def async_graph_driver() -> AsyncDriver:
+    """The async driver, created on first use."""
+    global _async_graph_driver
+    if _async_graph_driver is None:
+        _async_graph_driver = AsyncGraphDatabase.driver(NEO4J_URI, auth=NEO4J_AUTH, **NEO4J_POOL)
+    return _async_graph_driver
@@ -0,0 +1,308 @@
+# embedding_cache.py
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+
+def cache_key(namespace: str, text: str) -> str:
+    """Content address for `text` under an embedding namespace (model + encode options)."""
+    return hashlib.sha256(f"{namespace}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class DiskEmbeddingStore:
+    """
+    Fixed-capacity float32 matrix memory-mapped from `vectors.f32`, plus an
+    append-only key log (`index.log`) mapping content keys to matrix rows.
+
+    Log lines are "+ <key> <slot>" for a write and "- <key>" for an eviction.
+    The eviction line is written before the row is overwritten, so a crash
+    can lose an entry but never hand back the wrong vector for a key.
+
+    Several processes (say the headless runner and ingest) can share a store: every
+    read and write holds a lock on the `lock` file (shared / exclusive), and first
+    replays whatever the other processes appended to the log since, so slots are
+    never allocated twice and a key is never read from a slot someone else reused.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.dim: Optional[int] = None
+        self._slots: "OrderedDict[str, int]" = OrderedDict()   # LRU order, oldest first
+        self._owner: Dict[int, str] = {}
+        self._free: Set[int] = set()
+        self._matrix: Optional[np.memmap] = None
+        self._log = None
+        self._log_lines = 0
+        self._log_offset = 0            # bytes of index.log replayed so far
+        self._log_inode: Optional[int] = None
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, "lock"), "a+")
+        with self._locked(exclusive=False):
+            self._sync()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors.f32")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.path, "index.log")
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta")
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        if fcntl is None:       # no flock (Windows): one process per store
+            yield
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        """Catch up with the matrix and log as other processes left them (lock held)."""
+        if self._matrix is None:
+            if not os.path.exists(self._meta_path):
+                return
+            with open(self._meta_path) as f:
+                dim, capacity = (int(x) for x in f.read().split())
+            self._open_matrix(dim, capacity, mode="r+")
+            self._free = set(range(self.capacity))
+        try:
+            stat = os.stat(self._index_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._log_inode or stat.st_size < self._log_offset:
+            # first read, or another process compacted the log: replay it from the start
+            self._slots.clear()
+            self._owner.clear()
+            self._free = set(range(self.capacity))
+            self._log_offset = self._log_lines = 0
+            self._log_inode = stat.st_ino
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+        if stat.st_size == self._log_offset:
+            return
+        with open(self._index_path, "rb") as f:
+            f.seek(self._log_offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break       # a line still being written
+                self._log_offset += len(raw)
+                self._log_lines += 1
+                self._apply(raw.decode("utf-8").split())
+
+    def _apply(self, parts: List[str]) -> None:
+        if len(parts) == 3 and parts[0] == "+":
+            key, slot = parts[1], int(parts[2])
+            stale = self._owner.get(slot)
+            if stale is not None and stale != key and self._slots.get(stale) == slot:
+                self._slots.pop(stale)
+            previous = self._slots.pop(key, None)
+            if previous is not None and previous != slot:
+                self._owner.pop(previous, None)
+                self._free.add(previous)
+            self._slots[key] = slot
+            self._owner[slot] = key
+            self._free.discard(slot)
+        elif len(parts) == 2 and parts[0] == "-":
+            slot = self._slots.pop(parts[1], None)
+            if slot is not None:
+                self._owner.pop(slot, None)
+                self._free.add(slot)
+
+    def _open_matrix(self, dim: int, capacity: int, mode: str) -> None:
+        self.dim = dim
+        self.capacity = capacity
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode=mode, shape=(capacity, dim))
+
+    def _create(self, dim: int) -> None:
+        self._open_matrix(dim, self.capacity, mode="w+")
+        with open(self._meta_path, "w") as f:
+            f.write(f"{dim} {self.capacity}")
+        self._free = set(range(self.capacity))
+
+    def _append_log(self, line: str) -> None:
+        if self._log is None:
+            self._log = open(self._index_path, "a")
+            self._log_inode = os.fstat(self._log.fileno()).st_ino
+        self._log.write(line + "\n")
+        self._log.flush()
+        self._log_lines += 1
+        self._log_offset += len(line.encode("utf-8")) + 1
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[np.ndarray]]:
+        with self._locked(exclusive=False):
+            self._sync()
+            found: List[Optional[np.ndarray]] = []
+            for key in keys:
+                slot = self._slots.get(key)
+                if slot is None:
+                    found.append(None)
+                    continue
+                self._slots.move_to_end(key)
+                found.append(np.array(self._matrix[slot]))
+            return found
+
+    def put(self, key: str, vector: np.ndarray) -> Optional[str]:
+        """Store `vector`; returns the evicted key when the store was full."""
+        evicted = self.put_many([(key, vector)])
+        return evicted[0] if evicted else None
+
+    def put_many(self, items: Sequence[Tuple[str, np.ndarray]]) -> List[str]:
+        """Store (key, vector) pairs; returns the keys evicted to make room."""
+        evicted: List[str] = []
+        with self._locked(exclusive=True):
+            self._sync()
+            for key, vector in items:
+                if self._matrix is None:
+                    self._create(int(vector.shape[-1]))
+                slot = self._slots.pop(key, None)
+                if slot is None:
+                    if self._free:
+                        slot = self._free.pop()
+                    else:
+                        old, slot = self._slots.popitem(last=False)
+                        self._append_log(f"- {old}")
+                        evicted.append(old)
+                self._matrix[slot] = vector
+                self._slots[key] = slot
+                self._owner[slot] = key
+                self._append_log(f"+ {key} {slot}")
+            if self._log_lines > 4 * self.capacity:
+                self._compact()
+        return evicted
+
+    def _compact(self) -> None:
+        """Rewrite the key log as a snapshot of the live entries (keeps LRU order; lock held)."""
+        self.flush()
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for key, slot in self._slots.items():
+                f.write(f"+ {key} {slot}\n")
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        os.replace(tmp_path, self._index_path)
+        stat = os.stat(self._index_path)
+        self._log_inode, self._log_offset = stat.st_ino, stat.st_size
+        self._log_lines = len(self._slots)
+
+    def flush(self) -> None:
+        if self._matrix is not None:
+            self._matrix.flush()
+        if self._log is not None:
+            self._log.flush()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU of recent vectors in front of an
+    optional DiskEmbeddingStore shared across restarts.
+    """
+
+    def __init__(self, namespace: str, path: Optional[str] = None, capacity: int = 100_000,
+                 memory_capacity: int = 4096):
+        self.namespace = namespace
+        self.memory_capacity = memory_capacity
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._disk = DiskEmbeddingStore(path, capacity) if path else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls, namespace: str) -> "EmbeddingCache":
+        base = os.getenv("EMBEDDING_CACHE_DIR", ".cache/embeddings")
+        path = None
+        if base:
+            # one store per namespace, since vector widths differ between models
+            path = os.path.join(base, hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:16])
+        return cls(
+            namespace,
+            path=path,
+            capacity=int(os.getenv("EMBEDDING_CACHE_SIZE", "100000")),
+            memory_capacity=int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "4096")),
+        )
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_capacity:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Look up each text; misses come back as None."""
+        keys = [cache_key(self.namespace, text) for text in texts]
+        found: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self._lock:
+            on_disk = []
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    found[i] = vector
+                else:
+                    on_disk.append(i)
+            # one lock + log catch-up on the shared store for the whole batch
+            vectors = self._disk.get_many([keys[i] for i in on_disk]) if self._disk is not None and on_disk else []
+            for i, vector in zip(on_disk, vectors):
+                if vector is not None:
+                    self._remember(keys[i], vector)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    found[i] = vector
+            self.misses += sum(1 for i in on_disk if found[i] is None)
+        return found
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray) -> None:
+        items = [(cache_key(self.namespace, text), np.array(vector, dtype=np.float32))
+                 for text, vector in zip(texts, vectors)]
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, vector)
+            if self._disk is not None:
+                self.evictions += len(self._disk.put_many(items))
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._disk is not None:
+                self._disk.flush()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk) if self._disk is not None else 0,
+        }
@@ -0,0 +1,161 @@
+# embeddings.py
+
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embedding_cache import EmbeddingCache
+
+load_dotenv()
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+@dataclass(frozen=True)
+class EmbeddingConfig:
+    """
+    Settings for a SentenceTransformer embedding engine.
+    Engines are shared per config, so two graphs asking for the same config get the same model.
+    """
+    model_name: str = DEFAULT_EMBEDDING_MODEL
+    device: Optional[str] = None           # None lets sentence_transformers pick (cuda / mps / cpu)
+    batch_size: int = 32
+    normalize: bool = False
+    max_seq_length: Optional[int] = None   # None keeps the model default
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingConfig":
+        return cls(
+            model_name=os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL),
+            device=os.getenv("EMBEDDING_DEVICE") or None,
+            batch_size=_env_int("EMBEDDING_BATCH_SIZE") or 32,
+            normalize=_env_bool("EMBEDDING_NORMALIZE", False),
+            max_seq_length=_env_int("EMBEDDING_MAX_SEQ_LENGTH"),
+        )
+
+    @property
+    def cache_namespace(self) -> str:
+        # every setting that changes the produced vectors has to be part of the cache key
+        return f"{self.model_name}|normalize={self.normalize}|max_seq_length={self.max_seq_length}"
+
+
+class EmbeddingEngine:
+    """
+    Lazily loaded SentenceTransformer wrapper.
+    Nothing heavy (torch, model weights) is imported or loaded until the first encode() call
+    that misses the cache.
+    """
+
+    def __init__(self, config: EmbeddingConfig, cache: Optional[EmbeddingCache] = None):
+        self.config = config
+        self.cache = cache
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+
+                    model = SentenceTransformer(self.config.model_name, device=self.config.device)
+                    if self.config.max_seq_length:
+                        model.max_seq_length = self.config.max_seq_length
+                    self._model = model
+        return self._model
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: Union[str, List[str]], batch_size: Optional[int] = None,
+               use_cache: bool = True) -> np.ndarray:
+        """
+        Encode one text or a list of texts into a (n, dim) float32 matrix.
+        Pass use_cache=False for one-off bulk text (e.g. corpus ingestion) that would only churn the cache.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        if self.cache is None or not use_cache:
+            return self._encode(texts, batch_size)
+
+        cached = self.cache.get_many(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if not missing:
+            return np.stack(cached) if cached else np.empty((0, 0), dtype=np.float32)
+
+        # encode each distinct missing text once
+        pending = list(dict.fromkeys(texts[i] for i in missing))
+        fresh = self._encode(pending, batch_size)
+        self.cache.put_many(pending, fresh)
+        rows = dict(zip(pending, fresh))
+        for i in missing:
+            cached[i] = rows[texts[i]]
+        return np.stack(cached)
+
+    def _encode(self, texts: List[str], batch_size: Optional[int]) -> np.ndarray:
+        vectors = self.model.encode(
+            texts,
+            batch_size=batch_size or self.config.batch_size,
+            normalize_embeddings=self.config.normalize,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return np.asarray(vectors, dtype=np.float32)
+
+    def use_model(self, model: Any) -> None:
+        """
+        Encode with `model` instead of loading config.model_name. Anything with the
+        SentenceTransformer encode()/get_sentence_embedding_dimension() interface will do.
+        """
+        with self._lock:
+            self._model = model
+
+    def unload(self) -> None:
+        """Drop the model so an idle worker can give the memory back."""
+        with self._lock:
+            self._model = None
+
+
+_engines: Dict[EmbeddingConfig, EmbeddingEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(config: Optional[EmbeddingConfig] = None) -> EmbeddingEngine:
+    """
+    Return the process-wide engine for `config` (defaults to the environment config).
+    Set EMBEDDING_CACHE=false to bypass the embedding cache.
+    """
+    if config is None:
+        config = EmbeddingConfig.from_env()
+    engine = _engines.get(config)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(config)
+            if engine is None:
+                cache = None
+                if _env_bool("EMBEDDING_CACHE", True):
+                    cache = EmbeddingCache.from_env(config.cache_namespace)
+                engine = _engines[config] = EmbeddingEngine(config, cache)
+    return engine
@@ -0,0 +1,280 @@
+# fast_grader.py
+#
+# Embedding pre-grader in front of grader_node.
+#
+# Each SOP step is embedded once (its rubric description and example message); a trainee
+# reply is embedded and scored against the step's anchors with one matrix product. Replies
+# scoring at or above the pass threshold pass, replies below the fail threshold fail, and
+# only the band in between goes to the grader + referee LLMs.
+#
+# Every reply the LLMs grade (and the referee confirms) is logged with its score, and
+# `python fast_grader.py calibrate` picks the thresholds from that log:
+#
+#   python fast_grader.py calibrate --precision 0.97 --min-support 20
+#
+# FAST_GRADER picks the mode:
+#   off (default)  no pre-grader at all
+#   shadow         score and log every reply, but let the LLMs grade all of them; run
+#                  this for a while to collect the log `calibrate` needs
+#   on             settle clear passes / fails without the LLMs - only once thresholds
+#                  are calibrated (FAST_GRADER_THRESHOLDS file, or FAST_GRADER_PASS and
+#                  FAST_GRADER_FAIL set); until then it stays in shadow mode
+#
+# If the embedding model can't be loaded (not installed, offline, hub error) the
+# pre-grader disables itself and every reply goes to the LLMs.
+
+import argparse
+import json
+import math
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from sop import SOPDefinition, get_sop
+
+FAST_GRADER_LOG = os.getenv("FAST_GRADER_LOG", ".cache/fast_grader.jsonl")
+FAST_GRADER_THRESHOLDS = os.getenv("FAST_GRADER_THRESHOLDS", ".cache/fast_grader_thresholds.json")
+
+# Placeholders until calibrated, and never used to settle a turn: only near-paraphrases
+# would pass, only clearly off-topic replies would fail
+DEFAULT_PASS_THRESHOLD = 0.85
+DEFAULT_FAIL_THRESHOLD = 0.20
+
+
+class EmbeddingUnavailable(RuntimeError):
+    """The embedding model could not be loaded or run."""
+
+
+@dataclass(frozen=True)
+class FastVerdict:
+    score: float
+    step_passed: Optional[bool]         # None: inside the uncertainty band (or shadow mode), ask the LLMs
+
+    @property
+    def decided(self) -> bool:
+        return self.step_passed is not None
+
+
+def step_anchors(step: Dict) -> List[str]:
+    rubric = step.get("rubric", {})
+    return [text for text in (rubric.get("description"), rubric.get("example_message")) if text]
+
+
+class FastGrader:
+    def __init__(self, pass_threshold: float = DEFAULT_PASS_THRESHOLD, fail_threshold: float = DEFAULT_FAIL_THRESHOLD,
+                 encode: Optional[Callable[[List[str]], np.ndarray]] = None, log_path: Optional[str] = FAST_GRADER_LOG,
+                 enforce: bool = True):
+        self.pass_threshold = pass_threshold
+        self.fail_threshold = fail_threshold
+        self.log_path = log_path
+        self.enforce = enforce          # False: shadow mode, scores are only logged
+        self._encode = encode
+        self._anchors: Dict[str, Tuple[SOPDefinition, Dict[int, np.ndarray]]] = {}
+        self._lock = threading.Lock()
+        self.disabled_reason: Optional[str] = None
+        self.decided = 0
+        self.deferred = 0
+
+    @classmethod
+    def from_env(cls, mode: Optional[str] = None) -> "FastGrader":
+        pass_threshold, fail_threshold = DEFAULT_PASS_THRESHOLD, DEFAULT_FAIL_THRESHOLD
+        calibrated = bool(os.getenv("FAST_GRADER_PASS") and os.getenv("FAST_GRADER_FAIL"))
+        if FAST_GRADER_THRESHOLDS and os.path.exists(FAST_GRADER_THRESHOLDS):
+            with open(FAST_GRADER_THRESHOLDS) as f:
+                thresholds = json.load(f)
+            # a side the log couldn't support is never settled
+            pass_threshold = thresholds.get("pass_threshold")
+            fail_threshold = thresholds.get("fail_threshold")
+            pass_threshold = math.inf if pass_threshold is None else pass_threshold
+            fail_threshold = -math.inf if fail_threshold is None else fail_threshold
+            calibrated = True
+        enforce = (mode or fast_grader_mode()) == "on"
+        if enforce and not calibrated:
+            print("⚠️  Fast grader thresholds are not calibrated; running in shadow mode "
+                  "(python fast_grader.py calibrate)")
+            enforce = False
+        return cls(
+            pass_threshold=float(os.getenv("FAST_GRADER_PASS") or pass_threshold),
+            fail_threshold=float(os.getenv("FAST_GRADER_FAIL") or fail_threshold),
+            enforce=enforce,
+        )
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        try:
+            if self._encode is None:
+                from embeddings import get_engine
+                self._encode = get_engine().encode
+            vectors = np.asarray(self._encode(texts), dtype=np.float32)
+        except Exception as e:
+            raise EmbeddingUnavailable(f"{type(e).__name__}: {e}") from e
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def _step_matrices(self, sop_id: str) -> Dict[int, np.ndarray]:
+        """Unit-norm anchor rows per step, embedded in one batch the first time an SOP is graded."""
+        sop = get_sop(sop_id)
+        entry = self._anchors.get(sop_id)
+        if entry is not None and entry[0] is sop:
+            return entry[1]
+        with self._lock:
+            entry = self._anchors.get(sop_id)
+            if entry is not None and entry[0] is sop:
+                return entry[1]
+            owners, texts = [], []
+            for number in sop.step_numbers:
+                for text in step_anchors(sop.step(number)):
+                    owners.append(number)
+                    texts.append(text)
+            vectors = self.encode(texts) if texts else np.zeros((0, 1), dtype=np.float32)
+            owners_arr = np.asarray(owners)
+            matrices = {number: vectors[owners_arr == number] for number in sop.step_numbers}
+            self._anchors[sop_id] = (sop, matrices)
+            return matrices
+
+    def score(self, sop_id: str, step: int, reply: str) -> Optional[float]:
+        anchors = self._step_matrices(sop_id).get(step)
+        if anchors is None or not len(anchors):
+            return None
+        return float(np.max(anchors @ self.encode([reply])[0]))
+
+    def grade(self, sop_id: str, step: int, reply: str) -> Optional[FastVerdict]:
+        """A verdict, or None when the pre-grader can't run (no anchors, no embedding model)."""
+        if self.disabled_reason is not None:
+            return None
+        try:
+            score = self.score(sop_id, step, reply)
+        except EmbeddingUnavailable as e:
+            # no embedding backend, or a model that won't load: every reply goes to the LLMs
+            self.disabled_reason = str(e)
+            print(f"⚠️  Fast grader disabled: {e}")
+            return None
+        if score is None:
+            return None
+        if score >= self.pass_threshold:
+            passed: Optional[bool] = True
+        elif score < self.fail_threshold:
+            passed = False
+        else:
+            passed = None
+        with self._lock:
+            if passed is None:
+                self.deferred += 1
+            else:
+                self.decided += 1
+        # in shadow mode `decided` counts what would have been settled, but the LLMs still grade it
+        return FastVerdict(score=score, step_passed=passed if self.enforce else None)
+
+    def log_outcome(self, sop_id: str, step: int, score: float, step_passed: bool) -> None:
+        """Record an LLM verdict the referee confirmed, for calibration."""
+        if not self.log_path:
+            return
+        line = json.dumps({"sop_id": sop_id, "step": step, "score": round(score, 5), "step_passed": bool(step_passed)})
+        with self._lock:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a") as f:
+                f.write(line + "\n")
+
+    def stats(self) -> Dict[str, float]:
+        total = self.decided + self.deferred
+        return {
+            "mode": "on" if self.enforce else "shadow",
+            "decided": self.decided,
+            "deferred": self.deferred,
+            "fast_path_rate": self.decided / total if total else 0.0,
+            "pass_threshold": self.pass_threshold,
+            "fail_threshold": self.fail_threshold,
+        }
+
+
+def calibrate(outcomes: List[Tuple[float, bool]], precision: float = 0.97, min_support: int = 20) -> Dict[str, Any]:
+    """
+    Pick the lowest pass threshold at which replies scoring at or above it passed with at least
+    `precision`, and the highest fail threshold below which they failed with at least
+    `precision`, each backed by at least `min_support` logged outcomes. A threshold the log
+    can't support is None: that side is never settled without the LLMs.
+    """
+    scores = np.asarray([s for s, _ in outcomes], dtype=np.float64)
+    passed = np.asarray([p for _, p in outcomes], dtype=bool)
+    order = np.argsort(scores)
+    scores, passed = scores[order], passed[order]
+    n = len(scores)
+
+    pass_threshold: Optional[float] = None
+    # suffix i.. = replies scoring >= scores[i]
+    suffix_pass = np.cumsum(passed[::-1])[::-1]
+    for i in range(n):
+        support = n - i
+        if support < min_support:
+            break
+        if suffix_pass[i] / support >= precision:
+            pass_threshold = float(scores[i])
+            break
+
+    fail_threshold: Optional[float] = None
+    # prefix ..i = replies scoring < scores[i]
+    prefix_fail = np.cumsum(~passed)
+    for i in range(n - 1, min_support - 1, -1):
+        support = i
+        if prefix_fail[i - 1] / support >= precision:
+            fail_threshold = float(scores[i])
+            break
+
+    # never let the bands overlap
+    if fail_threshold is not None and pass_threshold is not None:
+        fail_threshold = min(fail_threshold, pass_threshold)
+    return {"pass_threshold": pass_threshold, "fail_threshold": fail_threshold, "outcomes": n}
+
+
+def load_outcomes(path: str = FAST_GRADER_LOG) -> List[Tuple[float, bool]]:
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [(row["score"], row["step_passed"]) for row in rows]
+
+
+_grader: Optional[FastGrader] = None
+_grader_lock = threading.Lock()
+
+
+def fast_grader_mode() -> str:
+    """The FAST_GRADER mode: off, shadow or on (true / false are read as on / off)."""
+    value = os.getenv("FAST_GRADER", "off").strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return "on"
+    if value == "shadow":
+        return "shadow"
+    return "off"
+
+
+def get_fast_grader() -> Optional[FastGrader]:
+    """Process-wide pre-grader, or None when FAST_GRADER=off."""
+    global _grader
+    if fast_grader_mode() == "off":
+        return None
+    if _grader is None:
+        with _grader_lock:
+            if _grader is None:
+                _grader = FastGrader.from_env()
+    return _grader
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Calibrate the embedding pre-grader from logged outcomes.")
+    parser.add_argument("command", choices=["calibrate"])
+    parser.add_argument("--log", default=FAST_GRADER_LOG)
+    parser.add_argument("--out", default=FAST_GRADER_THRESHOLDS)
+    parser.add_argument("--precision", type=float, default=0.97)
+    parser.add_argument("--min-support", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    thresholds = calibrate(load_outcomes(args.log), precision=args.precision, min_support=args.min_support)
+    with open(args.out, "w") as f:
+        json.dump(thresholds, f, indent=2)
+    print(json.dumps(thresholds, indent=2))
+    return thresholds
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# graph_client.py
+#
+# Neo4j access for the research tools.
+#
+# Queries are parameterized Cypher, registered once under a name in `queries`. The query
+# text never changes between calls, so the server reuses its cached plan instead of
+# planning every call again, and values are sent as parameters rather than spliced into
+# the string. Reads run in read transactions: a cluster routes them to a reader, and
+# managed ones (`read`) are retried by the driver on transient errors.
+#
+# `stream` keeps the result open and pulls records from the server NEO4J_FETCH_SIZE at a
+# time, so a large subgraph pull never sits in memory whole. The `a*` methods do the same
+# on the async driver, which is only created when first used.
+#
+# Pool settings for both drivers live in drivers.py.
+
+import itertools
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import neo4j
+from dotenv import load_dotenv
+
+from tracing import tracer
+
+load_dotenv()
+
+_PARAMETER = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)")
+
+
+@dataclass(frozen=True)
+class PreparedQuery:
+    name: str
+    cypher: str
+    params: Tuple[str, ...]             # $parameters the query text refers to
+
+    def bind(self, params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        params = dict(params or {})
+        missing = [name for name in self.params if name not in params]
+        if missing:
+            raise ValueError(f"Query {self.name!r} is missing parameters: {', '.join(missing)}")
+        return params
+
+
+class QueryRegistry:
+    """Named Cypher queries. Unregistered query text is still accepted, as an ad-hoc query."""
+
+    def __init__(self):
+        self._queries: Dict[str, PreparedQuery] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, cypher: str) -> PreparedQuery:
+        query = PreparedQuery(name, cypher.strip(), tuple(dict.fromkeys(_PARAMETER.findall(cypher))))
+        with self._lock:
+            self._queries[name] = query
+        return query
+
+    def get(self, name: str) -> PreparedQuery:
+        try:
+            return self._queries[name]
+        except KeyError:
+            raise KeyError(f"No graph query registered as {name!r}") from None
+
+    def resolve(self, query: str) -> PreparedQuery:
+        """The registered query named `query`, or `query` itself as ad-hoc Cypher."""
+        prepared = self._queries.get(query)
+        if prepared is not None:
+            return prepared
+        return PreparedQuery("adhoc", query, tuple(dict.fromkeys(_PARAMETER.findall(query))))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._queries
+
+    def __len__(self) -> int:
+        return len(self._queries)
+
+
+queries = QueryRegistry()
+
+
+class GraphClient:
+    def __init__(self, driver: neo4j.Driver, database: Optional[str] = None, fetch_size: int = 1000,
+                 async_driver: Optional[Callable[[], neo4j.AsyncDriver]] = None):
+        self.driver = driver
+        self.database = database
+        self.fetch_size = fetch_size
+        self._async_driver = async_driver
+
+    @classmethod
+    def from_env(cls, driver: neo4j.Driver, **overrides: Any) -> "GraphClient":
+        def async_driver() -> neo4j.AsyncDriver:
+            from drivers import async_graph_driver
+            return async_graph_driver()
+
+        settings = dict(
+            database=os.getenv("NEO4J_DATABASE") or None,
+            fetch_size=int(os.getenv("NEO4J_FETCH_SIZE", "1000")),
+            async_driver=async_driver,
+        )
+        settings.update(overrides)
+        return cls(driver, **settings)
+
+    def _session_config(self, fetch_size: Optional[int]) -> Dict[str, Any]:
+        return dict(database=self.database, fetch_size=fetch_size or self.fetch_size,
+                    default_access_mode=neo4j.READ_ACCESS)
+
+    # ----------------------------------------------------- sync
+
+    def read(self, query: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Run a registered query name (or Cypher text) in a managed read transaction."""
+        prepared = queries.resolve(query)
+        params = prepared.bind(params)
+
+        def work(tx: neo4j.ManagedTransaction) -> List[Dict[str, Any]]:
+            return [record.data() for record in tx.run(prepared.cypher, params)]
+
+        with tracer.span("neo4j.read", "neo4j", query=prepared.name) as span:
+            with self.driver.session(**self._session_config(None)) as session:
+                records = session.execute_read(work)
+            if span is not None:
+                span.attrs["records"] = len(records)
+        return records
+
+    def stream(self, query: str, params: Optional[Dict[str, Any]] = None,
+               fetch_size: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield records as the server sends them, `fetch_size` per round-trip. The session and
+        its read transaction stay open until the generator is exhausted or closed; it is not
+        retried, since records may already have been consumed.
+        """
+        prepared = queries.resolve(query)
+        params = prepared.bind(params)
+        # not made current: a generator's context is its consumer's
+        span = tracer.start("neo4j.stream", "neo4j", query=prepared.name)
+        error: Optional[BaseException] = None
+        records = 0
+        try:
+            with self.driver.session(**self._session_config(fetch_size)) as session:
+                with session.begin_transaction() as tx:
+                    for record in tx.run(prepared.cypher, params):
+                        records += 1
+                        yield record.data()
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if span is not None:
+                span.attrs["records"] = records
+            tracer.end(span, error)
+
+    def stream_batches(self, query: str, params: Optional[Dict[str, Any]] = None,
+                       fetch_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        """`stream`, grouped into lists of one fetch each."""
+        fetch_size = fetch_size or self.fetch_size
+        records = self.stream(query, params, fetch_size)
+        try:
+            while True:
+                batch = list(itertools.islice(records, fetch_size))
+                if not batch:
+                    return
+                yield batch
+        finally:
+            records.close()
+
+    # ----------------------------------------------------- async
+
+    def _async(self) -> neo4j.AsyncDriver:
+        if self._async_driver is None:
+            raise RuntimeError("GraphClient was created without an async driver")
+        return self._async_driver()
+
+    async def aread(self, query: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        prepared = queries.resolve(query)
+        params = prepared.bind(params)
+
+        async def work(tx: neo4j.AsyncManagedTransaction) -> List[Dict[str, Any]]:
+            result = await tx.run(prepared.cypher, params)
+            return [record.data() async for record in result]
+
+        with tracer.span("neo4j.read", "neo4j", query=prepared.name) as span:
+            async with self._async().session(**self._session_config(None)) as session:
+                records = await session.execute_read(work)
+            if span is not None:
+                span.attrs["records"] = len(records)
+        return records
+
+    async def astream(self, query: str, params: Optional[Dict[str, Any]] = None,
+                      fetch_size: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        prepared = queries.resolve(query)
+        params = prepared.bind(params)
+        # not made current, as in `stream`
+        span = tracer.start("neo4j.stream", "neo4j", query=prepared.name)
+        error: Optional[BaseException] = None
+        records = 0
+        try:
+            async with self._async().session(**self._session_config(fetch_size)) as session:
+                async with await session.begin_transaction() as tx:
+                    result = await tx.run(prepared.cypher, params)
+                    async for record in result:
+                        records += 1
+                        yield record.data()
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if span is not None:
+                span.attrs["records"] = records
+            tracer.end(span, error)
@@ -0,0 +1,191 @@
+# headless_runner.py
+#
+# Replays scripted trainee transcripts against the coach / grader / referee graph in
+# langchain_referee.py without a keyboard, many sessions at a time, and records the
+# outcome and per-node latency of every session.
+#
+#   python headless_runner.py sample_simulations/SOP145.json --concurrency 8 --repeat 4
+#
+# Transcripts live next to the SOP files: sample_simulations/transcripts/<SOP>.jsonl,
+# one session per line: {"session_id": "...", "replies": ["trainee reply", ...]}
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import langchain_referee as referee
+from conversation import drop_conversation
+from fast_grader import get_fast_grader
+from prompts import metrics as prompt_metrics, registry as prompt_registry
+from response_cache import get_response_cache
+from sop import get_sop, load_sop
+import tracing
+
+
+class ScriptExhausted(Exception):
+    """The transcript ran out of trainee replies before the SOP was finished."""
+
+
+@dataclass
+class SessionResult:
+    session_id: str
+    sop: str
+    completed: bool = False
+    current_step: int = 1
+    total_steps: int = 0
+    replies_used: int = 0
+    node_runs: int = 0
+    error: Optional[str] = None
+    wall_seconds: float = 0.0
+    node_latency: Dict[str, List[float]] = field(default_factory=dict)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def default_transcript_path(sop_path: str) -> str:
+    folder, name = os.path.split(sop_path)
+    return os.path.join(folder, "transcripts", os.path.splitext(name)[0] + ".jsonl")
+
+
+def load_transcripts(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_session(sop: str, transcript: Dict[str, Any], max_node_runs: int = 1000,
+                grader_mode: Optional[str] = None) -> SessionResult:
+    """Drive one session to completion (or until its script runs out), timing every node."""
+    replies = list(transcript["replies"])
+    result = SessionResult(session_id=transcript["session_id"], sop=sop, total_steps=get_sop(sop).total_steps)
+
+    def reply_source(prompt: str) -> str:
+        if result.replies_used >= len(replies):
+            raise ScriptExhausted()
+        result.replies_used += 1
+        return replies[result.replies_used - 1]
+
+    thread_id = f"headless-{uuid.uuid4().hex}"
+    config = referee.session_config(thread_id, reply_source=reply_source, grader_mode=grader_mode or referee.GRADER_MODE)
+    config["recursion_limit"] = max_node_runs
+    state = referee.new_state(sop)
+    started = time.perf_counter()
+    last = graded_at = started
+    try:
+        # nodes run one after another, so the gap between two "updates" events is the
+        # latency of the node that produced the second one
+        for mode, chunk in referee.simulation.stream(state, config, stream_mode=["updates", "values"]):
+            if mode == "updates":
+                now = time.perf_counter()
+                for node, update in chunk.items():
+                    result.node_latency.setdefault(node, []).append(now - last)
+                    result.node_runs += 1
+                    # "grading": reply in to audited verdict out, whichever nodes did the work
+                    if node == "grader" and update and update.get("last_referee"):
+                        result.node_latency.setdefault("grading", []).append(now - last)
+                    elif node == "grader":
+                        graded_at = last
+                    elif node == "referee":
+                        result.node_latency.setdefault("grading", []).append(now - graded_at)
+                last = now
+            else:
+                state = chunk
+    except ScriptExhausted:
+        pass
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        referee.simulation.checkpointer.delete_thread(thread_id)
+        drop_conversation(state["conversation_id"])
+    result.wall_seconds = time.perf_counter() - started
+    result.completed = bool(state.get("done"))
+    result.current_step = state.get("current_step", 1)
+    return result
+
+
+def run_sessions(jobs: List[Tuple[str, Dict[str, Any]]], concurrency: int,
+                 grader_mode: Optional[str] = None) -> List[SessionResult]:
+    """Run (sop_id, transcript) jobs concurrently; sessions of different SOPs can mix freely."""
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda job: run_session(*job, grader_mode=grader_mode), jobs))
+
+
+def summarize(results: List[SessionResult], wall_seconds: float) -> Dict[str, Any]:
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    for result in results:
+        for node, values in result.node_latency.items():
+            latencies[node].extend(values)
+    return {
+        "sessions": len(results),
+        "completed": sum(r.completed for r in results),
+        "errors": sum(r.error is not None for r in results),
+        "wall_seconds": round(wall_seconds, 3),
+        "sessions_per_minute": round(len(results) / wall_seconds * 60, 2) if wall_seconds else 0.0,
+        "prompts": prompt_metrics.snapshot(),
+        "response_cache": cache.stats() if (cache := get_response_cache()) is not None else None,
+        "fast_grader": fast.stats() if (fast := get_fast_grader()) is not None else None,
+        # per-stage spans (nodes, LLM / embedding calls) and each node's share of turn time
+        "tracing": tracing.snapshot(),
+        "node_latency_ms": {
+            node: {
+                "count": len(values),
+                "p50": round(percentile(values, 50) * 1000, 2),
+                "p95": round(percentile(values, 95) * 1000, 2),
+                "p99": round(percentile(values, 99) * 1000, 2),
+                "max": round(max(values) * 1000, 2),
+            }
+            for node, values in sorted(latencies.items())
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Run scripted trainee sessions against the referee graph.")
+    parser.add_argument("sops", nargs="+", help="sample_simulations/*.json files")
+    parser.add_argument("--transcripts", help="transcript JSONL (only with a single SOP file)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1, help="replay every transcript this many times")
+    parser.add_argument("--out", default="headless_results.jsonl", help="per-session results (JSONL)")
+    parser.add_argument("--verbose", action="store_true", help="keep the nodes' console output")
+    parser.add_argument("--grader-mode", choices=["serial", "speculative"], help="default: GRADER_MODE")
+    args = parser.parse_args(argv)
+
+    jobs: List[Tuple[str, Dict[str, Any]]] = []
+    for sop_path in args.sops:
+        sop = load_sop(sop_path)
+        prompt_registry.precompile(sop.sop_id)
+        transcripts = load_transcripts(args.transcripts or default_transcript_path(sop_path))
+        jobs.extend((sop.sop_id, dict(t, session_id=f"{t['session_id']}#{i}"))
+                    for i in range(args.repeat) for t in transcripts)
+
+    started = time.perf_counter()
+    with contextlib.ExitStack() as quiet:
+        if not args.verbose:
+            quiet.enter_context(contextlib.redirect_stdout(quiet.enter_context(open(os.devnull, "w"))))
+        results = run_sessions(jobs, args.concurrency, grader_mode=args.grader_mode)
+    print(f"✅ {len(results)} sessions over {len(args.sops)} SOP(s)", file=sys.stderr)
+    wall_seconds = time.perf_counter() - started
+
+    with open(args.out, "w") as f:
+        for result in results:
+            f.write(json.dumps(asdict(result)) + "\n")
+    summary = summarize(results, wall_seconds)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# ingest.py
+#
+# Streams email / document chunks from JSONL into the Qdrant collection the
+# research agent reads from. Memory use is bounded by the batch size and queue
+# depth, not by the corpus size, and progress is checkpointed so an interrupted
+# run picks up where it stopped.
+#
+#   python ingest.py chunks.jsonl --collection JBAF_LAW_doc_chunks
+
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+
+from embeddings import EmbeddingEngine, get_engine
+
+load_dotenv()
+
+DEFAULT_COLLECTION = "JBAF_LAW_doc_chunks"
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+INGEST_UPLOAD_WORKERS = int(os.getenv("INGEST_UPLOAD_WORKERS", "2"))
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH", "4"))
+_ID_NAMESPACE = uuid.UUID("6f1c7a52-1d53-4d2e-9a53-5b8f3f0c2a11")
+
+
+@dataclass
+class ChunkBatch:
+    seq: int
+    end_offset: int              # byte offset just past the last line of this batch
+    ids: List[str]
+    texts: List[str]
+    payloads: List[Dict[str, Any]]
+    vectors: Optional[np.ndarray] = None
+
+
+@dataclass
+class IngestReport:
+    chunks: int = 0
+    batches: int = 0
+    skipped_lines: int = 0
+    embed_seconds: float = 0.0
+    upload_seconds: float = 0.0
+    wall_seconds: float = 0.0
+    resumed_from: int = 0
+
+    @property
+    def chunks_per_sec(self) -> float:
+        return self.chunks / self.wall_seconds if self.wall_seconds else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "chunks": self.chunks,
+            "batches": self.batches,
+            "skipped_lines": self.skipped_lines,
+            "embed_seconds": round(self.embed_seconds, 3),
+            "upload_seconds": round(self.upload_seconds, 3),
+            "wall_seconds": round(self.wall_seconds, 3),
+            "chunks_per_sec": round(self.chunks_per_sec, 1),
+            "resumed_from": self.resumed_from,
+        }
+
+
+def point_id(record: Dict[str, Any], text: str) -> str:
+    """
+    Stable Qdrant point id. Re-ingesting the same chunk overwrites it instead of
+    duplicating it, which is what makes resuming after a crash safe.
+    """
+    source_id = record.get("id") or record.get("chunk_id")
+    if source_id is None:
+        source_id = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(_ID_NAMESPACE, str(source_id)))
+
+
+def iter_chunks(path: str, start_offset: int = 0, text_field: str = "text") -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+    """
+    Yield (end_offset, record) for every line of a JSONL file, starting at a byte offset.
+    Lines without usable text yield (end_offset, None) so the caller can still advance.
+    """
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            offset += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                yield offset, None
+                continue
+            if not isinstance(record, dict) or not record.get(text_field):
+                yield offset, None
+                continue
+            yield offset, record
+
+
+def iter_batches(path: str, batch_size: int, start_offset: int = 0, text_field: str = "text",
+                 report: Optional[IngestReport] = None) -> Iterator[ChunkBatch]:
+    """
+    Batches of up to `batch_size` chunks. Lines skipped after the last full batch still end
+    up in a batch (possibly one without chunks), so the checkpoint can move past them.
+    """
+    seq = 0
+    batch_start = start_offset
+    batch = ChunkBatch(seq=seq, end_offset=start_offset, ids=[], texts=[], payloads=[])
+    for end_offset, record in iter_chunks(path, start_offset, text_field):
+        batch.end_offset = end_offset
+        if record is None:
+            if report is not None:
+                report.skipped_lines += 1
+            continue
+        text = record[text_field]
+        batch.ids.append(point_id(record, text))
+        batch.texts.append(text)
+        batch.payloads.append(record)
+        if len(batch.texts) >= batch_size:
+            yield batch
+            seq += 1
+            batch_start = end_offset
+            batch = ChunkBatch(seq=seq, end_offset=end_offset, ids=[], texts=[], payloads=[])
+    if batch.texts or batch.end_offset > batch_start:
+        yield batch
+
+
+class Checkpoint:
+    """
+    Byte offset into the source file up to which every chunk is known to be in Qdrant.
+    Uploads can finish out of order, so the offset only advances over a contiguous run of
+    completed batches.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.offset = 0
+        self._done: Dict[int, int] = {}
+        self._next_seq = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.offset = json.load(f).get("offset", 0)
+
+    def complete(self, batch: ChunkBatch) -> None:
+        with self._lock:
+            self._done[batch.seq] = batch.end_offset
+            advanced = False
+            while self._next_seq in self._done:
+                self.offset = self._done.pop(self._next_seq)
+                self._next_seq += 1
+                advanced = True
+            if advanced and self.path:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"offset": self.offset, "updated_at": time.time()}, f)
+                os.replace(tmp_path, self.path)
+
+
+def ensure_collection(qdrant: QdrantClient, collection: str, dim: int) -> None:
+    if not qdrant.collection_exists(collection):
+        qdrant.create_collection(
+            collection_name=collection,
+            vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE),
+        )
+
+
+def ingest_jsonl(path: str, qdrant: QdrantClient, collection: str = DEFAULT_COLLECTION,
+                 batch_size: int = INGEST_BATCH_SIZE, upload_workers: int = INGEST_UPLOAD_WORKERS,
+                 queue_depth: int = INGEST_QUEUE_DEPTH,
+                 checkpoint_path: Optional[str] = None, text_field: str = "text",
+                 engine: Optional[EmbeddingEngine] = None, progress_every: int = 50) -> IngestReport:
+    """
+    Embed and upsert every chunk in `path`.
+
+    The calling thread reads and embeds; `upload_workers` threads upsert. The queue between
+    them holds at most `queue_depth` batches, so a slow Qdrant throttles embedding instead
+    of letting batches pile up in memory.
+    """
+    engine = engine or get_engine()
+    checkpoint = Checkpoint(checkpoint_path)
+    report = IngestReport(resumed_from=checkpoint.offset)
+    work: "queue.Queue[Optional[ChunkBatch]]" = queue.Queue(maxsize=queue_depth)
+    errors: List[BaseException] = []
+    stats_lock = threading.Lock()
+    collection_ready = threading.Event()
+
+    def upload_worker() -> None:
+        while True:
+            batch = work.get()
+            if batch is None:
+                return
+            if errors:
+                continue    # drain the queue so the producer never blocks on a dead pipeline
+            try:
+                started = time.perf_counter()
+                qdrant.upload_collection(
+                    collection_name=collection,
+                    vectors=batch.vectors,
+                    payload=batch.payloads,
+                    ids=batch.ids,
+                    batch_size=len(batch.ids),
+                    wait=True,
+                )
+                elapsed = time.perf_counter() - started
+                checkpoint.complete(batch)
+                with stats_lock:
+                    report.upload_seconds += elapsed
+                    report.chunks += len(batch.ids)
+                    report.batches += 1
+                    if progress_every and report.batches % progress_every == 0:
+                        rate = report.chunks / (time.perf_counter() - wall_start)
+                        print(f"📦 {report.chunks} chunks ingested ({rate:.0f} chunks/sec)")
+            except BaseException as e:
+                errors.append(e)
+
+    wall_start = time.perf_counter()
+    workers = [threading.Thread(target=upload_worker, daemon=True) for _ in range(upload_workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for batch in iter_batches(path, batch_size, checkpoint.offset, text_field, report):
+            if errors:
+                break
+            if not batch.ids:
+                # only skipped lines: nothing to upload, but the checkpoint moves past them
+                checkpoint.complete(batch)
+                continue
+            started = time.perf_counter()
+            batch.vectors = engine.encode(batch.texts, use_cache=False)
+            report.embed_seconds += time.perf_counter() - started
+            if not collection_ready.is_set():
+                ensure_collection(qdrant, collection, batch.vectors.shape[1])
+                collection_ready.set()
+            batch.texts = []    # payloads still carry the text; drop the duplicate list early
+            work.put(batch)     # blocks while the uploaders are `queue_depth` batches behind
+    finally:
+        for _ in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+        report.wall_seconds = time.perf_counter() - wall_start
+
+    if errors:
+        raise RuntimeError(f"Ingestion stopped at byte offset {checkpoint.offset}") from errors[0]
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream JSONL chunks into Qdrant.")
+    parser.add_argument("path", help="JSONL file, one chunk per line with a 'text' field")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--upload-workers", type=int, default=INGEST_UPLOAD_WORKERS)
+    parser.add_argument("--queue-depth", type=int, default=INGEST_QUEUE_DEPTH)
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--checkpoint", default=None,
+                        help="checkpoint file (defaults to <path>.checkpoint.json)")
+    args = parser.parse_args()
+
+    from drivers import qdrant_driver
+
+    report = ingest_jsonl(
+        args.path,
+        qdrant_driver,
+        collection=args.collection,
+        batch_size=args.batch_size,
+        upload_workers=args.upload_workers,
+        queue_depth=args.queue_depth,
+        checkpoint_path=args.checkpoint or args.path + ".checkpoint.json",
+        text_field=args.text_field,
+    )
+    print("\n✅ Ingestion complete:")
+    print(json.dumps(report.as_dict(), indent=2))
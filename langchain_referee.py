@@ -14,37 +14,65 @@ Prereqs
 -----------------------------------------------------------
 pip install  langchain langgraph openai tiktoken pydantic
 -----------------------------------------------------------
-Set OPENAI_API_KEY in your environment before running.
-Swap `ChatOpenAI` for `Ollama` or any other LC LLM if needed.
+Set OPENAI_API_KEY in your environment before running, or pick
+another backend with GRAPH_LLM_BACKEND=ollama|fake (llm_backends.py).
 """
 
 from __future__ import annotations
 from typing import Dict, Any, Literal, Optional, List, TypedDict
 from dataclasses import dataclass
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.runnables import RunnableBinding, RunnableConfig, RunnableLambda
 from langgraph.graph import StateGraph, END
+from langgraph.config import get_stream_writer
+from langgraph.checkpoint.memory import InMemorySaver
 import openai
 import dotenv
 import os
 from dotenv import load_dotenv
 load_dotenv()
 openai.organization = os.getenv("OPENAI_ORG_ID")
+import asyncio
 import json 
+import uuid
+from collections import Counter
+from conversation import Message, drop_conversation, get_conversation, new_conversation
+from fast_grader import FastVerdict, get_fast_grader
+from llm_backends import lazy_chat_model
+from prompts import CompiledPrompt, cached_input_tokens, metrics as prompt_metrics, registry as prompt_registry
+from response_cache import get_response_cache
+from sop import get_sop, register_sop, sop_from_sample
+from structured import (GraderVerdict, RefereeVerdict, StructuredOutputError, aread_stream, grader_done, parse_text,
+                        read_stream, referee_done, structured_llm)
+from tokens import count_tokens
+from tracing import trace_node, tracer
 
 # =====================  CONFIG  ===========================
-LLM_GRADER  = ChatOpenAI(model="gpt-3.5-turbo", temperature=1)
-LLM_REFEREE = ChatOpenAI(model="gpt-3.5-turbo", temperature=1)
-LLM_coach = ChatOpenAI(model="gpt-3.5-turbo", temperature=1)
+# Models come from the GRAPH_LLM_BACKEND backend and are built on first use.
+# stream_usage: streamed replies report token usage too (incl. cached prompt tokens)
+# Verdicts are deterministic (temperature 0 by default), which also lets them be cached
+LLM_GRADER  = lazy_chat_model(temperature=float(os.getenv("GRADER_TEMPERATURE", "0")), stream_usage=True)
+LLM_REFEREE = lazy_chat_model(temperature=float(os.getenv("REFEREE_TEMPERATURE", "0")), stream_usage=True)
+LLM_coach = lazy_chat_model(temperature=1, stream_usage=True)
+LLM_SUMMARY = lazy_chat_model(temperature=0)   # rolling history summaries
 
 
 MAX_GRADER_RETRIES = 2
 
-SOP_STEPS = {
+# "serial": one grader call, then the referee. "speculative": GRADER_SAMPLES grader calls
+# at once (sampled at SPECULATIVE_TEMPERATURE), the referee starts on the leading verdict
+# while the rest are in flight, and leftover calls are cancelled once a majority agrees.
+# Sessions can override the mode with configurable["grader_mode"].
+GRADER_MODE = os.getenv("GRADER_MODE", "serial")
+GRADER_SAMPLES = int(os.getenv("GRADER_SAMPLES", "3"))
+SPECULATIVE_TEMPERATURE = float(os.getenv("SPECULATIVE_TEMPERATURE", "0.7"))
+# After the referee rejects a verdict the grader is asked again at this temperature: at 0
+# it would only repeat itself. Sampled calls bypass the response cache.
+GRADER_RETRY_TEMPERATURE = float(os.getenv("GRADER_RETRY_TEMPERATURE", "0.7"))
 
-}
+# A whole session runs as one graph invocation, one superstep per node.
+RECURSION_LIMIT = 10_000
 
 # ================  PROMPT TEMPLATES  ======================
 
@@ -53,10 +81,10 @@ You are the *Grader* LLM grading an user's reply in simulated scenario.
 Return ONLY JSON:
 
 {{
-  "role": "grader",
+  "step_passed": true | false,
   "message": "<short constructive feedback to user>",
   "current_step": {step},
-  "step_passed": true | false
+  "role": "grader"
 }}
 
 Rules:
@@ -71,6 +99,9 @@ Rules:
 """
 
 
+# Prompts are laid out static-first: instructions and SOP / rubric text (compiled once per
+# SOP step in prompts.registry), then the per-call content, so the provider can reuse the
+# cached prefix.
 GRADER_INTERACTION_PROMPT = """\
 You are the *Grader* LLM grading an user's reply in a simulated scenario for an SOP.
 ──────── FULL SOP Details ────────:
@@ -79,13 +110,59 @@ You are the *Grader* LLM grading an user's reply in a simulated scenario for an
 ──────── CURRENT SOP Step Details ────────:
 {SOP_STEP_DETAILS}
 
+──────── RULES ────────:
+1. Do not tell the user exacly what to say/do without giving them a chance to explore.  Give them a hint if they ask for it, but do not give them the exact answer immediately.
+2. After a few back and forths, you can give them the exact answer if they are still struggling.
+
+"""
+
+GRADER_HISTORY_SUFFIX = """\
 ──────── Conversation History ────────:
 Here is the conversation so far.  Please respond to the next question from the user.
 {conversation_history}
+"""
 
-──────── RULES ────────:
-1. Do not tell the user exacly what to say/do without giving them a chance to explore.  Give them a hint if they ask for it, but do not give them the exact answer immediately.
-2. After a few back and forths, you can give them the exact answer if they are still struggling.
+COACH_INTRO_PROMPT = """
+        <LLM INSTRUCTIONS>
+        This is a simulation for a training system.  
+        A user is being trained to follow a Standard Operating Procedure (SOP) for a specific task.
+
+-----------------------SOP DETAILS------------------------
+{SOP}
+----------------------------------------------------------
+
+        You are simulating the role of the coach in the SOP training simulation.  You are not a grader or referee.  
+        You only represent the coach being played out in the SOP.  Do not include any other roles or perspectives.
+        Do not mention AI, LLM, or anything like that.
+        You can provide hints to the user if they ask for it, but never give them the exact answer.  Give them a chance to explore and learn.
+        If they are really struggling, you can give them the exact answer, but only after a few back and forths.
+        You are evaulating the user's input and giving them feedback on how well they are doing.
+        You are not grading the user.  You are not a referee.  You are not a grader.  You are just a coach.
+        Do not respond as the user.  Do not respond as the grader.  Do not respond as the referee.
+        Do not mention the grader or referee.  Do not mention the user.  Do not mention the coach.
+
+        Go ahead and describe the training simulation situation to the user from what they need to know to start the simulation as the user.  What is the situation they are trying to 
+        role play?  What is the task they are trying to accomplish?  What is the goal of the simulation?
+        </LLM INSTRUCTIONS>
+        """
+
+# The conversation so far is sent as the human message, after this fixed system prompt.
+COACH_TURN_PROMPT = """
+You are a coach in an Standard Operating procedure.
+
+The conversation so far is in the next message.
+
+Respond naturally. Keep it short (1–2 sentences). Be polite but firm. Do not repeat yourself.
+Don't respond as the user or the trainee. Only respond as if you are the coach.
+
+        You are simulating the role of the coach in the SOP training simulation.  You are not a grader or referee.  
+        You only represent the coach being played out in the SOP.  Do not include any other roles or perspectives.
+        Do not mention AI, LLM, or anything like that.
+        You can provide hints to the user if they ask for it, but never give them the exact answer.  Give them a chance to explore and learn.
+        If they are really struggling, you can give them the exact answer.
+        You are evaulating the user's input and giving them feedback on how well they are doing.
+        You are not grading the user.  You are not a referee.  You are not a grader.  You are just a coach.
+        Do not mention the grader or referee.  Do not mention the user.  Do not mention the coach.
 
 """
 
@@ -133,196 +210,465 @@ Your job is to validate correctness, not critique style.
 
 ──────── Output (JSON only, NO markdown) ─────────
 {{
-  "role": "referee",
-  "current_step": {step},
-  "message": "<referee feedback to grader on how the grader did grading, not on whether the user passed>",
+  "referee_grade": "pass" | "fail",
   "must_regenerate": true | false,
-  "referee_grade": "pass" | "fail"
+  "message": "<referee feedback to grader on how the grader did grading, not on whether the user passed>",
+  "current_step": {step},
+  "role": "referee"
 }}
 Be completely deterministic (temperature 0).
 
 """
 
+# Static prompt segments, rendered once per (SOP, step, role) by prompts.registry
+
+def _grader_prompt(sop, step):
+    return PromptTemplate.from_template(GRADER_GRADING_PROMPT).format(
+        step=step, step_desc=sop.step_description(step), SOP_STEP_DETAILS=sop.step(step))
+
+
+def _grader_interaction_prompt(sop, step):
+    return PromptTemplate.from_template(GRADER_INTERACTION_PROMPT).format(
+        SOP=sop.rendered, step=step, SOP_STEP_DETAILS=sop.step(step))
+
+
+def _referee_prompt(sop, step):
+    return PromptTemplate.from_template(REFEREE_SYSTEM_PROMPT).format(
+        step=step, step_desc=sop.step_description(step), SOP_STEP_DETAILS=sop.step(step))
+
+
+prompt_registry.register("grader", _grader_prompt)
+prompt_registry.register("grader_interaction", _grader_interaction_prompt)
+prompt_registry.register("referee", _referee_prompt)
+prompt_registry.register("coach_intro", lambda sop, step: COACH_INTRO_PROMPT.format(SOP=sop.rendered), per_step=False)
+prompt_registry.register("coach", lambda sop, step: COACH_TURN_PROMPT, per_step=False)
+
 # ================  STATE MODEL  ===========================
 
 
 class StateDict(TypedDict):
+    sop_id: str                             # key into the shared SOP registry (sop.py)
     current_step: int
     grader_retries: int
     done: bool
     last_grader: Optional[Dict[str, Any]]
     last_referee: Optional[Dict[str, Any]]
-    history: List[Dict[str, Any]]
+    conversation_id: str                    # key into the conversation store (conversation.py)
+    history_len: int                        # messages of the full history committed so far
     input_message: Optional[Dict[str, str]]  # user reply
     coach_message: Optional[str]          # most recent coach reply
-    dialogue_history: List[Dict[str, str]]   # alternating coach/user turns
+    dialogue_len: int                       # alternating coach/user turns committed so far
     next_node: Optional[str]                # next node to run
+    fast_score: Optional[float]             # pre-grader similarity of the reply being graded by the LLMs
 
 # ================  NODE FUNCTIONS  ========================
 
-def coach_node(state: StateDict) -> Dict[str, Any]:
-    
-    if state.get("next_node")  and state["next_node"] != "coach":
-        # Skip this node if not the next one
-        return {}
-    
-    dialogue = state.get("dialogue_history", [])
-    if not dialogue:
-        prompt = f"""
-        <LLM INSTRUCTIONS>
-        This is a simulation for a training system.  
-        A user is being trained to follow a Standard Operating Procedure (SOP) for a specific task.
-
------------------------SOP DETAILS------------------------
-{SOP_STEPS}
-----------------------------------------------------------
+def record_prompt(role: str, prefix: CompiledPrompt, dynamic_text: str, response=None) -> None:
+    """Account one call in prompts.metrics: static prefix vs. per-call tokens, provider cache hits."""
+    prompt_metrics.record(role, prefix, count_tokens(dynamic_text), cached_input_tokens(response))
+
+
+def invoke_verdict(llm, messages, schema, done, refresh: bool = False):
+    """
+    Ask for a `schema` object (structured.py) and stop reading as soon as `done(fields)`.
+    Temperature-0 calls go through the response cache (response_cache.py); `refresh` skips
+    the lookup and overwrites the entry, e.g. to audit again on a grader retry.
+    Returns (verdict dict, chunk that reported usage or None).
+    """
+    cache = get_response_cache()
+    cacheable = cache is not None and sampling_temperature(llm) == 0
+    with tracer.span(_span_name(schema), "llm") as span:
+        if cacheable:
+            model, key_messages = _cache_key(llm, messages)
+            if not refresh:
+                cached = cache.lookup(model, key_messages)
+                _record_cache(span, cached is not None)
+                if cached is not None:
+                    return parse_text(cached, schema).model_dump(), None
+        verdict, usage = read_stream(structured_llm(llm, schema).stream(messages), schema, done)
+        if span is not None:
+            span.add_usage(usage)
+    if cacheable:
+        cache.store(model, key_messages, verdict.model_dump_json())
+    return verdict.model_dump(), usage
+
+
+async def ainvoke_verdict(llm, messages, schema, done, refresh: bool = False):
+    """Async `invoke_verdict`; cancelling the awaiting task closes the stream."""
+    cache = get_response_cache()
+    cacheable = cache is not None and sampling_temperature(llm) == 0
+    with tracer.span(_span_name(schema), "llm") as span:
+        if cacheable:
+            model, key_messages = _cache_key(llm, messages)
+            if not refresh:
+                cached = cache.lookup(model, key_messages)
+                _record_cache(span, cached is not None)
+                if cached is not None:
+                    return parse_text(cached, schema).model_dump(), None
+        verdict, usage = await aread_stream(structured_llm(llm, schema).astream(messages), schema, done)
+        if span is not None:
+            span.add_usage(usage)
+    if cacheable:
+        cache.store(model, key_messages, verdict.model_dump_json())
+    return verdict.model_dump(), usage
+
+
+def invoke_verdict_checked(llm, messages, schema, done, refresh: bool = False):
+    """`invoke_verdict`, asked once more without the cache if the reply doesn't validate."""
+    try:
+        return invoke_verdict(llm, messages, schema, done, refresh=refresh)
+    except StructuredOutputError as e:
+        print(f"⚠️  {schema.__name__} did not validate, asking again: {e}")
+        return invoke_verdict(llm, messages, schema, done, refresh=True)
+
+
+def unparsable_referee(step: int, error: Exception) -> Dict[str, Any]:
+    """A rejecting audit, so a verdict nobody could read goes down the orchestrator's retry path."""
+    return {"role": "referee", "current_step": step, "message": f"Unreadable verdict: {error}",
+            "must_regenerate": True, "referee_grade": "fail"}
+
+
+def sampling_temperature(llm) -> Optional[float]:
+    """
+    The temperature a call will sample at. A `.bind(temperature=...)` overrides the model's
+    own, but attribute lookups on the binding still reach the wrapped model, so unwrap it.
+    """
+    while isinstance(llm, RunnableBinding):
+        if "temperature" in llm.kwargs:
+            return llm.kwargs["temperature"]
+        llm = llm.bound
+    return getattr(llm, "temperature", None)
+
+
+def _span_name(schema) -> str:
+    # GraderVerdict -> llm.grader, RefereeVerdict -> llm.referee
+    return "llm." + schema.__name__.replace("Verdict", "").lower()
+
+
+def _record_cache(span, hit: bool) -> None:
+    if span is not None:
+        span.cache_hit = hit
+
+
+def _cache_key(llm, messages):
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+    return model, [(m.type, m.content) for m in messages]
+
+
+def stream_reply(llm, messages, speaker: str, prefix: Optional[CompiledPrompt] = None) -> str:
+    """
+    Stream an LLM reply as LangGraph "custom" events ({"speaker", "token"}) while it is
+    generated, and return the assembled text. Outside `simulation.stream(...,
+    stream_mode="custom")` the events are simply dropped.
+    """
+    writer = get_stream_writer()
+    parts = []
+    usage_chunk = None
+    with tracer.span(f"llm.{speaker}", "llm") as span:
+        for chunk in llm.stream(messages):
+            if chunk.content:
+                parts.append(chunk.content)
+                writer({"speaker": speaker, "token": chunk.content})
+            if getattr(chunk, "usage_metadata", None):
+                usage_chunk = chunk
+        if span is not None:
+            span.add_usage(usage_chunk)
+    writer({"speaker": speaker, "end": True})
+    if prefix is not None:
+        # the prefix opens the first message; everything after it is per-call content
+        dynamic = "".join(m.content for m in messages)[len(prefix.text):]
+        record_prompt(speaker, prefix, dynamic, usage_chunk)
+    return "".join(parts)
+
+
+def summarize_history(prompt: str) -> str:
+    """Summarizer for the coach / grader history windows (conversation.HistoryWindow)."""
+    with tracer.span("llm.summary", "llm") as span:
+        response = LLM_SUMMARY.invoke([HumanMessage(content=prompt)])
+        if span is not None:
+            span.add_usage(response)
+    return response.content
 
-        You are simulating the role of the coach in the SOP training simulation.  You are not a grader or referee.  
-        You only represent the coach being played out in the SOP.  Do not include any other roles or perspectives.
-        Do not mention AI, LLM, or anything like that.
-        You can provide hints to the user if they ask for it, but never give them the exact answer.  Give them a chance to explore and learn.
-        If they are really struggling, you can give them the exact answer, but only after a few back and forths.
-        You are evaulating the user's input and giving them feedback on how well they are doing.
-        You are not grading the user.  You are not a referee.  You are not a grader.  You are just a coach.
-        Do not respond as the user.  Do not respond as the grader.  Do not respond as the referee.
-        Do not mention the grader or referee.  Do not mention the user.  Do not mention the coach.
 
-        Go ahead and describe the training simulation situation to the user from what they need to know to start the simulation as the user.  What is the situation they are trying to 
-        role play?  What is the task they are trying to accomplish?  What is the goal of the simulation?
-        </LLM INSTRUCTIONS>
-        """
+def coach_node(state: StateDict) -> Dict[str, Any]:
+    sop = get_sop(state["sop_id"])
+    conversation = get_conversation(state["conversation_id"])
+    if not state["dialogue_len"]:
+        prefix = prompt_registry.get(sop.sop_id, None, "coach_intro")
         dialogue_text = ""
     else:
-        dialogue_text = "\n".join([f"{x['role'].capitalize()}: {x['content']}" for x in dialogue])
-        prompt = f"""
-You are a coach in an Standard Operating procedure.
+        prefix = prompt_registry.get(sop.sop_id, None, "coach")
+        window = conversation.window("coach", conversation.dialogue, summarize_history)
+        dialogue_text = window.render(state["dialogue_len"])
 
-Here is the conversation so far:
-{dialogue_text}
-
-Respond naturally. Keep it short (1–2 sentences). Be polite but firm. Do not repeat yourself.
-Don't respond as the user or the trainee. Only respond as if you are the coach.
-
-        You are simulating the role of the coach in the SOP training simulation.  You are not a grader or referee.  
-        You only represent the coach being played out in the SOP.  Do not include any other roles or perspectives.
-        Do not mention AI, LLM, or anything like that.
-        You can provide hints to the user if they ask for it, but never give them the exact answer.  Give them a chance to explore and learn.
-        If they are really struggling, you can give them the exact answer.
-        You are evaulating the user's input and giving them feedback on how well they are doing.
-        You are not grading the user.  You are not a referee.  You are not a grader.  You are just a coach.
-        Do not mention the grader or referee.  Do not mention the user.  Do not mention the coach.
-
-"""
-
-    result = LLM_coach([SystemMessage(content=prompt),HumanMessage(content=dialogue_text)])
-    grader_reply = result.content.strip()
-    print(f"\n🗣️  Coach:{grader_reply}")
+    grader_reply = stream_reply(LLM_coach, [SystemMessage(content=prefix.text),HumanMessage(content=dialogue_text)], "coach",
+                                prefix=prefix).strip()
+    message = Message("coach", grader_reply)
     return {
         "coach_message": grader_reply,
         "input_message": {"role": "coach", "content": grader_reply},
         "last_grader": None,
         "last_referee": None,
-        "history": state.get("history", []) + [{"role": "coach", "content": grader_reply}],
-        "dialogue_history": dialogue + [{"role": "coach", "content": grader_reply}],
-        "next_node": "grader"
+        "history_len": conversation.history.append(message, at=state["history_len"]),
+        "dialogue_len": conversation.dialogue.append(message, at=state["dialogue_len"]),
+        "next_node": "user"
     }
 
 
 
 # Node functions now accept the state dictionary
-def grader_node(state: StateDict) -> Dict[str, Any]:
-    """Grader grades the current coach's reply."""
-    grader_message_content = state.get("input_message", {}).get("content")
-    direct_question_to_grader = grader_message_content.startswith("Grader:")
-    if not direct_question_to_grader and state.get("next_node","") != "grader":
-        # Skip this node if not the next one
-        return {"next_node": state["next_node"]}
+def grader_messages(state: StateDict, reply: str):
+    prefix = prompt_registry.get(state["sop_id"], state["current_step"], "grader")
+    return prefix, [SystemMessage(content=prefix.text), HumanMessage(content=reply)]
+
 
-    
+def referee_messages(state: StateDict, reply: str, grader_feedback: Dict[str, Any]):
+    prefix = prompt_registry.get(state["sop_id"], state["current_step"], "referee")
+    referee_input = {
+        "grader_reply": reply,
+        "grader_feedback": grader_feedback
+    }
+    payload = json.dumps(referee_input)
+    return prefix, payload, [SystemMessage(content=prefix.text), HumanMessage(content=payload)]
+
+
+def forget_grader_verdict(state: StateDict, reply: str) -> None:
+    """Drop a cached grader verdict the referee rejected, so the next identical turn is graded afresh."""
+    cache = get_response_cache()
+    if cache is not None:
+        _, messages = grader_messages(state, reply)
+        cache.invalidate(*_cache_key(LLM_GRADER, messages))
+
+
+def log_confirmed_verdict(state: StateDict, fast_score: Optional[float], grader_json, referee_json) -> None:
+    fast_grader = get_fast_grader()
+    if fast_grader is not None and fast_score is not None and referee_json.get("referee_grade") == "pass":
+        # the referee confirmed the grader: a labelled example for calibrating the pre-grader
+        fast_grader.log_outcome(state["sop_id"], state["current_step"], fast_score, grader_json["step_passed"])
+
+
+async def speculative_grade(state: StateDict, reply: str, samples: int):
+    """
+    Sample `samples` grader verdicts concurrently and have the referee audit the leading
+    verdict (most votes so far) as soon as there is one. The first audit that confirms a
+    verdict still leading the vote settles the turn and cancels every call in flight;
+    if the referee rejects a verdict, the other one is audited once a sample produces it.
+    Returns (grader_json, referee_json).
+    """
+    prefix, messages = grader_messages(state, reply)
+    sampler = LLM_GRADER.bind(temperature=SPECULATIVE_TEMPERATURE) if samples > 1 else LLM_GRADER
+    pending = {asyncio.ensure_future(ainvoke_verdict(sampler, messages, GraderVerdict, grader_done))
+               for _ in range(samples)}
+    verdicts: Dict[bool, Dict[str, Any]] = {}       # first verdict seen for pass / fail
+    votes: Counter = Counter()
+    audits: Dict[bool, asyncio.Future] = {}
+    rejected: Dict[bool, Dict[str, Any]] = {}
+
+    async def audit(grader_json):
+        referee_prefix, payload, referee_msgs = referee_messages(state, reply, grader_json)
+        try:
+            referee_json, usage = await ainvoke_verdict(LLM_REFEREE, referee_msgs, RefereeVerdict, referee_done,
+                                                        refresh=state.get("grader_retries", 0) > 0)
+        except StructuredOutputError as e:
+            print(f"Referee audit failed: {e}")
+            return unparsable_referee(state["current_step"], e)
+        record_prompt("referee", referee_prefix, payload, usage)
+        return referee_json
+
+    def leader() -> Optional[bool]:
+        candidates = [v for v in votes if v not in rejected]
+        return max(candidates, key=lambda v: votes[v]) if candidates else None
+
+    try:
+        while True:
+            for passed, task in audits.items():
+                if not task.done() or passed in rejected:
+                    continue
+                referee_json = task.result()
+                if referee_json.get("referee_grade") != "pass":
+                    rejected[passed] = referee_json
+                elif leader() == passed:
+                    return verdicts[passed], referee_json
+            in_flight = pending | {task for task in audits.values() if not task.done()}
+            if not in_flight:
+                break
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done & pending:
+                pending.discard(task)
+                try:
+                    grader_json, usage = task.result()
+                    passed = grader_json["step_passed"]
+                except Exception as e:
+                    # one bad sample doesn't sink the vote
+                    print(f"Grader sample failed: {e}")
+                    continue
+                record_prompt("grader", prefix, reply, usage)
+                votes[passed] += 1
+                verdicts.setdefault(passed, grader_json)
+            current = leader()
+            if current is not None and current not in audits:
+                audits[current] = asyncio.ensure_future(audit(verdicts[current]))
+        if not votes:
+            raise RuntimeError("💥 Every grader sample failed.")
+        # every audited verdict was rejected: report the majority one, the orchestrator retries
+        majority = max(votes, key=lambda v: votes[v])
+        return verdicts[majority], rejected.get(majority) or next(iter(rejected.values()))
+    finally:
+        for task in (*pending, *audits.values()):
+            task.cancel()
+
+
+def grader_node(state: StateDict, config: RunnableConfig) -> Dict[str, Any]:
+    """Grader grades the current coach's reply."""
+    update, fast_score = grade_preamble(state)
+    if update is not None:
+        return update
+    reply = state["input_message"]["content"]
+    if grader_mode(config) == "speculative":
+        return asyncio.run(speculative_update(state, reply, fast_score))
+    return serial_grade(state, reply, fast_score)
+
+
+async def agrader_node(state: StateDict, config: RunnableConfig) -> Dict[str, Any]:
+    """`grader_node` for ainvoke / astream: speculative grading runs on the caller's event loop."""
+    update, fast_score = await asyncio.to_thread(grade_preamble, state)
+    if update is not None:
+        return update
+    reply = state["input_message"]["content"]
+    if grader_mode(config) == "speculative":
+        return await speculative_update(state, reply, fast_score)
+    return await asyncio.to_thread(serial_grade, state, reply, fast_score)
+
+
+def grader_mode(config: RunnableConfig) -> str:
+    return config.get("configurable", {}).get("grader_mode", GRADER_MODE)
+
+
+def grade_preamble(state: StateDict):
+    """
+    Everything before the grader LLM call. Returns (state update, None) when the turn is
+    settled without it (no message, a direct question, the embedding pre-grader), else
+    (None, pre-grader score or None).
+    """
     # Ensure input_message exists and has content
-    grader_message_content = state.get("input_message", {}).get("content")
+    grader_message_content = (state.get("input_message") or {}).get("content")
     if not grader_message_content:
-         # Handle case where there's no message to grade (shouldn't happen with driver loop)
+         # Handle case where there's no message to grade (routing should never get here)
          print("Error: Grader node received no input message.")
-         return {"last_grader": {"role": "grader", "message": "No message to grade.", "current_step": state["current_step"], "step_passed": False}}
+         return {"last_grader": {"role": "grader", "message": "No message to grade.", "current_step": state["current_step"], "step_passed": False}, "next_node": "user"}, None
+    direct_question_to_grader = grader_message_content.startswith("Grader:")
 
     #is this a direct question to the grader?  If so, it will not be graded.
     if direct_question_to_grader:
         print("Grader: This is a direct question to the grader.  It will not be graded.")
-        
-        prompt = PromptTemplate.from_template(GRADER_INTERACTION_PROMPT).format(
-            SOP=SOP_STEPS,
-            step=state["current_step"], # Access using dictionary keys
-            SOP_STEP_DETAILS=SOP_STEPS[state["current_step"]],
-            conversation_history=state["history"],
-        )
-
-        grader_response = LLM_GRADER([
-            SystemMessage(content=prompt),
+        conversation = get_conversation(state["conversation_id"])
+
+        prefix = prompt_registry.get(state["sop_id"], state["current_step"], "grader_interaction")
+        history_text = conversation.window("grader", conversation.history, summarize_history).render(state["history_len"])
+
+        grader_reply = stream_reply(LLM_GRADER, [
+            SystemMessage(content=prefix.text + GRADER_HISTORY_SUFFIX.format(conversation_history=history_text)),
             HumanMessage(content=grader_message_content)
-        ])
-        # Access .content before parsing JSON
+        ], "grader", prefix=prefix)
         last_grader = {
             "role": "grader",
-            "message": grader_response.content,
+            "message": grader_reply,
             "current_step": state["current_step"],
             "step_passed": False
         }
-        return {"last_grader": last_grader, "next_node":"user", "history": state["history"] + [last_grader]}
-
-    else:
-        print("Grader is grading the user's reply...")
+        history_len = conversation.history.append(Message("grader", grader_reply, meta=last_grader), at=state["history_len"])
+        return {"last_grader": last_grader, "next_node":"user", "history_len": history_len}, None
+
+    fast_score = None
+    fast_grader = get_fast_grader()
+    if fast_grader is not None and not state.get("grader_retries", 0):
+        with tracer.span("fast_grader", "embedding"):
+            verdict = fast_grader.grade(state["sop_id"], state["current_step"], grader_message_content)
+        if verdict is not None and verdict.decided:
+            # clear pass / clear fail on embedding similarity: no grader or referee LLM call
+            return fast_path_verdict(state, verdict), None
+        fast_score = verdict.score if verdict is not None else None
+
+    print("Grader is grading the user's reply...")
+    return None, fast_score
+
+
+async def speculative_update(state: StateDict, reply: str, fast_score: Optional[float]) -> Dict[str, Any]:
+    """Grade and audit the reply speculatively; if a backend call fails, grade it the serial way instead."""
+    try:
+        grader_json, referee_json = await speculative_grade(state, reply, GRADER_SAMPLES)
+    except Exception as e:
+        print(f"⚠️  Speculative grading failed, grading serially: {e}")
+        return await asyncio.to_thread(serial_grade, state, reply, fast_score)
+    grader_json["current_step"] = referee_json["current_step"] = state["current_step"]
+    print(f"Grader JSON: {grader_json}")
+    print(f"Referee JSON: {referee_json}")
+    log_confirmed_verdict(state, fast_score, grader_json, referee_json)
+    return {"last_grader": grader_json, "last_referee": referee_json, "fast_score": None, "next_node": "orchestrator"}
+
+
+def serial_grade(state: StateDict, reply: str, fast_score: Optional[float]) -> Dict[str, Any]:
+    """One grader call; the referee node audits it next."""
+    prefix, messages = grader_messages(state, reply)
+    # a retry means the referee rejected the last verdict: sample a new one instead of repeating it
+    retrying = state.get("grader_retries", 0) > 0
+    grader = LLM_GRADER.bind(temperature=GRADER_RETRY_TEMPERATURE) if retrying else LLM_GRADER
+    try:
+        grader_json, usage = invoke_verdict_checked(grader, messages, GraderVerdict, grader_done)
+    except StructuredOutputError as e:
+        # no readable verdict even on a second try: treat the turn as misgraded and retry it
+        print(f"⚠️  Grader verdict unreadable: {e}")
+        last_grader = {"role": "grader", "message": "Could not grade this reply.",
+                       "current_step": state["current_step"], "step_passed": False}
+        return {"last_grader": last_grader, "last_referee": unparsable_referee(state["current_step"], e),
+                "fast_score": None, "next_node": "orchestrator"}
+    record_prompt("grader", prefix, reply, usage)
+    grader_json["current_step"] = state["current_step"]
+    # Return dictionary update for the state
+    print(grader_json)
+    return {"last_grader": grader_json, "fast_score": fast_score, "next_node":"referee"}
 
-        prompt = PromptTemplate.from_template(GRADER_GRADING_PROMPT).format(
-            step=state["current_step"], # Access using dictionary keys
-            step_desc=get_sop_step_description(state["current_step"]),
-            SOP_STEP_DETAILS=SOP_STEPS[state["current_step"]]
-        )
 
-        grader_response = LLM_GRADER([
-            SystemMessage(content=prompt),
-            HumanMessage(content=grader_message_content)
-        ])
-        # Access .content before parsing JSON
-        grader_json = JsonOutputParser().parse(grader_response.content)
-        # Return dictionary update for the state
-        print(grader_json)
-        return {"last_grader": grader_json, "next_node":"referee"}
+def fast_path_verdict(state: StateDict, verdict: FastVerdict) -> Dict[str, Any]:
+    """Grader + referee outputs for a reply the embedding pre-grader decided on its own."""
+    step = state["current_step"]
+    if verdict.step_passed:
+        message = "That covers what this step asks for."
+    else:
+        message = f"Not quite. This step is about: {get_sop(state['sop_id']).step_description(step)}"
+    last_grader = {"role": "grader", "message": message, "current_step": step, "step_passed": verdict.step_passed}
+    last_referee = {"role": "referee", "current_step": step, "message": f"Fast path (similarity {verdict.score:.2f}).",
+                    "must_regenerate": False, "referee_grade": "pass"}
+    print(f"Fast grader: {last_grader}")
+    return {"last_grader": last_grader, "last_referee": last_referee, "fast_score": None, "next_node": "orchestrator"}
 
 
 def referee_node(state: StateDict) -> Dict[str, Any]:
     """Referee audits the grader judgement."""
 
-    if state.get("next_node")  and state["next_node"] != "referee":
-        # Skip this node if not the next one
-        return {"last_referee":None}
-
     # Access needed data from state dictionary
     print("Referee is grading grader's reply...")
-    grader_message_content = state.get("input_message", {}).get("content")
+    grader_message_content = (state.get("input_message") or {}).get("content")
     grader_feedback = state.get("last_grader")
 
     if not grader_message_content or not grader_feedback:
         # Handle missing data - graph shouldn't reach here if edges are correct
         print("Error: Referee node missing input message or grader feedback.")
-        return {"last_referee": {"referee_grade": "fail", "feedback": "Missing inputs.", "must_regenerate": True}}
-
-
-    system_prompt = PromptTemplate.from_template(REFEREE_SYSTEM_PROMPT).format(
-        step=state["current_step"], # Access using dictionary keys
-        step_desc=get_sop_step_description(state["current_step"]), # Access using dictionary keys
-        SOP_STEP_DETAILS=SOP_STEPS[state["current_step"]]
-    )
-    referee_input = {
-        "grader_reply": grader_message_content, # Get content from state
-        "grader_feedback": grader_feedback      # Get last_grader from state
-    }
-    referee_response = LLM_REFEREE([
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=json.dumps(referee_input))
-    ])
-    # Access .content before parsing JSON
-    referee_json = JsonOutputParser().parse(referee_response.content)
+        return {"last_referee": {"referee_grade": "fail", "message": "Missing inputs.", "must_regenerate": True}}
+
+
+    prefix, referee_payload, messages = referee_messages(state, grader_message_content, grader_feedback)
+    # on a retry the cached audit is what sent us here; ask the referee again
+    try:
+        referee_json, usage = invoke_verdict_checked(LLM_REFEREE, messages, RefereeVerdict, referee_done,
+                                                     refresh=state.get("grader_retries", 0) > 0)
+    except StructuredOutputError as e:
+        print(f"⚠️  Referee verdict unreadable: {e}")
+        return {"last_referee": unparsable_referee(state["current_step"], e)}
+    record_prompt("referee", prefix, referee_payload, usage)
+    referee_json["current_step"] = state["current_step"]
+    if referee_json.get("referee_grade") != "pass":
+        forget_grader_verdict(state, grader_message_content)
 
     # # catch inconsistency
     # if referee_json["referee_grade"] == "fail" and referee_json["must_regenerate"]:
@@ -334,31 +680,33 @@ def referee_node(state: StateDict) -> Dict[str, Any]:
     print(f"Grader JSON: {grader_feedback}")
     print(f"Referee JSON: {referee_json}")
 
+    log_confirmed_verdict(state, state.get("fast_score"), grader_feedback, referee_json)
+
     # Return dictionary update for the state
     return {"last_referee": referee_json}
 
-def user_node(state: StateDict) -> Dict[str, Any]:
-    print(f"\n📝 SOP Step {state['current_step']} — {get_sop_step_description(state['current_step'])}")
-    input_text = input("\n👨‍💼 Your reply:\n> ")
+def user_node(state: StateDict, config: RunnableConfig) -> Dict[str, Any]:
+    print(f"\n📝 SOP Step {state['current_step']} — {get_sop(state['sop_id']).step_description(state['current_step'])}")
+    # Headless runs pass configurable["reply_source"] (prompt -> reply) instead of a keyboard
+    reply_source = config.get("configurable", {}).get("reply_source", input)
+    input_text = reply_source("\n👨‍💼 Your reply:\n> ")
 
     reply = {"role": "user", "content": input_text}
     next_node = "grader"
     if input_text.lower().startswith("coach:"):
         next_node = "coach"
 
+    conversation = get_conversation(state["conversation_id"])
     return {
         "input_message": reply,
-        "history": state["history"] + [reply],
+        "history_len": conversation.history.append(Message("user", input_text), at=state["history_len"]),
         "next_node": next_node
     }
 
 def orchestrator_node(state: StateDict) -> Dict[str, Any]:
-    updates: Dict[str, Any] = {}
+    # Default: nothing was graded, so hand the turn back to the user
+    updates: Dict[str, Any] = {"next_node": "user"}
 
-    if updates.get("done",False):
-        updates["next_node"] = END
-        return updates  # ✅ always return a dict
-    #updates["next_node"] = state.get("next_node", "coach")
     referee = state.get("last_referee",None)
     grader = state.get("last_grader", None)
     input_msg = state.get("input_message", None)
@@ -385,10 +733,12 @@ def orchestrator_node(state: StateDict) -> Dict[str, Any]:
 
         if referee_agreed and grader_passed:
             # ✅ user passed the step
-            updates["dialogue_history"] = state["dialogue_history"] + [input_msg]
+            dialogue = get_conversation(state["conversation_id"]).dialogue
+            updates["dialogue_len"] = dialogue.append(Message.from_dict(input_msg), at=state["dialogue_len"])
             updates["grader_retries"] = 0
-            updates["current_step"] = min(state["current_step"] + 1, 6)
-            updates["done"] = state["current_step"] >= 6
+            total_steps = get_sop(state["sop_id"]).total_steps
+            updates["current_step"] = min(state["current_step"] + 1, total_steps)
+            updates["done"] = state["current_step"] >= total_steps
             updates["input_message"] = None
             updates["last_grader"] = None
             updates["last_referee"] = None
@@ -400,7 +750,8 @@ def orchestrator_node(state: StateDict) -> Dict[str, Any]:
             updates["grader_retries"] = 0
             updates["input_message"] = None
             updates["next_node"] = "user"
-            updates["history"] = state["history"] + [input_msg]  # Log failed attempt
+            history = get_conversation(state["conversation_id"]).history
+            updates["history_len"] = history.append(Message.from_dict(input_msg), at=state["history_len"])  # Log failed attempt
 
 
         else:
@@ -413,116 +764,124 @@ def orchestrator_node(state: StateDict) -> Dict[str, Any]:
 
     return updates
 
+def route_next(state: StateDict) -> str:
+    """Every routing decision is made by the node that ran last, via `next_node`."""
+    return state["next_node"]
+
+
 # Initialize the StateGraph
 graph = StateGraph(StateDict)
 
-# Add all nodes
-graph.add_node("coach", coach_node)
-graph.add_node("user", user_node)
-graph.add_node("grader", grader_node)
-graph.add_node("referee", referee_node)
-graph.add_node("orchestrator", orchestrator_node)
-
-# Core transition edges
+# Add all nodes, each timed as a tracing span (tracing.py)
+graph.add_node("coach", trace_node("coach", coach_node, graph="referee"))
+graph.add_node("user", trace_node("user", user_node, graph="referee"))
+# the grader has an async variant, so speculative grading under ainvoke / astream runs on the caller's loop
+graph.add_node("grader", RunnableLambda(trace_node("grader", grader_node, graph="referee"),
+                                        afunc=trace_node("grader", agrader_node, graph="referee"), name="grader"))
+graph.add_node("referee", trace_node("referee", referee_node, graph="referee"))
+graph.add_node("orchestrator", trace_node("orchestrator", orchestrator_node, graph="referee"))
+
+# Transition edges: each node runs only when the previous one routed to it
+#   coach ─▶ user ─▶ grader ─▶ referee ─▶ orchestrator ─▶ coach | user | grader | END
+#              └──▶ coach     ├──▶ user (direct question to the grader)
+#                             └──▶ orchestrator (decided by the embedding pre-grader, or
+#                                               graded and audited in speculative mode)
 graph.add_edge("coach", "user")
-graph.add_edge("user", "grader")
-graph.add_edge("grader", "referee")
+graph.add_conditional_edges("user", route_next, ["coach", "grader"])
+graph.add_conditional_edges("grader", route_next, ["referee", "user", "orchestrator"])
 graph.add_edge("referee", "orchestrator")
-
-graph.add_conditional_edges("orchestrator", {
-    "coach": lambda state: state["next_node"] == "coach",
-    "user": lambda state: state["next_node"] == "user",
-    END: lambda state: state["next_node"] == END
-})
+graph.add_conditional_edges("orchestrator", route_next, ["coach", "user", "grader", END])
 
 
 # Set the entry point — where the whole loop starts
 graph.set_entry_point("coach")
 
-# Compile the graph
-simulation = graph.compile()
+# Compile the graph once. The checkpointer keeps each session's state under its
+# thread_id, so a session paused in user_node (interrupt) resumes where it stopped.
+simulation = graph.compile(checkpointer=InMemorySaver())
+
+
+def session_config(thread_id: str, **configurable: Any) -> Dict[str, Any]:
+    return {"configurable": {"thread_id": thread_id, **configurable}, "recursion_limit": RECURSION_LIMIT}
 
 
 # ================  DRIVER LOOP  ===========================
 
-def run_simulation(sample: Dict[str, Any]) -> None:
-    # Initialize state as a dictionary matching StateDict structure
-    state: StateDict = {
+SPEAKER_LABELS = {"coach": "🗣️  Coach:", "grader": "📝 Grader: "}
+
+def new_state(sop_id: str, conversation_id: Optional[str] = None) -> StateDict:
+    # Initialize state as a dictionary matching StateDict structure. The transcript itself
+    # lives in the conversation store; drop_conversation() frees it when the session ends.
+    return {
+        "sop_id": sop_id,
+        "conversation_id": new_conversation(conversation_id),
         "current_step": 1,
         "grader_retries": 0,
         "done": False,
         "last_grader": None,
         "last_referee": None,
-        "history": [],
-        "dialogue_history": [],
+        "history_len": 0,
+        "dialogue_len": 0,
         "input_message": None,
         "coach_message": None,
+        "next_node": "coach",
+        "fast_score": None,
     }
 
-    steps_array = sample.get("steps", {})
-    for step in steps_array:
-        interaction_number = step.get("step_number")
-        SOP_STEPS[interaction_number] = step
-        print(f"Step {interaction_number}: {get_sop_step_description(interaction_number)}")
+
+def print_verdict(last_grader: Dict[str, Any], last_referee: Dict[str, Any]) -> None:
+    if last_referee["referee_grade"] == "pass":
+        # ✅ Referee agrees with Grader — show grader feedback
+        print(f"\n📝 Grader: {last_grader['message']}")
+        # Optional: also show Referee confirmation sentence
+        # print(f"✅ Referee: {last_referee['message']}")
+    else:
+        # ❌ Referee disagrees — warn trainee
+        print(f"⚠️  Referee disagreed: {last_referee['message']}")
+
+
+def run_simulation(sample: Dict[str, Any], sop_id: Optional[str] = None) -> None:
+    sop = register_sop(sop_from_sample(sample, sop_id))
+    prompt_registry.precompile(sop.sop_id)
+    state = new_state(sop.sop_id)
+
+    for interaction_number in sop.step_numbers:
+        print(f"Step {interaction_number}: {sop.step_description(interaction_number)}")
 
     print("=== Retail Return Simulation ===")
 
-    while not state["done"]:
-
-        state = simulation.invoke(state)
-
-        # # ---- Get input from the current coach (here, hardcoded as 'user') ----
-        # # This part can be extended to get input from different coachs dynamically
-        # current_step = state["current_step"]
-
-        # # ───── Display dialogue history in chat format ─────
-        # # if state.get("history"):
-        # #     print("\n💬 Conversation so far:\n")
-        # #     for turn in state["history"]:
-        # #         role = turn["role"]
-        # #         text = turn["content"]
-        # #         prefix = "🗣️ coach:" if role == "coach" else "👨‍💼 user:"
-        # #         print(f"{prefix:<13} {text}")
-            
-        
-
-        # step_desc = SOP_STEPS.get(current_step, "Unknown Step")
-        # input_text = input(
-        #     f"\n👨‍💼  user reply for step {current_step} "
-        #     f"({step_desc}):\n> "
-        # )
-
-        # # ---- Populate the input_message key in the state dictionary ----
-        # # This structure allows specifying the coach's role
-        # state["input_message"] = {"role": "user", "content": input_text}
-
-        # # ---- run a graph “tick” ----
-        # # Invoke with the state dictionary directly
-        # try:
-        #     # The state dictionary is updated in place by LangGraph
-        #     state = simulation.invoke(state)
-        # except RuntimeError as e:
-        #     print(f"\n❌ Simulation failed: {e}")
-        #     break # Exit loop on error
-
-        # ---- Show feedback based on the updated state ----
-        # Access feedback from the state dictionary
-        last_grader   = state.get("last_grader", None)
-        last_referee = state.get("last_referee", None)
-    
-        if not last_referee:
-            if last_grader:
-                print(f"\n📝 Grader: {last_grader['message']}")
-            continue
-    
-        if last_referee["referee_grade"] == "pass":
-            # ✅ Referee agrees with Grader — show grader feedback
-            print(f"\n📝 Grader: {last_grader['message']}")
-            # Optional: also show Referee confirmation sentence
-            # print(f"✅ Referee: {last_referee['message']}")
-        else:
-            # ❌ Referee disagrees — warn trainee
-            print(f"⚠️  Referee disagreed: {last_referee['message']}")
+    # The whole session is one streamed run: "custom" events carry coach / grader tokens
+    # as they are generated, "updates" events the output of each node, "values" the state.
+    config = session_config(f"cli-{uuid.uuid4().hex}")
+    streamed = set()
+    last_grader = None
+    try:
+        for mode, chunk in simulation.stream(state, config, stream_mode=["custom", "updates", "values"]):
+            if mode == "values":
+                state = chunk
+            elif mode == "custom":
+                if chunk.get("end"):
+                    print()
+                    continue
+                if chunk["speaker"] not in streamed:
+                    streamed.add(chunk["speaker"])
+                    print(f"\n{SPEAKER_LABELS.get(chunk['speaker'], chunk['speaker'])}", end="")
+                print(chunk["token"], end="", flush=True)
+            elif "grader" in chunk:
+                # a direct answer from the grader was streamed already; verdicts wait for the referee
+                last_grader = chunk["grader"]["last_grader"]
+                streamed.discard("grader")
+                if chunk["grader"].get("last_referee"):
+                    # audited inside the grader node (pre-grader or speculative mode)
+                    print_verdict(last_grader, chunk["grader"]["last_referee"])
+            elif "referee" in chunk:
+                print_verdict(last_grader, chunk["referee"]["last_referee"])
+            elif "coach" in chunk:
+                streamed.discard("coach")
+    except RuntimeError as e:
+        print(f"\n❌ Simulation failed: {e}")
+    finally:
+        simulation.checkpointer.delete_thread(config["configurable"]["thread_id"])
 
     # After the loop (either done or error)
     if state["done"]:
@@ -531,27 +890,26 @@ def run_simulation(sample: Dict[str, Any]) -> None:
 
     # ---- Show Simulation History ----
     print("\n=== Simulation History ===")
-    if not state["history"]:
+    history = get_conversation(state["conversation_id"]).history
+    if not state["history_len"]:
         print("No steps completed successfully.")
     else:
         # History records steps that successfully advanced (referee referee_grade == "pass")
         # The index of the history entry corresponds to the step number (1-based)
-        for i, entry in enumerate(state["history"]):
+        for i, entry in enumerate(history.messages(state["history_len"])):
             interaction_number = i + 1
             print(f"{interaction_number}):")
-            print(f"  Coach ({entry['role']}): \"{entry.get('content',entry.get('message',''))}\"") # Use role and content from history entry
-            if entry.get("grader_feedback"):
-                print(f"  Grader Feedback: \"{entry['grader_feedback']}\"") # Use grader feedback from history
+            print(f"  Coach ({entry.role}): \"{entry.content}\"") # Use role and content from history entry
+            if entry.meta and entry.meta.get("grader_feedback"):
+                print(f"  Grader Feedback: \"{entry.meta['grader_feedback']}\"") # Use grader feedback from history
             print("-" * 20) # Separator
 
     print("=== End Simulation History ===")
-
-def get_sop_step_description(step_number):
-    return SOP_STEPS.get(step_number, {"step_name": "Unknown step","step_number": 1,"rubric": {"description": "No description","example_message": ""  }}).get("rubric", {"description": "No description","example_message": ""  }).get("description", "No description")
+    drop_conversation(state["conversation_id"])
 
 if __name__ == "__main__":
     #load the sample file
     sample = None
     with open("sample_simulations/SOP145.json", "r") as f:
         sample = json.load(f)
-    run_simulation(sample)
\ No newline at end of file
+    run_simulation(sample, sop_id="SOP145")
@@ -1,30 +1,30 @@
 # llm.py
 
-import ollama
 import json
+import os
 import requests
 
-# fast_vectorizer.py
-from sentence_transformers import SentenceTransformer
-
-# Choose a fast, local embedding model
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+# The SentenceTransformer is loaded on first use by the shared engine, not at import
+from embeddings import get_engine
+from llm_client import get_llm_client
+from structured import parse_text
+from tokens import count_tokens, truncate_to_tokens
+from tracing import traced
 
+@traced("embedding", "embedding")
 def get_embedding(texts:str)-> list:
     """
     Get the embedding for a given text or list of texts."""
-    if isinstance(texts, str):
-        texts = [texts]
-    return model.encode(texts).tolist()
+    return get_engine().encode(texts).tolist()
 
 # def get_embedding(text: str) -> list:
 #     # Assumes Ollama model supports embedding, like 'nomic-embed-text'
 #     response = ollama.embeddings(model="nomic-embed-text", prompt=text)
 #     return response["embedding"]
 
-def summarize_chunks(chunks: list) -> str:
-    context = "\n\n".join(chunk["text"] for chunk in chunks)
-    prompt = f"""
+SUMMARY_CONTEXT_TOKENS = int(os.getenv("SUMMARY_CONTEXT_TOKENS", "6000"))
+
+SUMMARY_PROMPT = """
 You are an assistant reviewing customer service emails. The following are snippets of good responses to customers.
 
 Please extract the best 3 examples and explain why they are good.
@@ -33,13 +33,74 @@ Please extract the best 3 examples and explain why they are good.
 {context}
 --- END TEXT ---
 """
-    response = ollama.chat(model="llama3", messages=[{"role": "user", "content": prompt}])
-    return response["message"]["content"]
 
+SUMMARY_MAP_PROMPT = """
+You are an assistant reviewing customer service emails. The following are snippets of responses to customers.
+
+Copy out, word for word, the best 3 examples of good responses to customers. Do not add commentary.
+If there are fewer than 3 good examples, copy out only those.
+
+--- BEGIN TEXT ---
+{context}
+--- END TEXT ---
+"""
 
-def chat_with_llm(prompt: str) -> str:
-    response = ollama.chat(model="llama3", messages=[{"role": "user", "content": prompt}])
-    return response["message"]["content"]
+
+def _pack_by_tokens(texts: list, budget: int) -> list:
+    """Greedily group texts into "\n\n"-joined blocks of at most `budget` tokens each."""
+    groups, current, used = [], [], 0
+    for text in texts:
+        size = count_tokens(text)
+        if size > budget:
+            text, size = truncate_to_tokens(text, budget), budget
+        if current and used + size > budget:
+            groups.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(text)
+        used += size + 1
+    if current:
+        groups.append("\n\n".join(current))
+    return groups
+
+
+@traced("llm.summarize_chunks", "llm")
+def summarize_chunks(chunks: list, context_tokens: int = None) -> str:
+    """
+    Summarize retrieved chunks. If they don't fit in one prompt's `context_tokens`
+    budget, groups of chunks are condensed in parallel (map) and the condensed
+    groups are merged, level by level, until they fit into the final prompt
+    (reduce). Wall time grows with the number of levels, i.e. ~log(len(chunks)).
+    """
+    budget = context_tokens or SUMMARY_CONTEXT_TOKENS
+    texts = [chunk["text"] for chunk in chunks]
+    groups = _pack_by_tokens(texts, budget)
+    while len(groups) > 1:
+        partials = get_llm_client().map([SUMMARY_MAP_PROMPT.format(context=group) for group in groups])
+        regrouped = _pack_by_tokens(partials, budget)
+        if len(regrouped) >= len(groups):
+            # the condensed groups are no smaller; cut each one down so the tree still converges
+            share = max(budget // len(partials), 1)
+            regrouped = _pack_by_tokens([truncate_to_tokens(p, share) for p in partials], budget)
+        groups = regrouped
+    return get_llm_client().complete(SUMMARY_PROMPT.format(context=groups[0] if groups else ""))
+
+
+def chat_with_llm(prompt: str, on_token=None) -> str:
+    """Complete `prompt`. With `on_token`, pieces are passed to it as they are generated."""
+    if on_token is not None:
+        return get_llm_client().complete_streaming(prompt, on_token)
+    return get_llm_client().complete(prompt)
+
+
+def chat_structured(prompt: str, schema):
+    """Complete `prompt` with Ollama constrained to the JSON schema of a Pydantic model; returns the validated model."""
+    content = get_llm_client().complete(prompt, format=schema.model_json_schema())
+    return parse_text(content, schema)
+
+
+def chat_with_llm_many(prompts: list) -> list:
+    """Run independent prompts concurrently (bounded by LLM_MAX_CONCURRENCY); answers keep prompt order."""
+    return get_llm_client().map(prompts)
 
 def is_reply_chunk(text: str) -> bool:
     prompt = f"""
@@ -53,63 +114,64 @@ Look for signs like 'Re:' in the subject line, reply-style greetings, or referen
 
 Reply with ONLY 'yes' or 'no'.
 """
-    response = ollama.chat(model="llama3", messages=[{"role": "user", "content": prompt}])
-    return response["message"]["content"].strip().lower() == "yes"
+    return is_yes(get_llm_client().complete(prompt))
 
 
-def format_history_for_llm(history: list) -> str:
-    return "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in history])
+def is_yes(answer) -> bool:
+    """A yes/no answer: "yes", "true" or a JSON true (format=json models often answer with booleans)."""
+    if isinstance(answer, bool):
+        return answer
+    return str(answer).strip().strip(".").lower() in ("yes", "true")
 
-def get_customer_reply(history: list) -> str:
+
+def classify_reply_chunks(chunks: dict) -> dict:
+    """
+    Batched version of is_reply_chunk: one prompt for many chunks.
+    `chunks` maps chunk id -> text; returns chunk id -> bool for every id the model answered.
+    """
+    listing = "\n\n".join(f"--- CHUNK {chunk_id} ---\n{text}" for chunk_id, text in chunks.items())
     prompt = f"""
-You are the customer in this conversation. Respond realistically based on the latest message from the customer service agent.
+For each email chunk below, decide whether it is a REPLY to a customer.
 
-Here is the full conversation history:
+Look for signs like 'Re:' in the subject line, reply-style greetings, or references to prior conversations.
 
-{format_history_for_llm(history)}
+{listing}
+--------------------
 
-Respond with your next message as the customer.
+Respond in VALID JSON only, mapping every chunk id to "yes" or "no", e.g. {{"<chunk id>": "yes"}}.
 """
+    content = get_llm_client().complete(prompt, format="json")
+    try:
+        verdicts = json.loads(content)
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(verdicts, dict):
+        return {}
+    ids = {str(chunk_id): chunk_id for chunk_id in chunks}
+    return {ids[str(k)]: is_yes(v) for k, v in verdicts.items() if str(k) in ids}
+
 
-    return chat_with_llm(prompt)
+def format_history_for_llm(history) -> str:
+    """
+    Render a conversation for a prompt. Accepts a list of {"role", "content"} dicts, a
+    conversation.ConversationLog, or a token-budgeted conversation.HistoryWindow.
+    """
+    if hasattr(history, "render"):
+        return history.render()
+    return "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in history])
 
+# Static instructions first and the conversation last, so consecutive prompts share a
+# byte-identical prefix that Ollama can serve from its KV cache.
+CUSTOMER_REPLY_PROMPT = """
+You are the customer in this conversation. Respond realistically based on the latest message from the customer service agent.
+Respond with your next message as the customer.
+
+Here is the conversation history:
 
-def evaluate_customer_response(history: list) -> dict:
-    prompt = f"""
-You are a customer service trainer evaluating the trainee's performance based on SOP145.
-
-SOP145 requires:
-- Acknowledge the issue with empathy
-- Ask for order details and relevant evidence
-- Check refund eligibility
-- Set refund timeline expectations
-- Provide status updates
-- Confirm refund completion
-
-Below is the full conversation so far:
-
-{format_history_for_llm(history)}
-
-Evaluate whether the trainee has addressed ALL required items in SOP145 so far. If not, explain what is missing.
-
-Respond in VALID JSON with:
-- "step": description of the current SOP step being addressed
-- "passed": true if the current step is complete, false otherwise
-- "complete": true if all steps are complete
-- "feedback": a short explanation of what was good or what’s missing in bulleted list format (easy to digest).  Recommend specific improvements.
-- "examples": a list of examples from the conversation that demonstrate good or bad practices.
-Be specific and provide examples from the conversation to support your evaluation.
-Always provide the expected tasks as a numbered list.
-- "expected_tasks": a numbered list of tasks that should have been completed according to SOP145.
-- "actual_tasks": a numbered list of tasks that were actually completed by the trainee.
-
-It is critical your response is in JSON format. Do not include any other text or explanations outside of the JSON.
 """
 
-    content = chat_with_llm(prompt)
-    if not content:
-        return {"passed": False, "feedback": "No response from LLM."}
-    try:
-        return json.loads(content)
-    except:
-        return {"passed": False, "feedback": "Could not parse response: " + content}
+
+@traced("llm.customer", "llm")
+def get_customer_reply(history, on_token=None) -> str:
+    prompt = CUSTOMER_REPLY_PROMPT + format_history_for_llm(history)
+    return chat_with_llm(prompt, on_token=on_token)
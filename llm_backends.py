@@ -0,0 +1,397 @@
+# llm_backends.py
+#
+# Backend registry for every LLM call in the project.
+#
+#   LLM_BACKEND        backend of the llm.py helpers (customer, evaluator, summaries,
+#                      reply classification): "ollama" (default) or "fake"
+#   GRAPH_LLM_BACKEND  backend of the referee graph roles (grader, referee, coach,
+#                      history summaries): "openai" (default), "ollama" or "fake"
+#
+# The helpers get an LLMClient (get_client); the graph gets LangChain chat models
+# (chat_model / lazy_chat_model). Ollama and fake chat models are thin adapters over the
+# same LLMClient, so they share its concurrency limit, retries and keep-alive. Graph
+# models are built on first use, so importing langchain_referee needs no API key.
+#
+# "fake" answers offline and deterministically, for benchmarking the orchestration
+# itself: every call waits a (seeded, lognormal) time to first token plus a per-token
+# delay, and the reply comes from the first rule of FAKE_LLM_SCRIPT whose regex matches
+# the prompt, then from built-in rules that pass every grader / referee verdict, then
+# from the requested JSON schema, then FAKE_LLM_DEFAULT. A script file looks like:
+#
+#   {"rules": [{"match": "step 2", "response": {"step_passed": false, "message": "Ask again."}},
+#              {"match": "customer", "response": ["Sure.", "I don't know."]}],
+#    "default": "Okay."}
+#
+# A list of responses is picked from per call, with the same seed.
+
+import asyncio
+import contextvars
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import weakref
+import zlib
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+
+from llm_client import LLMClient
+from tokens import count_tokens
+
+load_dotenv()
+
+Response = Union[str, List[Any], Dict[str, Any]]
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+
+# Stand-ins for the graph's JSON roles, so a fake session runs end to end without a script
+DEFAULT_FAKE_RULES: List[Tuple[str, Response]] = [
+    (r"\*\*Referee\*\* LLM", {"referee_grade": "pass", "must_regenerate": False, "message": ""}),
+    (r"\*Grader\* LLM grading an user's reply in simulated scenario",
+     {"step_passed": True, "message": "Good, that covers this step."}),
+    (r"Reply with ONLY 'yes' or 'no'", "no"),
+]
+
+_PIECES = re.compile(r"\S+\s*|\s+")
+
+
+def example_for_schema(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Any:
+    """A minimal instance of a JSON schema: defaults where given, otherwise a plausible value."""
+    root = root or schema
+    if "$ref" in schema:
+        name = schema["$ref"].rsplit("/", 1)[-1]
+        return example_for_schema(root.get("$defs", {}).get(name, {}), root)
+    if "default" in schema:
+        return schema["default"]
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            options = [s for s in schema[key] if s.get("type") != "null"] or schema[key]
+            return example_for_schema(options[0], root)
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        properties = schema.get("properties", {})
+        return {name: example_for_schema(sub, root) for name, sub in properties.items()}
+    return {"boolean": True, "integer": 0, "number": 0.0, "string": "ok", "array": [], "null": None}.get(kind, "")
+
+
+class FakeTransport:
+    """Offline stand-in for ollama.Client: scripted replies with simulated latency."""
+
+    def __init__(self, rules: Optional[List[Tuple[str, Response]]] = None, default: str = "Okay.",
+                 latency_ms: float = 0.0, latency_sigma: float = 0.0, token_ms: float = 0.0, seed: int = 0):
+        self.rules = [(re.compile(pattern), response) for pattern, response in (rules or [])]
+        self.rules += [(re.compile(pattern), response) for pattern, response in DEFAULT_FAKE_RULES]
+        self.default = default
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.token_ms = token_ms
+        self.seed = seed
+        self._seen: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeTransport":
+        rules: List[Tuple[str, Response]] = []
+        default = os.getenv("FAKE_LLM_DEFAULT", "Okay.")
+        script = os.getenv("FAKE_LLM_SCRIPT")
+        if script:
+            with open(script) as f:
+                loaded = json.load(f)
+            rules = [(rule["match"], rule["response"]) for rule in loaded.get("rules", [])]
+            default = loaded.get("default", default)
+        return cls(
+            rules=rules,
+            default=default,
+            latency_ms=float(os.getenv("FAKE_LLM_LATENCY_MS") or 0),
+            latency_sigma=float(os.getenv("FAKE_LLM_LATENCY_SIGMA") or 0),
+            token_ms=float(os.getenv("FAKE_LLM_TOKEN_MS") or 0),
+            seed=int(os.getenv("FAKE_LLM_SEED") or 0),
+        )
+
+    def _rng(self, prompt: str) -> random.Random:
+        """Seeded by the prompt and how often it was seen, so results don't depend on thread timing."""
+        digest = zlib.crc32(prompt.encode("utf-8"))
+        with self._lock:
+            self.calls += 1
+            n = self._seen[digest] = self._seen.get(digest, -1) + 1
+        return random.Random(f"{self.seed}\x00{digest}\x00{n}")
+
+    def reply(self, prompt: str, format: Any, rng: random.Random) -> str:
+        for pattern, response in self.rules:
+            if pattern.search(prompt):
+                if isinstance(response, list):
+                    response = rng.choice(response)
+                return response if isinstance(response, str) else json.dumps(response)
+        if isinstance(format, dict):
+            return json.dumps(example_for_schema(format))
+        if format == "json":
+            return "{}"
+        return self.default
+
+    def _first_token_delay(self, rng: random.Random) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        # lognormal with median latency_ms; sigma 0 is a constant delay
+        return self.latency_ms * math.exp(self.latency_sigma * rng.gauss(0, 1)) / 1000
+
+    def chat(self, model: str, messages: List[Dict[str, str]], stream: bool = False, format: Any = None,
+             **kwargs: Any) -> Any:
+        prompt = "\n".join(m.get("content", "") for m in messages)
+        rng = self._rng(prompt)
+        text = self.reply(prompt, format, rng)
+        pieces = _PIECES.findall(text) or [""]
+        counts = {"prompt_eval_count": count_tokens(prompt), "eval_count": len(pieces)}
+        delay = self._first_token_delay(rng)
+        if not stream:
+            time.sleep(delay + self.token_ms * len(pieces) / 1000)
+            return {"model": model, "message": {"role": "assistant", "content": text}, "done": True, **counts}
+        return self._stream(model, pieces, delay, counts)
+
+    def _stream(self, model: str, pieces: List[str], delay: float, counts: Dict[str, int]) -> Iterator[Dict[str, Any]]:
+        time.sleep(delay)
+        for i, piece in enumerate(pieces):
+            if i and self.token_ms:
+                time.sleep(self.token_ms / 1000)
+            last = i == len(pieces) - 1
+            yield {"model": model, "message": {"role": "assistant", "content": piece}, "done": last,
+                   **(counts if last else {})}
+
+
+# ====================  LangChain adapter  ====================
+
+_ROLES = {"system": "system", "human": "user", "ai": "assistant", "tool": "tool"}
+
+
+def _usage(response: Any) -> Optional[Dict[str, int]]:
+    prompt_tokens = response.get("prompt_eval_count")
+    output_tokens = response.get("eval_count")
+    if prompt_tokens is None and output_tokens is None:
+        return None
+    prompt_tokens, output_tokens = prompt_tokens or 0, output_tokens or 0
+    return {"input_tokens": prompt_tokens, "output_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens}
+
+
+class ClientChatModel(BaseChatModel):
+    """A LangChain chat model over an LLMClient (Ollama or fake transport)."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    client: Any
+    model_name: str
+    temperature: Optional[float] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm-client"
+
+    def _request(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any]
+                 ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        payload = [{"role": _ROLES.get(m.type, "user"), "content": m.content if isinstance(m.content, str) else str(m.content)}
+                   for m in messages]
+        options: Dict[str, Any] = {}
+        temperature = kwargs.pop("temperature", self.temperature)
+        if temperature is not None:
+            options["temperature"] = temperature
+        if stop:
+            options["stop"] = stop
+        # OpenAI structured-output kwargs (see structured.openai_bind_kwargs) map to `format`
+        response_format = kwargs.pop("response_format", None) or {}
+        tools = kwargs.pop("tools", None)
+        kwargs.pop("tool_choice", None)
+        if response_format.get("type") == "json_schema":
+            kwargs["format"] = response_format["json_schema"]["schema"]
+        elif response_format.get("type") == "json_object":
+            kwargs["format"] = "json"
+        elif tools:
+            kwargs["format"] = tools[0]["function"]["parameters"]
+        if options:
+            kwargs["options"] = options
+        return payload, kwargs
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                  **kwargs: Any) -> ChatResult:
+        payload, kwargs = self._request(messages, stop, kwargs)
+        response = self.client.chat_response(payload, model=self.model_name, **kwargs)
+        message = AIMessage(content=response["message"]["content"], usage_metadata=_usage(response))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        payload, kwargs = self._request(messages, stop, kwargs)
+        chunks = self.client.stream_chunks(payload, model=self.model_name, **kwargs)
+        try:
+            for chunk in chunks:
+                content = chunk["message"]["content"]
+                usage = _usage(chunk) if chunk.get("done") else None
+                generation = ChatGenerationChunk(message=AIMessageChunk(content=content, usage_metadata=usage))
+                if run_manager is not None:
+                    run_manager.on_llm_new_token(content, chunk=generation)
+                yield generation
+        finally:
+            chunks.close()      # releases the client's concurrency slot when the caller stops early
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()        # keeps the caller's tracing span in the worker
+        chunks = self._stream(messages, stop, None, **kwargs)
+        try:
+            while True:
+                generation = await loop.run_in_executor(None, context.run, next, chunks, None)
+                if generation is None:
+                    return
+                if run_manager is not None:
+                    await run_manager.on_llm_new_token(generation.text, chunk=generation)
+                yield generation
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                pass            # cancelled mid-`next`: the worker thread still owns it
+
+
+# ====================  registry  ====================
+
+ClientFactory = Callable[[], LLMClient]
+ChatFactory = Callable[..., BaseChatModel]
+
+
+def _fake_client() -> LLMClient:
+    return LLMClient.from_env(
+        model=os.getenv("FAKE_LLM_MODEL", "fake"),
+        max_concurrency=int(os.getenv("FAKE_LLM_CONCURRENCY", "64")),
+        keep_alive=None,
+        transport=FakeTransport.from_env(),
+    )
+
+
+_client_factories: Dict[str, ClientFactory] = {
+    "ollama": LLMClient.from_env,
+    "fake": _fake_client,
+}
+_clients: Dict[str, LLMClient] = {}
+_clients_lock = threading.Lock()
+
+
+def _openai_chat(temperature: Optional[float] = None, stream_usage: bool = False) -> BaseChatModel:
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=OPENAI_MODEL, temperature=temperature, stream_usage=stream_usage)
+
+
+def _client_chat(backend: str) -> ChatFactory:
+    def build(temperature: Optional[float] = None, stream_usage: bool = False) -> BaseChatModel:
+        client = get_client(backend)
+        return ClientChatModel(client=client, model_name=client.model, temperature=temperature)
+    return build
+
+
+_chat_factories: Dict[str, ChatFactory] = {
+    "openai": _openai_chat,
+    "ollama": _client_chat("ollama"),
+    "fake": _client_chat("fake"),
+}
+_overrides: Dict[str, str] = {}
+_lazy_models: "weakref.WeakSet[LazyChatModel]" = weakref.WeakSet()
+
+
+def register_backend(name: str, client: Optional[ClientFactory] = None, chat: Optional[ChatFactory] = None) -> None:
+    """Add or replace a backend; `client` serves the llm.py helpers, `chat` the graph roles."""
+    if client is not None:
+        _client_factories[name] = client
+        with _clients_lock:
+            _clients.pop(name, None)
+    if chat is not None:
+        _chat_factories[name] = chat
+
+
+def client_backend() -> str:
+    return _overrides.get("client") or os.getenv("LLM_BACKEND") or "ollama"
+
+
+def chat_backend() -> str:
+    return _overrides.get("chat") or os.getenv("GRAPH_LLM_BACKEND") or "openai"
+
+
+def get_client(backend: Optional[str] = None) -> LLMClient:
+    """The process-wide LLMClient of a backend (default: LLM_BACKEND)."""
+    backend = backend or client_backend()
+    client = _clients.get(backend)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(backend)
+            if client is None:
+                if backend not in _client_factories:
+                    raise ValueError(f"Unknown LLM backend {backend!r} (have: {', '.join(sorted(_client_factories))})")
+                client = _clients[backend] = _client_factories[backend]()
+    return client
+
+
+def chat_model(temperature: Optional[float] = None, stream_usage: bool = False, backend: Optional[str] = None
+               ) -> BaseChatModel:
+    backend = backend or chat_backend()
+    if backend not in _chat_factories:
+        raise ValueError(f"Unknown chat backend {backend!r} (have: {', '.join(sorted(_chat_factories))})")
+    return _chat_factories[backend](temperature=temperature, stream_usage=stream_usage)
+
+
+class LazyChatModel:
+    """
+    Stands in for a chat model declared at import time and builds it (from the current
+    backend) on first use; attribute access and calls go to the built model.
+    """
+
+    def __init__(self, temperature: Optional[float] = None, stream_usage: bool = False):
+        self._settings = {"temperature": temperature, "stream_usage": stream_usage}
+        self._model: Optional[BaseChatModel] = None
+        self._lock = threading.Lock()
+        _lazy_models.add(self)
+
+    @property
+    def model(self) -> BaseChatModel:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = chat_model(**self._settings)
+        return self._model
+
+    def reset(self) -> None:
+        self._model = None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def __repr__(self) -> str:
+        return f"LazyChatModel({chat_backend()!r}, {self._settings})"
+
+
+def lazy_chat_model(temperature: Optional[float] = None, stream_usage: bool = False) -> LazyChatModel:
+    return LazyChatModel(temperature=temperature, stream_usage=stream_usage)
+
+
+def use_backend(name: Optional[str] = None, client: Optional[str] = None, chat: Optional[str] = None) -> None:
+    """
+    Switch backends at runtime (e.g. a benchmark selecting "fake"): `name` sets both, None
+    goes back to the environment. Lazy graph models are rebuilt on their next use.
+    """
+    for kind, value in (("client", client or name), ("chat", chat or name)):
+        if value is None:
+            _overrides.pop(kind, None)
+        else:
+            _overrides[kind] = value
+    for model in list(_lazy_models):
+        model.reset()
@@ -0,0 +1,228 @@
+# llm_client.py
+#
+# Shared, bounded-concurrency client for the local Ollama server.
+#
+# One ollama.Client (and so one pooled HTTP connection set) is reused for every call,
+# a semaphore caps in-flight requests at LLM_MAX_CONCURRENCY, each request has a
+# timeout, and transient failures are retried with jittered exponential backoff.
+# Set OLLAMA_NUM_PARALLEL on the server to at least LLM_MAX_CONCURRENCY, otherwise
+# the extra requests just queue there.
+#
+# Every request asks the server to keep the model loaded for OLLAMA_KEEP_ALIVE, so it is
+# not unloaded between turns and can reuse the KV cache of a prompt prefix it has seen.
+#
+# The transport is anything with ollama.Client's `chat` signature; llm_backends.py passes
+# an offline stand-in for benchmarks and picks the process-wide client from LLM_BACKEND.
+#
+# Each call is a tracing span (tracing.py) with its queue time (waiting for a slot),
+# retries and token counts.
+
+import asyncio
+import contextvars
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+import httpx
+import ollama
+from dotenv import load_dotenv
+
+from tracing import Span, tracer
+
+load_dotenv()
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_MODEL = "llama3"
+
+
+class LLMClient:
+    def __init__(self, model: str = DEFAULT_MODEL, host: Optional[str] = None, max_concurrency: int = 4,
+                 timeout: float = 120.0, retries: int = 2, backoff: float = 0.5, keep_alive: Optional[str] = "30m",
+                 transport: Any = None):
+        self.model = model
+        self.keep_alive = keep_alive
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._client = transport if transport is not None else ollama.Client(host=host, timeout=timeout)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._in_pool = threading.local()
+
+    @classmethod
+    def from_env(cls, **overrides: Any) -> "LLMClient":
+        settings = dict(
+            model=os.getenv("OLLAMA_MODEL", DEFAULT_MODEL),
+            host=os.getenv("OLLAMA_HOST") or None,
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+            timeout=float(os.getenv("LLM_TIMEOUT", "120")),
+            retries=int(os.getenv("LLM_RETRIES", "2")),
+            keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m") or None,
+        )
+        settings.update(overrides)
+        return cls(**settings)
+
+    # ----------------------------------------------------- single calls
+
+    def _retryable(self, error: Exception) -> bool:
+        if isinstance(error, (httpx.TransportError, ConnectionError)):
+            return True
+        if isinstance(error, ollama.ResponseError):
+            return error.status_code == 429 or error.status_code >= 500
+        return False
+
+    def _acquire(self, span: Optional[Span]) -> None:
+        waited = time.perf_counter()
+        self._slots.acquire()
+        if span is not None:
+            span.queue_ms += (time.perf_counter() - waited) * 1000
+
+    def _backoff(self, attempt: int, span: Optional[Span]) -> None:
+        if span is not None:
+            span.retries += 1
+        # full jitter keeps a burst of failed calls from retrying in lockstep
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def _call(self, fn: Callable[[], T], span: Optional[Span] = None) -> T:
+        attempt = 0
+        while True:
+            try:
+                self._acquire(span)
+                try:
+                    return fn()
+                finally:
+                    self._slots.release()
+            except Exception as e:
+                if attempt >= self.retries or not self._retryable(e):
+                    raise
+                self._backoff(attempt, span)
+                attempt += 1
+
+    def chat_response(self, messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs: Any) -> Any:
+        """Blocking chat call returning the whole response (content plus token counts)."""
+        if self.keep_alive is not None:
+            kwargs.setdefault("keep_alive", self.keep_alive)
+        model = model or self.model
+        with tracer.span("llm_client.chat", "llm", model=model) as span:
+            response = self._call(lambda: self._client.chat(model=model, messages=messages, **kwargs), span)
+            if span is not None:
+                span.add_tokens(response.get("prompt_eval_count"), response.get("eval_count"))
+        return response
+
+    def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs: Any) -> str:
+        """Blocking chat call; extra kwargs (format, options, keep_alive) go to ollama.chat."""
+        return self.chat_response(messages, model=model, **kwargs)["message"]["content"]
+
+    def complete(self, prompt: str, **kwargs: Any) -> str:
+        return self.chat([{"role": "user", "content": prompt}], **kwargs)
+
+    def stream_chunks(self, messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs: Any) -> Iterator[Any]:
+        """
+        Yield response chunks as the server generates them. The concurrency slot is held until
+        the stream is exhausted or closed; only opening the stream is retried, since a retry
+        after tokens have been yielded would repeat them.
+        """
+        if self.keep_alive is not None:
+            kwargs.setdefault("keep_alive", self.keep_alive)
+        model = model or self.model
+        # not made current: a generator's context is its consumer's
+        span = tracer.start("llm_client.stream", "llm", model=model)
+        error: Optional[BaseException] = None
+        self._acquire(span)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    chunks = iter(self._client.chat(model=model, messages=messages, stream=True, **kwargs))
+                    first = next(chunks, None)
+                    break
+                except Exception as e:
+                    if attempt >= self.retries or not self._retryable(e):
+                        raise
+                    self._backoff(attempt, span)
+                    attempt += 1
+            if first is None:
+                return
+            for chunk in itertools.chain([first], chunks):
+                if span is not None and chunk.get("done"):
+                    span.add_tokens(chunk.get("prompt_eval_count"), chunk.get("eval_count"))
+                yield chunk
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._slots.release()
+            tracer.end(span, error)
+
+    def stream(self, messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs: Any) -> Iterator[str]:
+        """Yield content pieces as the server generates them."""
+        for chunk in self.stream_chunks(messages, model=model, **kwargs):
+            yield chunk["message"]["content"]
+
+    def complete_streaming(self, prompt: str, on_token: Callable[[str], None], **kwargs: Any) -> str:
+        """Stream a completion into `on_token` and return the assembled text."""
+        parts = []
+        for piece in self.stream([{"role": "user", "content": prompt}], **kwargs):
+            if piece:
+                parts.append(piece)
+                on_token(piece)
+        return "".join(parts)
+
+    # ----------------------------------------------------- fan-out
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_concurrency,
+                        thread_name_prefix="llm",
+                        initializer=lambda: setattr(self._in_pool, "active", True),
+                    )
+        return self._executor
+
+    def gather(self, fn: Callable[[T], R], items: Iterable[T]) -> List[R]:
+        """
+        Run fn over items on the client's pool; results come back in input order.
+        Called from inside the pool (a fanned-out function fanning out again) it runs
+        inline instead, so nested fan-out can't deadlock the pool.
+        """
+        items = list(items)
+        if len(items) <= 1 or getattr(self._in_pool, "active", False):
+            return [fn(item) for item in items]
+        # each item runs in a copy of the caller's context, so its spans keep their parent
+        contexts = [contextvars.copy_context() for _ in items]
+        return list(self.executor.map(lambda context, item: context.run(fn, item), contexts, items))
+
+    def map(self, prompts: Iterable[str], **kwargs: Any) -> List[str]:
+        """Complete many prompts concurrently, bounded by max_concurrency."""
+        return self.gather(lambda prompt: self.complete(prompt, **kwargs), prompts)
+
+    async def acomplete(self, prompt: str, **kwargs: Any) -> str:
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: context.run(self.complete, prompt, **kwargs))
+
+    async def amap(self, prompts: Iterable[str], **kwargs: Any) -> List[str]:
+        return list(await asyncio.gather(*(self.acomplete(prompt, **kwargs) for prompt in prompts)))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def get_llm_client() -> LLMClient:
+    """Process-wide client, so every helper shares one connection pool and one concurrency limit."""
+    from llm_backends import get_client
+    return get_client()
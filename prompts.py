@@ -0,0 +1,128 @@
+# prompts.py
+#
+# Precompiled prompt segments for the referee graph.
+#
+# The static part of every prompt (instructions plus the SOP / rubric text) only depends
+# on the SOP, the step and the role, so it is rendered once per (sop_id, step, role) and
+# reused. Callers put it first and append the per-call content (conversation, trainee
+# reply) last, which keeps the leading tokens byte-identical between calls: that is what
+# OpenAI's automatic prompt caching and Ollama's KV-cache reuse need in order to hit.
+#
+# PromptMetrics tracks, per role, how much of each prompt was the static prefix and how
+# many input tokens the provider reported as served from its cache.
+
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sop import SOPDefinition, get_sop
+from tokens import count_tokens
+
+PromptKey = Tuple[str, Optional[int], str]          # (sop_id, step or None, role)
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    key: PromptKey
+    text: str
+    tokens: int
+
+
+class PromptRegistry:
+    """
+    Role builders render the static segment for an SOP step; compiled segments are kept
+    until the SOP under that id is replaced in the SOP registry.
+    """
+
+    def __init__(self):
+        self._builders: Dict[str, Callable[[SOPDefinition, Optional[int]], str]] = {}
+        self._per_step: Dict[str, bool] = {}
+        self._compiled: Dict[PromptKey, Tuple[SOPDefinition, CompiledPrompt]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, role: str, builder: Callable[[SOPDefinition, Optional[int]], str], per_step: bool = True) -> None:
+        """`per_step=False` for segments that only depend on the SOP (looked up with step None)."""
+        with self._lock:
+            self._builders[role] = builder
+            self._per_step[role] = per_step
+            for key in [k for k in self._compiled if k[2] == role]:
+                del self._compiled[key]
+
+    def get(self, sop_id: str, step: Optional[int], role: str) -> CompiledPrompt:
+        key = (sop_id, step, role)
+        sop = get_sop(sop_id)
+        entry = self._compiled.get(key)
+        if entry is not None and entry[0] is sop:
+            self.hits += 1
+            return entry[1]
+        text = self._builders[role](sop, step)
+        compiled = CompiledPrompt(key=key, text=text, tokens=count_tokens(text))
+        with self._lock:
+            self._compiled[key] = (sop, compiled)
+            self.misses += 1
+        return compiled
+
+    def precompile(self, sop_id: str) -> int:
+        """Render every registered role for every step of an SOP up front."""
+        sop = get_sop(sop_id)
+        compiled = 0
+        for role, per_step in list(self._per_step.items()):
+            for step in (sop.step_numbers if per_step else [None]):
+                self.get(sop_id, step, role)
+                compiled += 1
+        return compiled
+
+    def __len__(self) -> int:
+        return len(self._compiled)
+
+
+class PromptMetrics:
+    """Per-role prompt token accounting: static prefix share and provider cache hits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._roles: Dict[str, Dict[str, int]] = {}
+
+    def record(self, role: str, prefix: CompiledPrompt, dynamic_tokens: int, cached_tokens: Optional[int] = None) -> None:
+        with self._lock:
+            stats = self._roles.setdefault(role, {"calls": 0, "prompt_tokens": 0, "prefix_tokens": 0,
+                                                  "reported_calls": 0, "reported_prompt_tokens": 0,
+                                                  "cached_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prefix.tokens + dynamic_tokens
+            stats["prefix_tokens"] += prefix.tokens
+            if cached_tokens is not None:
+                stats["reported_calls"] += 1
+                stats["reported_prompt_tokens"] += prefix.tokens + dynamic_tokens
+                stats["cached_tokens"] += cached_tokens
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            out = {}
+            for role, stats in sorted(self._roles.items()):
+                out[role] = {
+                    **stats,
+                    # share of prompt tokens that were a reusable static prefix
+                    "cached_prefix_ratio": round(stats["prefix_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0,
+                    # share the provider actually served from its cache (calls that reported usage)
+                    "provider_cache_ratio": round(stats["cached_tokens"] / stats["reported_prompt_tokens"], 4) if stats["reported_prompt_tokens"] else None,
+                }
+            return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._roles.clear()
+
+
+def cached_input_tokens(message: Any) -> Optional[int]:
+    """Cached prompt tokens reported on a LangChain AIMessage(Chunk), if the provider sent usage."""
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return None
+    return (usage.get("input_token_details") or {}).get("cache_read", 0)
+
+
+registry = PromptRegistry()
+metrics = PromptMetrics()
@@ -0,0 +1,180 @@
+# reply_filter.py
+#
+# Decides which retrieved email chunks are replies to a customer, cheapest check first:
+#
+#   0. graph          - a "reply_to" set by ResearchTools.expand_with_graph
+#   1. heuristics     - "Re:" subject, "following up", "as requested", ...
+#   2. embeddings     - similarity to reply / non-reply exemplars, reusing the shared engine
+#   3. batched LLM    - only the chunks both earlier tiers were unsure about, many per prompt
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from embeddings import get_engine
+from llm_client import get_llm_client
+import llm
+
+REPLY_SUBJECT = re.compile(r"^\s*(subject:\s*)?(re|aw|sv)\s*(\[\d+\])?\s*:", re.IGNORECASE | re.MULTILINE)
+REPLY_PHRASES = re.compile(
+    r"following up|as requested|regarding your (inquiry|request|email|message|question)"
+    r"|in response to your|thank(s| you) for (your (email|message|reply|patience)|reaching out|getting back)"
+    r"|per your (request|email)|as we discussed|as discussed|wrote:\s*$|^\s*>",
+    re.IGNORECASE | re.MULTILINE,
+)
+NON_REPLY_SUBJECT = re.compile(r"^\s*(subject:\s*)?(fwd?|fw)\s*:", re.IGNORECASE | re.MULTILINE)
+
+REPLY_EXEMPLARS = [
+    "Re: your refund request. Thank you for reaching out, following up on your message below.",
+    "As requested, I've attached the documents regarding your inquiry from last week.",
+    "Thanks for getting back to me. Regarding your question about the invoice, here is the update.",
+]
+NON_REPLY_EXEMPLARS = [
+    "Our office will be closed on Monday for the holiday. Please plan accordingly.",
+    "Newsletter: upcoming events, firm announcements and new practice areas.",
+    "Meeting agenda for the quarterly partners review, attached for internal circulation.",
+]
+
+BATCH_SIZE = 20
+EMBEDDING_MARGIN = 0.15    # |sim(reply) - sim(non reply)| needed to decide without the LLM
+
+
+@dataclass
+class ReplyFilterStats:
+    chunks: int = 0
+    by_graph: int = 0
+    by_heuristic: int = 0
+    by_embedding: int = 0
+    by_llm: int = 0
+    llm_calls: int = 0
+    fallback_calls: int = 0
+
+    @property
+    def llm_calls_per_chunk(self) -> float:
+        return (self.llm_calls + self.fallback_calls) / self.chunks if self.chunks else 0.0
+
+
+@dataclass
+class ReplyClassifier:
+    batch_size: int = BATCH_SIZE
+    embedding_margin: float = EMBEDDING_MARGIN
+    use_embeddings: bool = True
+    stats: ReplyFilterStats = field(default_factory=ReplyFilterStats)
+    _prototypes: Optional[np.ndarray] = field(default=None, init=False, repr=False)
+
+    def heuristic(self, text: str) -> Optional[bool]:
+        if REPLY_SUBJECT.search(text) or REPLY_PHRASES.search(text):
+            return True
+        if NON_REPLY_SUBJECT.search(text):
+            return False
+        return None
+
+    def _prototype_matrix(self) -> np.ndarray:
+        # (2, dim): mean reply exemplar, mean non-reply exemplar, unit length
+        if self._prototypes is None:
+            engine = get_engine()
+            prototypes = np.stack([
+                engine.encode(REPLY_EXEMPLARS).mean(axis=0),
+                engine.encode(NON_REPLY_EXEMPLARS).mean(axis=0),
+            ])
+            self._prototypes = prototypes / np.linalg.norm(prototypes, axis=1, keepdims=True)
+        return self._prototypes
+
+    def embedding_verdicts(self, texts: List[str]) -> List[Optional[bool]]:
+        vectors = get_engine().encode(texts)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        sims = vectors @ self._prototype_matrix().T
+        margin = sims[:, 0] - sims[:, 1]
+        return [True if m >= self.embedding_margin else False if m <= -self.embedding_margin else None
+                for m in margin]
+
+    def verdicts(self, chunks: List[Dict[str, Any]]) -> List[bool]:
+        """
+        Whether each chunk is a reply, in order. Chunks are tracked by position, so chunks
+        without an id (or sharing one) never stand in for each other.
+        """
+        texts = [chunk.get("text", "") for chunk in chunks]
+        self.stats.chunks += len(texts)
+        verdicts: Dict[int, bool] = {}
+        # the graph only ever confirms a reply: a missing REPLY_TO edge may just be missing data
+        for i, chunk in enumerate(chunks):
+            if chunk.get("reply_to") is not None:
+                verdicts[i] = True
+                self.stats.by_graph += 1
+
+        pending = []
+        for i, text in enumerate(texts):
+            if i in verdicts:
+                continue
+            verdict = self.heuristic(text)
+            if verdict is None:
+                pending.append(i)
+            else:
+                verdicts[i] = verdict
+                self.stats.by_heuristic += 1
+
+        if pending and self.use_embeddings:
+            undecided = []
+            for i, verdict in zip(pending, self.embedding_verdicts([texts[i] for i in pending])):
+                if verdict is None:
+                    undecided.append(i)
+                else:
+                    verdicts[i] = verdict
+                    self.stats.by_embedding += 1
+            pending = undecided
+
+        skipped = self._ask_llm({i: texts[i] for i in pending}, verdicts) if pending else []
+        if skipped:
+            # the model left chunks out (or answered with invalid JSON): ask once more with just those
+            skipped = self._ask_llm({i: texts[i] for i in skipped}, verdicts)
+        if skipped:
+            # still missing: one prompt per chunk, all at once
+            verdicts.update(zip(skipped, get_llm_client().gather(llm.is_reply_chunk, [texts[i] for i in skipped])))
+            self.stats.fallback_calls += len(skipped)
+        return [verdicts.get(i, False) for i in range(len(chunks))]
+
+    def _ask_llm(self, texts: Dict[int, str], verdicts: Dict[int, bool]) -> List[int]:
+        """Classify `texts` (position -> text) in batched prompts into `verdicts`; returns the positions left unanswered."""
+        positions = list(texts)
+        # the prompt labels chunks by position, the one key no two chunks share
+        batches = [{i: texts[i] for i in positions[start:start + self.batch_size]}
+                   for start in range(0, len(positions), self.batch_size)]
+        # batches are independent prompts, so they go to the model server concurrently
+        answers = get_llm_client().gather(llm.classify_reply_chunks, batches)
+        self.stats.llm_calls += len(batches)
+        skipped = []
+        for batch, answered in zip(batches, answers):
+            for i in batch:
+                if i in answered:
+                    verdicts[i] = answered[i]
+                    self.stats.by_llm += 1
+                else:
+                    skipped.append(i)
+        return skipped
+
+    def classify(self, chunks: List[Dict[str, Any]]) -> Dict[Any, bool]:
+        """Chunk id -> is reply, for the chunks that have an "id" / "chunk_id" payload field."""
+        result = {}
+        for chunk, verdict in zip(chunks, self.verdicts(chunks)):
+            cid = chunk_id(chunk)
+            if cid is not None:
+                result[cid] = verdict
+        return result
+
+    def filter(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [chunk for chunk, verdict in zip(chunks, self.verdicts(chunks)) if verdict]
+
+
+def chunk_id(chunk: Dict[str, Any]) -> Any:
+    """The chunk's own "id" / "chunk_id" payload field, or None."""
+    for key in ("id", "chunk_id"):
+        if chunk.get(key) is not None:
+            return chunk[key]
+    return None
+
+
+def filter_reply_chunks(chunks: List[Dict[str, Any]], classifier: Optional[ReplyClassifier] = None) -> List[Dict[str, Any]]:
+    """Keep only the chunks that are replies to a customer."""
+    return (classifier or ReplyClassifier()).filter(chunks)
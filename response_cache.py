@@ -0,0 +1,281 @@
+# response_cache.py
+#
+# Cache for deterministic (temperature 0) LLM verdicts, e.g. the grader and referee.
+#
+# Tiers, checked in order:
+#   1. exact: sha256 of the model plus the whitespace-normalized messages, served from an
+#      in-process LRU in front of a SQLite file shared across runs
+#   2. similar (optional, RESPONSE_CACHE_SIMILARITY): same model and same leading messages
+#      (system prompt = SOP step + role), and a final message whose embedding is within
+#      the cosine threshold of a cached one
+#
+# Entries expire after RESPONSE_CACHE_TTL seconds; beyond RESPONSE_CACHE_SIZE entries the
+# least recently used ones are dropped. In process, a similarity row lives exactly as long
+# as its key's entry in the exact LRU, so RESPONSE_CACHE_MEMORY_SIZE bounds both.
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+Messages = Sequence[Tuple[str, str]]          # (role, content)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def response_key(model: str, messages: Messages) -> str:
+    return _digest(model, *(f"{role}\x01{normalize(content)}" for role, content in messages))
+
+
+def context_key(model: str, messages: Messages) -> str:
+    """Everything but the final message: the scope within which similar inputs may share a verdict."""
+    return response_key(model, messages[:-1])
+
+
+class SQLiteResponseStore:
+    """Responses (and, for the similarity tier, query embeddings) in one local SQLite file."""
+
+    def __init__(self, path: str, capacity: int):
+        self.capacity = capacity
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, context TEXT NOT NULL, value TEXT NOT NULL,"
+            " created REAL NOT NULL, used REAL NOT NULL, embedding BLOB)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses(used)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_context ON responses(context)")
+        self._writes = 0
+
+    def get(self, key: str, min_created: float) -> Optional[Tuple[float, str]]:
+        """(created, value) of a live entry."""
+        row = self._db.execute("SELECT created, value FROM responses WHERE key = ? AND created >= ?", (key, min_created)).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0], row[1]
+
+    def put(self, key: str, context: str, value: str, embedding: Optional[np.ndarray]) -> int:
+        """Insert or replace; returns how many entries were evicted to stay within capacity."""
+        now = time.time()
+        blob = None if embedding is None else np.asarray(embedding, dtype=np.float32).tobytes()
+        self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, context, value, now, now, blob))
+        self._writes += 1
+        if self._writes % 100:
+            return 0
+        # trim in batches rather than on every write
+        over = len(self) - self.capacity
+        if over <= 0:
+            return 0
+        self._db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used LIMIT ?)", (over,))
+        return over
+
+    def delete(self, key: str) -> None:
+        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def embeddings(self, context: str, min_created: float, limit: int) -> List[Tuple[str, float, str, np.ndarray]]:
+        """(key, created, value, embedding) of the `limit` most recently used live entries in `context`."""
+        rows = self._db.execute(
+            "SELECT key, created, value, embedding FROM responses"
+            " WHERE context = ? AND created >= ? AND embedding IS NOT NULL ORDER BY used DESC LIMIT ?",
+            (context, min_created, limit),
+        ).fetchall()
+        return [(key, created, value, np.frombuffer(blob, dtype=np.float32)) for key, created, value, blob in rows]
+
+    def purge_expired(self, min_created: float) -> int:
+        return self._db.execute("DELETE FROM responses WHERE created < ?", (min_created,)).rowcount
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    Exact-match LRU (+ optional SQLite store) with an optional embedding-similarity tier.
+    Only use it for calls whose output is a function of the input, i.e. temperature 0.
+    """
+
+    def __init__(self, path: Optional[str] = None, capacity: int = 50_000, memory_capacity: int = 2048,
+                 ttl: float = 7 * 86400, similarity: Optional[float] = None,
+                 embed: Optional[Callable[[List[str]], list]] = None):
+        self.ttl = ttl
+        self.memory_capacity = memory_capacity
+        self.similarity = similarity
+        self._embed = embed
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()    # key -> (created, value)
+        self._vectors: Dict[str, Tuple[List[str], Optional[np.ndarray]]] = {}  # context -> (keys, unit rows)
+        self._vector_context: Dict[str, str] = {}                               # key -> its context in _vectors
+        self._disk = SQLiteResponseStore(path, capacity) if path else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        similarity = os.getenv("RESPONSE_CACHE_SIMILARITY", "")
+        return cls(
+            path=os.getenv("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3") or None,
+            capacity=int(os.getenv("RESPONSE_CACHE_SIZE", "50000")),
+            memory_capacity=int(os.getenv("RESPONSE_CACHE_MEMORY_SIZE", "2048")),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 86400))),
+            similarity=float(similarity) if similarity else None,
+        )
+
+    def _embedding(self, text: str) -> np.ndarray:
+        if self._embed is None:
+            from llm import get_embedding
+            self._embed = get_embedding
+        vector = np.asarray(self._embed([normalize(text)])[0], dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _remember(self, key: str, created: float, value: str) -> None:
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_capacity:
+            evicted, _ = self._memory.popitem(last=False)
+            self._drop_vector(evicted)
+
+    def _forget(self, key: str) -> None:
+        self._memory.pop(key, None)
+        self._drop_vector(key)
+
+    def _drop_vector(self, key: str) -> None:
+        context = self._vector_context.pop(key, None)
+        if context is None:
+            return
+        keys, matrix = self._vectors[context]
+        keep = [i for i, k in enumerate(keys) if k != key]
+        if keep:
+            self._vectors[context] = ([keys[i] for i in keep], matrix[keep])
+        else:
+            del self._vectors[context]
+
+    def _exact(self, key: str, min_created: float) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] >= min_created:
+                self._memory.move_to_end(key)
+                return entry[1]
+            self._forget(key)
+        if self._disk is not None:
+            entry = self._disk.get(key, min_created)
+            if entry is not None:
+                self.disk_hits += 1
+                self._remember(key, *entry)
+                return entry[1]
+        return None
+
+    def _context_vectors(self, context: str, min_created: float) -> Tuple[List[str], Optional[np.ndarray]]:
+        if context not in self._vectors and self._disk is not None:
+            rows = self._disk.embeddings(context, min_created, self.memory_capacity)
+            if rows:
+                self._vectors[context] = ([key for key, *_ in rows], np.stack([row[3] for row in rows]))
+                for key, created, value, _ in rows:
+                    self._vector_context[key] = context
+                # least recently used first, so the LRU keeps the same order as the store
+                for key, created, value, _ in reversed(rows):
+                    self._remember(key, created, value)
+        return self._vectors.get(context, ([], None))
+
+    def lookup(self, model: str, messages: Messages) -> Optional[str]:
+        key = response_key(model, messages)
+        min_created = time.time() - self.ttl
+        with self._lock:
+            value = self._exact(key, min_created)
+            if value is not None:
+                self.hits += 1
+                return value
+            if self.similarity is None:
+                self.misses += 1
+                return None
+            keys, matrix = self._context_vectors(context_key(model, messages), min_created)
+        if matrix is not None:
+            scores = matrix @ self._embedding(messages[-1][1])
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity:
+                with self._lock:
+                    value = self._exact(keys[best], min_created)
+                    if value is not None:
+                        self.hits += 1
+                        self.similar_hits += 1
+                        return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, model: str, messages: Messages, value: str) -> None:
+        key = response_key(model, messages)
+        context = context_key(model, messages)
+        vector = self._embedding(messages[-1][1]) if self.similarity is not None else None
+        with self._lock:
+            if vector is not None:
+                keys, matrix = self._context_vectors(context, time.time() - self.ttl)
+                if key not in keys:
+                    matrix = vector[None, :] if matrix is None else np.vstack([matrix, vector])
+                    self._vectors[context] = (keys + [key], matrix)
+                    self._vector_context[key] = context
+            self._remember(key, time.time(), value)
+            if self._disk is not None:
+                self.evictions += self._disk.put(key, context, value, vector)
+
+    def invalidate(self, model: str, messages: Messages) -> None:
+        """Drop the entry for these messages, e.g. a verdict the referee rejected."""
+        key = response_key(model, messages)
+        with self._lock:
+            self._forget(key)
+            if self._disk is not None:
+                self._disk.delete(key)
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            self._vectors.clear()
+            self._vector_context.clear()
+            return self._disk.purge_expired(time.time() - self.ttl) if self._disk is not None else 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk) if self._disk is not None else 0,
+        }
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-wide response cache, or None when RESPONSE_CACHE=false."""
+    global _cache
+    if os.getenv("RESPONSE_CACHE", "true").strip().lower() in ("0", "false", "no", "off"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache.from_env()
+    return _cache
@@ -0,0 +1,182 @@
+# session_server.py
+#
+# Runs many trainee sessions side by side in one process. Every session trains on a
+# compiled SOP from the shared registry (sop.py) and keeps its own StateDict in the
+# graph checkpointer under its session id. The compiled graph (langchain_referee.simulation)
+# and the LLM clients are shared by all sessions.
+#
+# While a session waits for its trainee, user_node is parked with LangGraph's
+# interrupt(): no thread is held, the state just sits in the checkpointer until
+# submit_reply() resumes it.
+#
+# Sessions live in process memory and don't survive a restart: the checkpointed state only
+# refers to the session's conversation log (conversation.py), which is kept in-process.
+# That is why only in-memory checkpointers are accepted.
+#
+#   python session_server.py sample_simulations/SOP145.json     # console demo
+
+import asyncio
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.types import Command, interrupt
+
+import langchain_referee as referee
+from conversation import drop_conversation
+from prompts import registry as prompt_registry
+from sop import get_sop, load_sop
+
+
+def _await_reply(prompt: str) -> str:
+    # reply_source for user_node: pause the graph until submit_reply() resumes it
+    return interrupt({"prompt": prompt})
+
+
+@dataclass
+class Session:
+    session_id: str
+    sop_id: str
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    feedback: Dict[str, Any] = field(default_factory=dict)
+
+
+class SessionManager:
+    """
+    Async facade over the referee graph: start_session / submit_reply / get_feedback.
+    Turns of different sessions run concurrently (up to `max_concurrent_turns`);
+    turns of the same session are serialized.
+    """
+
+    def __init__(self, checkpointer=None, max_concurrent_turns: int = 256):
+        if checkpointer is not None and not isinstance(checkpointer, InMemorySaver):
+            # a restored checkpoint would point at a conversation log this process never had
+            raise ValueError(f"{type(checkpointer).__name__} is not supported: conversation logs are kept "
+                             "in process memory, so sessions can't be restored after a restart")
+        # a checkpointer of its own needs its own compiled copy of the graph
+        self.graph = referee.graph.compile(checkpointer=checkpointer) if checkpointer else referee.simulation
+        self.checkpointer = self.graph.checkpointer
+        self._sessions: Dict[str, Session] = {}
+        self._turn_slots = asyncio.Semaphore(max_concurrent_turns)
+        self.max_concurrent_turns = max_concurrent_turns
+
+    def install_executor(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        """
+        The graph's nodes are synchronous and LangGraph runs them on the loop's default
+        executor, whose stock size (cpu + 4) would cap concurrent turns well below what the
+        LLM backends can take. Size it to the turn limit.
+        """
+        loop = loop or asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_concurrent_turns, thread_name_prefix="turn"))
+
+    @staticmethod
+    def load_sop(path: str, sop_id: Optional[str] = None) -> str:
+        sop = load_sop(path, sop_id)
+        prompt_registry.precompile(sop.sop_id)
+        return sop.sop_id
+
+    def _config(self, session: Session) -> Dict[str, Any]:
+        return referee.session_config(session.session_id, reply_source=_await_reply)
+
+    def _session(self, session_id: str) -> Session:
+        try:
+            return self._sessions[session_id]
+        except KeyError:
+            raise KeyError(f"Unknown session {session_id!r}") from None
+
+    async def _run_turn(self, session: Session, graph_input: Any) -> Dict[str, Any]:
+        """
+        Advance the session until it needs the trainee again (or finishes), collecting what
+        the coach, grader and referee said along the way.
+        """
+        feedback: Dict[str, Any] = {"session_id": session.session_id, "grader": None, "referee": None,
+                                    "coach_message": None, "error": None}
+        config = self._config(session)
+        state: Dict[str, Any] = {}
+        waiting = False
+        async with self._turn_slots:
+            try:
+                # runs exactly the nodes this turn needs, up to the next interrupt in user_node or END
+                async for mode, chunk in self.graph.astream(graph_input, config, stream_mode=["updates", "values"]):
+                    if mode == "values":
+                        state = chunk
+                        continue
+                    if "__interrupt__" in chunk:
+                        waiting = True
+                        continue
+                    for node, update in chunk.items():
+                        if not update:
+                            continue
+                        if node == "coach" and update.get("coach_message"):
+                            feedback["coach_message"] = update["coach_message"]
+                        elif node == "grader" and update.get("last_grader"):
+                            feedback["grader"] = update["last_grader"]
+                            if update.get("last_referee"):
+                                # the embedding pre-grader decided without a referee round
+                                feedback["referee"] = update["last_referee"]
+                        elif node == "referee" and update.get("last_referee"):
+                            feedback["referee"] = update["last_referee"]
+            except Exception as e:
+                feedback["error"] = f"{type(e).__name__}: {e}"
+        feedback.update({
+            "current_step": state.get("current_step"),
+            "step_description": get_sop(session.sop_id).step_description(state.get("current_step", 1)),
+            "done": bool(state.get("done")),
+            "awaiting_reply": waiting,
+        })
+        session.feedback = feedback
+        return feedback
+
+    async def start_session(self, sop_id: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+        get_sop(sop_id)     # fail fast on an unknown SOP
+        session = Session(session_id=session_id or uuid.uuid4().hex, sop_id=sop_id)
+        if session.session_id in self._sessions:
+            raise ValueError(f"Session {session.session_id!r} already exists")
+        self._sessions[session.session_id] = session
+        async with session.lock:
+            return await self._run_turn(session, referee.new_state(sop_id, conversation_id=session.session_id))
+
+    async def submit_reply(self, session_id: str, text: str) -> Dict[str, Any]:
+        session = self._session(session_id)
+        async with session.lock:
+            if not session.feedback.get("awaiting_reply"):
+                raise RuntimeError(f"Session {session_id!r} is not waiting for a reply")
+            return await self._run_turn(session, Command(resume=text))
+
+    async def get_feedback(self, session_id: str) -> Dict[str, Any]:
+        return self._session(session_id).feedback
+
+    async def end_session(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            await self.checkpointer.adelete_thread(session_id)
+            drop_conversation(session_id)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+async def _console_demo(sop_path: str) -> None:
+    manager = SessionManager()
+    manager.install_executor()
+    sop_id = manager.load_sop(sop_path)
+    feedback = await manager.start_session(sop_id)
+    while not feedback["done"] and not feedback["error"]:
+        reply = await asyncio.to_thread(input, "\n👨‍💼 Your reply:\n> ")
+        feedback = await manager.submit_reply(feedback["session_id"], reply)
+        referee_verdict = feedback["referee"] or {}
+        if feedback["grader"] and referee_verdict.get("referee_grade", "pass") == "pass":
+            print(f"\n📝 Grader: {feedback['grader']['message']}")
+        elif referee_verdict:
+            print(f"⚠️  Referee disagreed: {referee_verdict['message']}")
+    if feedback["error"]:
+        print(f"\n❌ Simulation failed: {feedback['error']}")
+    else:
+        print("\n✅  Simulation complete! All steps passed.")
+
+
+if __name__ == "__main__":
+    asyncio.run(_console_demo(sys.argv[1] if len(sys.argv) > 1 else "sample_simulations/SOP145.json"))
@@ -0,0 +1,76 @@
+# sop.py
+#
+# Parsed SOP definitions (sample_simulations/*.json), compiled once and shared by every
+# session that trains on them. Graph state only carries the `sop_id`.
+
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Dict, List, Optional
+
+UNKNOWN_STEP = {"step_name": "Unknown step", "step_number": 1, "rubric": {"description": "No description", "example_message": ""}}
+
+
+@dataclass(frozen=True)
+class SOPDefinition:
+    sop_id: str
+    steps: Dict[int, Dict[str, Any]]           # step_number -> step, in SOP order
+    source: Optional[str] = None
+
+    @property
+    def total_steps(self) -> int:
+        return len(self.steps)
+
+    @property
+    def step_numbers(self) -> List[int]:
+        return list(self.steps)
+
+    def step(self, step_number: int) -> Dict[str, Any]:
+        return self.steps.get(step_number, UNKNOWN_STEP)
+
+    def step_description(self, step_number: int) -> str:
+        return self.step(step_number).get("rubric", {"description": "No description"}).get("description", "No description")
+
+    @cached_property
+    def rendered(self) -> str:
+        """The full SOP as it is pasted into prompts, rendered once."""
+        return str(self.steps)
+
+
+def sop_from_sample(sample: Dict[str, Any], sop_id: Optional[str] = None, source: Optional[str] = None) -> SOPDefinition:
+    if sop_id is None:
+        digest = hashlib.sha1(json.dumps(sample, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+        sop_id = f"sop-{digest}"
+    steps = {step.get("step_number"): step for step in sample.get("steps", [])}
+    return SOPDefinition(sop_id=sop_id, steps=steps, source=source)
+
+
+_registry: Dict[str, SOPDefinition] = {}
+_registry_lock = threading.Lock()
+
+
+def register_sop(sop: SOPDefinition) -> SOPDefinition:
+    with _registry_lock:
+        _registry[sop.sop_id] = sop
+    return sop
+
+
+def load_sop(path: str, sop_id: Optional[str] = None) -> SOPDefinition:
+    """Load and register an SOP file; the id defaults to the file name (e.g. "SOP145")."""
+    sop_id = sop_id or os.path.splitext(os.path.basename(path))[0]
+    existing = _registry.get(sop_id)
+    if existing is not None and existing.source == path:
+        return existing
+    with open(path) as f:
+        sample = json.load(f)
+    return register_sop(sop_from_sample(sample, sop_id, source=path))
+
+
+def get_sop(sop_id: str) -> SOPDefinition:
+    try:
+        return _registry[sop_id]
+    except KeyError:
+        raise KeyError(f"Unknown SOP {sop_id!r}; load it with load_sop() or register_sop() first") from None
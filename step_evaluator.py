@@ -0,0 +1,140 @@
+# step_evaluator.py
+#
+# Incremental SOP evaluator for training_simulation.py.
+#
+# The trainee's progress is a StepCheckpoint: which SOP steps are already satisfied, and
+# on which turn. Each turn only the new trainee message (plus the customer message it
+# answers) is graded, and only against the steps still outstanding, so the prompt - and
+# the cost of a turn - stays flat however long the conversation gets. Steps, once
+# satisfied, are never re-judged.
+#
+# The SOP comes from a sample_simulations JSON file (sop.load_sop); its rubric is the
+# static prompt prefix, compiled once per SOP by prompts.registry.
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from llm import chat_structured
+from prompts import registry as prompt_registry
+from sop import SOPDefinition, get_sop
+from structured import StepEvaluation, StructuredOutputError
+from tracing import tracer
+
+STEP_EVALUATION_PROMPT = """
+You are a customer service trainer grading a trainee against {sop_id}, one message at a time.
+
+{sop_id} steps:
+{steps}
+
+You will be given the customer's latest message, the trainee's new reply to it, and the
+steps the trainee has not completed yet. Decide which of those outstanding steps the new
+reply completes. Judge only the new reply: earlier steps are already recorded.
+
+Respond in VALID JSON only, with:
+- "satisfied_steps": the numbers of the outstanding steps this reply completes ([] if none)
+- "feedback": a short bulleted list of what was good and what is still missing for the
+  current step. Recommend specific improvements.
+
+"""
+
+STEP_EVALUATION_SUFFIX = """
+Outstanding steps: {outstanding}
+Current step: {current} - {current_desc}
+
+Customer: {customer}
+Trainee: {trainee}
+"""
+
+
+def _render_steps(sop: SOPDefinition) -> str:
+    lines = []
+    for number in sop.step_numbers:
+        step = sop.step(number)
+        example = step.get("rubric", {}).get("example_message")
+        line = f"{number}. {step.get('step_name', '')}: {sop.step_description(number)}"
+        lines.append(f"{line} (e.g. \"{example}\")" if example else line)
+    return "\n".join(lines)
+
+
+prompt_registry.register(
+    "step_evaluator",
+    lambda sop, step: STEP_EVALUATION_PROMPT.format(sop_id=sop.sop_id, steps=_render_steps(sop)),
+    per_step=False,
+)
+
+
+@dataclass
+class StepCheckpoint:
+    sop_id: str
+    satisfied: Dict[int, int] = field(default_factory=dict)     # step number -> turn that completed it
+    turn: int = 0
+
+    def outstanding(self, sop: Optional[SOPDefinition] = None) -> List[int]:
+        sop = sop or get_sop(self.sop_id)
+        return [number for number in sop.step_numbers if number not in self.satisfied]
+
+    def current_step(self, sop: Optional[SOPDefinition] = None) -> Optional[int]:
+        outstanding = self.outstanding(sop)
+        return outstanding[0] if outstanding else None
+
+    def complete(self, sop: Optional[SOPDefinition] = None) -> bool:
+        return not self.outstanding(sop)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"sop_id": self.sop_id, "satisfied": {str(k): v for k, v in self.satisfied.items()}, "turn": self.turn}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "StepCheckpoint":
+        return cls(sop_id=data["sop_id"], satisfied={int(k): v for k, v in data.get("satisfied", {}).items()},
+                   turn=data.get("turn", 0))
+
+
+class StepEvaluator:
+    """Grades one trainee message at a time against the steps a StepCheckpoint still has open."""
+
+    def __init__(self, sop_id: str):
+        self.sop_id = sop_id
+
+    def prompt(self, checkpoint: StepCheckpoint, customer_message: str, trainee_message: str) -> str:
+        sop = get_sop(self.sop_id)
+        current = checkpoint.current_step(sop)
+        prefix = prompt_registry.get(self.sop_id, None, "step_evaluator")
+        return prefix.text + STEP_EVALUATION_SUFFIX.format(
+            outstanding=", ".join(map(str, checkpoint.outstanding(sop))),
+            current=current,
+            current_desc=sop.step_description(current),
+            customer=customer_message,
+            trainee=trainee_message,
+        )
+
+    def evaluate(self, checkpoint: StepCheckpoint, customer_message: str, trainee_message: str) -> Dict[str, Any]:
+        """
+        Grade `trainee_message` and record the steps it completes in `checkpoint`.
+        Returns {"step", "passed", "complete", "feedback", "satisfied_steps"}: "passed" is
+        whether the step that was current before this message is now satisfied.
+        """
+        sop = get_sop(self.sop_id)
+        checkpoint.turn += 1
+        current = checkpoint.current_step(sop)
+        if current is None:
+            return {"step": None, "passed": True, "complete": True, "feedback": "", "satisfied_steps": []}
+
+        with tracer.span("llm.evaluator", "llm", outstanding=len(checkpoint.outstanding(sop))):
+            try:
+                verdict = chat_structured(self.prompt(checkpoint, customer_message, trainee_message), StepEvaluation)
+            except StructuredOutputError as e:
+                return {"step": sop.step_description(current), "passed": False,
+                        "complete": False, "feedback": f"Could not parse response: {e}", "satisfied_steps": []}
+
+        outstanding = set(checkpoint.outstanding(sop))
+        # steps that were already satisfied, or don't exist, are ignored
+        newly = [number for number in dict.fromkeys(verdict.satisfied_steps) if number in outstanding]
+        for number in newly:
+            checkpoint.satisfied[number] = checkpoint.turn
+        return {
+            "step": sop.step_description(current),
+            "passed": current in checkpoint.satisfied,
+            "complete": checkpoint.complete(sop),
+            "feedback": verdict.feedback,
+            "satisfied_steps": newly,
+        }
@@ -0,0 +1,202 @@
+# structured.py
+#
+# Schema-enforced JSON output for the grader, referee and training step evaluator.
+#
+# The Pydantic models below are the single source of the output schemas: they are sent
+# to OpenAI as a response format (json_schema / json_object) or a forced tool, and to
+# Ollama as `format=`. Fields are declared decision-first, so a streamed reply carries
+# `step_passed` / `referee_grade` before the prose, and IncrementalJSONParser lets the
+# caller stop reading (and close the stream) as soon as the fields it needs are complete.
+#
+# STRUCTURED_OUTPUT selects the OpenAI mechanism: "json_schema" (strict schema, newer
+# models), "json_object" (JSON mode, works on gpt-3.5-turbo), "tool" or "off".
+
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, List, Literal, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError, model_validator
+
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "json_object")
+
+Fields = Dict[str, Any]
+
+
+class GraderVerdict(BaseModel):
+    step_passed: bool
+    message: str
+    current_step: Optional[int] = None
+    role: Literal["grader"] = "grader"
+
+
+class RefereeVerdict(BaseModel):
+    referee_grade: Literal["pass", "fail"]
+    must_regenerate: Optional[bool] = None
+    message: str = ""
+    current_step: Optional[int] = None
+    role: Literal["referee"] = "referee"
+
+    @model_validator(mode="after")
+    def _regenerate_follows_grade(self) -> "RefereeVerdict":
+        if self.must_regenerate is None:
+            self.must_regenerate = self.referee_grade == "fail"
+        return self
+
+
+class StepEvaluation(BaseModel):
+    satisfied_steps: List[int] = []
+    feedback: Any = ""
+
+
+# What each caller needs before it can stop reading the stream
+def grader_done(fields: Fields) -> bool:
+    return "step_passed" in fields and "message" in fields
+
+
+def referee_done(fields: Fields) -> bool:
+    # the referee's message is only shown to the trainee when it disagrees
+    return "referee_grade" in fields and (fields["referee_grade"] == "pass" or "message" in fields)
+
+
+class StructuredOutputError(ValueError):
+    """The model's reply did not contain a valid object for the schema."""
+
+
+class IncrementalJSONParser:
+    """
+    Feed text as it streams in; `fields` holds every top-level key of the JSON object whose
+    value is complete. Text before the opening brace (a fence, a preamble) is skipped.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Fields = {}
+        self.closed = False
+        self._pos: Optional[int] = None         # where the next key (or the closing brace) starts
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text: str) -> Fields:
+        self.buffer += text
+        if self._pos is None:
+            start = self.buffer.find("{")
+            if start < 0:
+                return self.fields
+            self._pos = start + 1
+        while not self.closed and self._advance():
+            pass
+        return self.fields
+
+    def _skip(self, pos: int) -> int:
+        while pos < len(self.buffer) and self.buffer[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    def _advance(self) -> bool:
+        """Consume one complete `"key": value` pair (or the closing brace); False if more text is needed."""
+        pos = self._skip(self._pos)
+        if pos >= len(self.buffer):
+            return False
+        if self.buffer[pos] == "}":
+            self.closed = True
+            return False
+        if self.buffer[pos] == ",":
+            pos = self._skip(pos + 1)
+        try:
+            key, pos = self._decoder.raw_decode(self.buffer, pos)
+            pos = self._skip(pos)
+            if pos >= len(self.buffer) or self.buffer[pos] != ":":
+                return False
+            value, end = self._decoder.raw_decode(self.buffer, self._skip(pos + 1))
+        except json.JSONDecodeError:
+            return False
+        # a number (or literal) at the end of the buffer may still be growing: only take it
+        # once the delimiter after it has arrived
+        after = self._skip(end)
+        if after >= len(self.buffer) or self.buffer[after] not in ",}":
+            return False
+        self.fields[key] = value
+        self._pos = after
+        return True
+
+
+def openai_bind_kwargs(schema: Type[BaseModel], mode: Optional[str] = None) -> Dict[str, Any]:
+    """Invocation kwargs that make an OpenAI chat model answer in `schema`."""
+    mode = mode or STRUCTURED_OUTPUT
+    if mode == "json_schema":
+        json_schema = schema.model_json_schema()
+        json_schema["additionalProperties"] = False
+        # not strict: strict mode rejects defaults, and the optional fields are filled in here
+        return {"response_format": {"type": "json_schema",
+                                    "json_schema": {"name": schema.__name__, "schema": json_schema, "strict": False}}}
+    if mode == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    if mode == "tool":
+        tool = {"type": "function", "function": {"name": schema.__name__, "parameters": schema.model_json_schema()}}
+        return {"tools": [tool], "tool_choice": {"type": "function", "function": {"name": schema.__name__}}}
+    return {}
+
+
+def structured_llm(llm, schema: Type[BaseModel], mode: Optional[str] = None):
+    kwargs = openai_bind_kwargs(schema, mode)
+    return llm.bind(**kwargs) if kwargs else llm
+
+
+def chunk_text(chunk) -> str:
+    """The JSON-bearing text of a streamed chunk: content, or forced-tool arguments."""
+    tool_chunks = getattr(chunk, "tool_call_chunks", None)
+    if tool_chunks:
+        return "".join(c.get("args") or "" for c in tool_chunks)
+    return chunk.content if isinstance(chunk.content, str) else ""
+
+
+def validate(schema: Type[BaseModel], fields: Fields, raw: str = "") -> BaseModel:
+    try:
+        return schema.model_validate(fields)
+    except ValidationError as e:
+        raise StructuredOutputError(f"{schema.__name__} not found in model output: {raw[:200]!r}") from e
+
+
+def read_stream(chunks: Iterable, schema: Type[BaseModel], done: Optional[Callable[[Fields], bool]] = None
+                ) -> Tuple[BaseModel, Any]:
+    """
+    Parse a chunk stream into `schema`, stopping once `done(fields)` holds (then the stream
+    is closed, which ends generation). Returns (model, last chunk that reported usage).
+    """
+    parser = IncrementalJSONParser()
+    usage_chunk = None
+    stream = iter(chunks)
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage_metadata", None):
+                usage_chunk = chunk
+            parser.feed(chunk_text(chunk))
+            if parser.closed or (done is not None and done(parser.fields)):
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    return validate(schema, parser.fields, parser.buffer), usage_chunk
+
+
+async def aread_stream(chunks, schema: Type[BaseModel], done: Optional[Callable[[Fields], bool]] = None
+                       ) -> Tuple[BaseModel, Any]:
+    parser = IncrementalJSONParser()
+    usage_chunk = None
+    try:
+        async for chunk in chunks:
+            if getattr(chunk, "usage_metadata", None):
+                usage_chunk = chunk
+            parser.feed(chunk_text(chunk))
+            if parser.closed or (done is not None and done(parser.fields)):
+                break
+    finally:
+        await chunks.aclose()
+    return validate(schema, parser.fields, parser.buffer), usage_chunk
+
+
+def parse_text(text: str, schema: Type[BaseModel]) -> BaseModel:
+    """Parse a complete reply (cached, or from a non-streaming call) into `schema`."""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return validate(schema, parser.fields, text)
@@ -0,0 +1,94 @@
+# test_embedding_cache.py
+
+import hashlib
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import embedding_cache
+from embedding_cache import DiskEmbeddingStore
+
+
+def vector(key):
+    return np.frombuffer(hashlib.sha256(key.encode()).digest()[:8], dtype=np.uint8).astype(np.float32)
+
+
+def check(store, keys):
+    """Every key comes back as its own vector or not at all; returns how many came back."""
+    found = 0
+    for key, got in zip(keys, store.get_many(keys)):
+        if got is not None:
+            assert np.array_equal(got, vector(key)), f"{key} came back with another key's vector"
+            found += 1
+    return found
+
+
+def put(store, *keys):
+    return store.put_many([(key, vector(key)) for key in keys])
+
+
+def test_write_in_one_store_read_in_another(tmp_path):
+    a, b = DiskEmbeddingStore(str(tmp_path), 8), DiskEmbeddingStore(str(tmp_path), 8)
+    put(a, "x", "y")
+    assert check(b, ["x", "y", "z"]) == 2
+    put(b, "z")
+    assert check(a, ["x", "y", "z"]) == 3
+    assert len(a) == len(b) == 3
+
+
+def test_slots_are_not_allocated_twice(tmp_path):
+    a, b = DiskEmbeddingStore(str(tmp_path), 4), DiskEmbeddingStore(str(tmp_path), 4)
+    put(a, "a1", "a2")
+    put(b, "b1", "b2")          # b sees a's slots taken before it allocates
+    keys = ["a1", "a2", "b1", "b2"]
+    assert check(a, keys) == check(b, keys) == 4
+
+
+def test_a_key_evicted_elsewhere_is_not_read_from_its_reused_slot(tmp_path):
+    a, b = DiskEmbeddingStore(str(tmp_path), 4), DiskEmbeddingStore(str(tmp_path), 4)
+    put(a, "k0", "k1", "k2", "k3")
+    assert check(a, ["k0"]) == 1            # a still maps k0 to its slot
+    assert put(b, "k4", "k5") == ["k0", "k1"]
+    assert a.get("k0") is None
+    assert a.get("k1") is None
+    keys = [f"k{i}" for i in range(6)]
+    assert check(a, keys) == check(b, keys) == 4
+
+
+def test_compaction_by_one_store_is_followed_by_the_other(tmp_path):
+    a, b = DiskEmbeddingStore(str(tmp_path), 4), DiskEmbeddingStore(str(tmp_path), 4)
+    keys = [f"k{i}" for i in range(40)]
+    put(b, keys[0])
+    for key in keys[1:]:
+        put(a, key)                          # 2 log lines per eviction: compacts past 16
+    assert a._log_lines <= 4 * a.capacity
+    assert check(b, keys) == 4
+    assert b.get("k39") is not None
+    put(b, "late")
+    assert check(a, keys + ["late"]) == 4
+    reopened = DiskEmbeddingStore(str(tmp_path), 4)
+    assert check(reopened, keys + ["late"]) == 4
+
+
+def _worker(path, tag):
+    store = DiskEmbeddingStore(path, 64)
+    for round in range(40):
+        mine = [f"{tag}-{round}-{i}" for i in range(8)]
+        put(store, *mine)
+        theirs = [f"{1 - tag}-{round}-{i}" for i in range(8)]
+        check(store, mine + theirs)
+
+
+@pytest.mark.skipif(embedding_cache.fcntl is None, reason="stores are shared through flock")
+def test_two_processes_never_see_each_others_vectors(tmp_path):
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_worker, args=(str(tmp_path), tag)) for tag in (0, 1)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert [worker.exitcode for worker in workers] == [0, 0]
+    store = DiskEmbeddingStore(str(tmp_path), 64)
+    keys = [f"{tag}-{round}-{i}" for tag in (0, 1) for round in range(40) for i in range(8)]
+    assert check(store, keys) == len(store) == 64
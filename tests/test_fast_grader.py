@@ -0,0 +1,43 @@
+# test_fast_grader.py
+
+import os
+
+import numpy as np
+import pytest
+
+from fast_grader import FastGrader, fast_grader_mode
+from sop import load_sop
+
+SOP_ID = load_sop(os.path.join(os.path.dirname(__file__), "..", "sample_simulations", "SOP145.json")).sop_id
+
+
+@pytest.mark.parametrize("value, mode", [(None, "off"), ("shadow", "shadow"), ("on", "on"), ("true", "on"),
+                                         ("false", "off"), ("bogus", "off")])
+def test_mode_is_opt_in(monkeypatch, value, mode):
+    if value is None:
+        monkeypatch.delenv("FAST_GRADER", raising=False)
+    else:
+        monkeypatch.setenv("FAST_GRADER", value)
+    assert fast_grader_mode() == mode
+
+
+def test_model_load_failure_disables_the_grader():
+    calls = []
+
+    def offline(texts):
+        calls.append(texts)
+        raise OSError("We couldn't connect to the model hub")
+
+    grader = FastGrader(encode=offline, log_path=None)
+    assert grader.grade(SOP_ID, 1, "Hello, how can I help?") is None
+    assert grader.disabled_reason.startswith("OSError")
+    assert grader.grade(SOP_ID, 1, "Hello again") is None
+    assert len(calls) == 1
+
+
+def test_shadow_mode_never_settles_a_turn():
+    grader = FastGrader(encode=lambda texts: np.ones((len(texts), 4)), log_path=None, enforce=False)
+    verdict = grader.grade(SOP_ID, 1, "anything")
+    assert verdict.score == pytest.approx(1.0)
+    assert verdict.step_passed is None
+    assert grader.decided == 1
@@ -0,0 +1,98 @@
+# test_graph_client.py
+
+import asyncio
+
+import pytest
+
+from graph_client import GraphClient
+from tracing import Sink, tracer
+
+
+class Record:
+    def __init__(self, data):
+        self._data = data
+
+    def data(self):
+        return self._data
+
+
+class Result:
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for i, row in enumerate(self.rows):
+            if i == self.fail_after:
+                raise ConnectionError("connection reset")
+            yield Record(row)
+
+
+class Context:
+    def __init__(self, value):
+        self.value = value
+
+    async def __aenter__(self):
+        return self.value
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class StubAsyncDriver:
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+
+    def session(self, **config):
+        driver = self
+
+        class Session:
+            async def begin_transaction(self):
+                class Tx:
+                    async def run(self, cypher, params):
+                        return Result(driver.rows, driver.fail_after)
+                return Context(Tx())
+
+        return Context(Session())
+
+
+class Collect(Sink):
+    def __init__(self):
+        self.spans = []
+
+    def emit(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def spans():
+    sink = tracer.add_sink(Collect())
+    yield sink.spans
+    tracer.remove_sink(sink)
+
+
+async def consume(client, limit=None):
+    out = []
+    stream = client.astream("MATCH (n) RETURN n.id AS id")
+    async for record in stream:
+        out.append(record)
+        if limit is not None and len(out) == limit:
+            await stream.aclose()
+            break
+    return out
+
+
+def test_astream_is_traced(spans):
+    client = GraphClient(None, async_driver=lambda: StubAsyncDriver([{"id": 1}, {"id": 2}, {"id": 3}]))
+    assert asyncio.run(consume(client)) == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert [(s.name, s.kind, s.attrs["records"], s.error) for s in spans] == [("neo4j.stream", "neo4j", 3, None)]
+
+
+def test_astream_span_records_early_close_and_errors(spans):
+    client = GraphClient(None, async_driver=lambda: StubAsyncDriver([{"id": 1}, {"id": 2}, {"id": 3}]))
+    asyncio.run(consume(client, limit=1))
+    failing = GraphClient(None, async_driver=lambda: StubAsyncDriver([{"id": 1}, {"id": 2}], fail_after=1))
+    with pytest.raises(ConnectionError):
+        asyncio.run(consume(failing))
+    assert [(s.attrs["records"], s.error) for s in spans] == [(1, None), (1, "ConnectionError: connection reset")]
@@ -0,0 +1,70 @@
+# test_graph_expansion.py
+
+from neo4j.exceptions import ServiceUnavailable
+from qdrant_client import QdrantClient
+
+from tools import ResearchTools, chunk_key
+
+
+class StubGraph:
+    def __init__(self, rows=None, error=None):
+        self.rows = rows or []
+        self.error = error
+        self.calls = []
+
+    def read(self, query, params=None):
+        self.calls.append((query, params))
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+
+def tools_with(graph):
+    tools = ResearchTools(QdrantClient(":memory:"), None)
+    tools.graph_client = graph
+    return tools
+
+
+ROWS = [
+    {"chunk_id": "c1", "email_id": "e1", "subject": "Refund", "sender": "a@x", "thread_id": "t1", "reply_to": None,
+     "neighbors": [{"id": "c3", "text": "parent"}, {"id": "c2", "text": "already a hit"}, {"id": "c4", "text": "thread"}]},
+    {"chunk_id": "c2", "email_id": "e2", "subject": "Re: Refund", "sender": "b@x", "thread_id": "t1", "reply_to": "e1",
+     "neighbors": [{"id": "c4", "text": "thread"}, {"id": "c5", "text": "more thread"}]},
+]
+
+
+def test_chunk_key_prefers_payload_ids():
+    assert chunk_key({"id": "a", "chunk_id": "b", "_id": 1}) == "a"
+    assert chunk_key({"chunk_id": "b", "_id": 1}) == "b"
+    assert chunk_key({"_id": 0}) == 0
+    assert chunk_key({"text": "no id"}) is None
+
+
+def test_hits_gain_graph_fields_without_losing_payload_fields():
+    graph = StubGraph(ROWS)
+    hits = [{"id": "c1", "text": "first", "subject": "from the payload"}, {"id": "c2", "text": "second"},
+            {"id": "c9", "text": "not in the graph"}]
+    expanded = tools_with(graph).expand_with_graph(hits, per_chunk=3)
+
+    assert graph.calls == [("chunk_neighborhood", {"chunk_ids": ["c1", "c2", "c9"], "per_chunk": 3})]
+    first, second, missing = expanded[:3]
+    assert first["subject"] == "from the payload"
+    assert (first["email_id"], first["sender"], first["thread_id"], first["reply_to"]) == ("e1", "a@x", "t1", None)
+    assert second["reply_to"] == "e1"
+    assert missing == hits[2]
+    assert "email_id" not in hits[0]          # the caller's dicts are left alone
+
+
+def test_neighbours_follow_the_hits_in_order_without_repeats():
+    hits = [{"id": "c1", "text": "first"}, {"id": "c2", "text": "second"}]
+    neighbors = tools_with(StubGraph(ROWS)).expand_with_graph(hits)[2:]
+    assert [(n["id"], n["_neighbor_of"]) for n in neighbors] == [("c3", "c1"), ("c4", "c1"), ("c5", "c2")]
+    assert all(n["thread_id"] == "t1" for n in neighbors)
+
+
+def test_hits_come_back_unchanged_when_the_graph_is_unavailable():
+    hits = [{"id": "c1", "text": "first"}]
+    graph = StubGraph(error=ServiceUnavailable("down"))
+    assert tools_with(graph).expand_with_graph(hits) is hits
+    assert tools_with(None).expand_with_graph(hits) is hits
+    assert tools_with(StubGraph(ROWS)).expand_with_graph(hits, per_chunk=0) is hits
@@ -0,0 +1,65 @@
+# test_ingest.py
+
+import json
+import os
+
+import numpy as np
+from qdrant_client import QdrantClient
+
+from ingest import Checkpoint, ingest_jsonl, iter_batches
+
+
+class StubEngine:
+    def encode(self, texts, use_cache=True):
+        return np.asarray([[len(text), 1.0, 0.5] for text in texts], dtype=np.float32)
+
+
+def write_lines(path, lines):
+    with open(path, "a") as f:
+        for line in lines:
+            f.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+
+
+def chunks(start, end):
+    return [{"id": f"c{i}", "text": f"chunk number {i}"} for i in range(start, end)]
+
+
+def ingest(path, qdrant):
+    return ingest_jsonl(str(path), qdrant, collection="c", batch_size=4, upload_workers=2,
+                        checkpoint_path=str(path) + ".checkpoint.json", engine=StubEngine(), progress_every=0)
+
+
+def test_trailing_skipped_lines_are_checkpointed(tmp_path):
+    path = tmp_path / "chunks.jsonl"
+    write_lines(path, chunks(0, 8) + ["{not json", {"id": "empty", "text": ""}])
+    qdrant = QdrantClient(":memory:")
+
+    report = ingest(path, qdrant)
+    assert (report.chunks, report.skipped_lines) == (8, 2)
+    assert Checkpoint(str(path) + ".checkpoint.json").offset == os.path.getsize(path)
+
+    again = ingest(path, qdrant)
+    assert (again.chunks, again.skipped_lines, again.resumed_from) == (0, 0, os.path.getsize(path))
+
+
+def test_resume_only_ingests_what_was_appended(tmp_path):
+    path = tmp_path / "chunks.jsonl"
+    write_lines(path, chunks(0, 6))
+    qdrant = QdrantClient(":memory:")
+    ingest(path, qdrant)
+    size = os.path.getsize(path)
+
+    write_lines(path, ["", "[1, 2]"] + chunks(6, 9))
+    report = ingest(path, qdrant)
+    assert report.resumed_from == size
+    assert (report.chunks, report.skipped_lines) == (3, 1)
+    assert qdrant.count("c").count == 9
+
+
+def test_only_skipped_lines_still_make_a_batch(tmp_path):
+    path = tmp_path / "chunks.jsonl"
+    write_lines(path, chunks(0, 4) + ["{bad"])
+    batches = list(iter_batches(str(path), batch_size=4))
+    assert [len(batch.ids) for batch in batches] == [4, 0]
+    assert batches[-1].end_offset == os.path.getsize(path)
+    assert list(iter_batches(str(path), batch_size=4, start_offset=os.path.getsize(path))) == []
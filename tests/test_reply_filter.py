@@ -0,0 +1,55 @@
+# test_reply_filter.py
+
+import pytest
+
+import llm
+import reply_filter
+from reply_filter import ReplyClassifier
+
+
+class StubClient:
+    def __init__(self):
+        self.gathers = []
+
+    def gather(self, fn, items):
+        items = list(items)
+        self.gathers.append((fn.__name__, len(items)))
+        return [fn(item) for item in items]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = StubClient()
+    monkeypatch.setattr(reply_filter, "get_llm_client", lambda: client)
+    def is_reply_chunk(text):
+        return text.endswith("reply")
+
+    monkeypatch.setattr(llm, "is_reply_chunk", is_reply_chunk)
+    return client
+
+
+# no heuristic matches these, so every one goes to the LLM
+CHUNKS = [{"id": i, "text": f"chunk {i} {'reply' if i % 2 else 'notice'}"} for i in range(5)]
+
+
+def test_invalid_batch_is_retried_before_asking_per_chunk(monkeypatch, client):
+    calls = []
+
+    def classify(batch):
+        calls.append(sorted(batch))
+        return {} if len(calls) == 1 else {i: text.endswith("reply") for i, text in batch.items()}
+
+    monkeypatch.setattr(llm, "classify_reply_chunks", classify)
+    classifier = ReplyClassifier(batch_size=3, use_embeddings=False)
+    assert classifier.classify(CHUNKS) == {0: False, 1: True, 2: False, 3: True, 4: False}
+    assert calls[2:] == [[0, 1, 2]]                 # retried with the skipped chunks only
+    assert classifier.stats.fallback_calls == 0
+    assert classifier.stats.llm_calls == 3
+
+
+def test_chunks_skipped_twice_are_asked_about_concurrently(monkeypatch, client):
+    monkeypatch.setattr(llm, "classify_reply_chunks", lambda batch: {i: False for i in batch if i not in (1, 3)})
+    classifier = ReplyClassifier(batch_size=2, use_embeddings=False)
+    assert classifier.filter(CHUNKS) == [CHUNKS[1], CHUNKS[3]]
+    assert classifier.stats.fallback_calls == 2
+    assert client.gathers[-1] == ("is_reply_chunk", 2)
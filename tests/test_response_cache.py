@@ -0,0 +1,65 @@
+# test_response_cache.py
+
+import numpy as np
+
+from response_cache import ResponseCache, context_key, response_key
+
+MESSAGES = [("system", "Grade step 1."), ("user", "Hello,  I can help\nwith that.")]
+
+
+def one_hot(texts):
+    # each distinct text gets its own direction, so only identical text is "similar"
+    return [np.eye(16, dtype=np.float32)[sum(map(ord, text)) % 16] for text in texts]
+
+
+def test_keys_ignore_whitespace_but_not_model_or_role():
+    spaced = [("system", "  Grade step 1. "), ("user", "Hello, I can help with that.")]
+    assert response_key("m", MESSAGES) == response_key("m", spaced)
+    assert response_key("m", MESSAGES) != response_key("other", MESSAGES)
+    assert response_key("m", MESSAGES) != response_key("m", [("user", "Grade step 1."), MESSAGES[1]])
+    assert context_key("m", MESSAGES) == context_key("m", [MESSAGES[0], ("user", "something else")])
+
+
+def test_store_lookup_and_invalidate():
+    cache = ResponseCache()
+    assert cache.lookup("m", MESSAGES) is None
+    cache.store("m", MESSAGES, "verdict")
+    assert cache.lookup("m", MESSAGES) == "verdict"
+    cache.invalidate("m", MESSAGES)
+    assert cache.lookup("m", MESSAGES) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_expired_entries_miss():
+    cache = ResponseCache(ttl=-1)
+    cache.store("m", MESSAGES, "verdict")
+    assert cache.lookup("m", MESSAGES) is None
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    ResponseCache(path=path).store("m", MESSAGES, "verdict")
+    cache = ResponseCache(path=path)
+    assert cache.lookup("m", MESSAGES) == "verdict"
+    assert cache.disk_hits == 1
+
+
+def test_similar_final_message_shares_the_verdict():
+    cache = ResponseCache(similarity=0.9, embed=one_hot)
+    cache.store("m", MESSAGES, "verdict")
+    # same characters in another order: same direction under one_hot
+    assert cache.lookup("m", [MESSAGES[0], ("user", MESSAGES[1][1][::-1])]) == "verdict"
+    assert cache.similar_hits == 1
+    assert cache.lookup("m", [("system", "Grade step 2."), MESSAGES[1]]) is None
+
+
+def test_lru_eviction_drops_similarity_rows():
+    cache = ResponseCache(memory_capacity=3, similarity=0.9, embed=one_hot)
+    for i in range(10):
+        cache.store("m", [("system", f"step {i % 2}"), ("user", f"reply {i}")], f"verdict {i}")
+    rows = sum(len(keys) for keys, _ in cache._vectors.values())
+    assert len(cache._memory) == 3
+    assert rows == 3
+    assert set(cache._vector_context) == set(cache._memory)
+    assert cache.lookup("m", [("system", "step 0"), ("user", "reply 0")]) is None
+    assert cache.lookup("m", [("system", "step 1"), ("user", "reply 9")]) == "verdict 9"
@@ -0,0 +1,83 @@
+# test_structured.py
+
+import json
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+
+from structured import (GraderVerdict, IncrementalJSONParser, RefereeVerdict, StructuredOutputError, grader_done,
+                        parse_text, read_stream, referee_done)
+
+GRADER = {"step_passed": True, "message": "Good greeting.", "current_step": 1, "role": "grader"}
+
+
+def feed_chars(parser, text):
+    snapshots = []
+    for char in text:
+        snapshots.append(dict(parser.feed(char)))
+    return snapshots
+
+
+def test_fields_appear_only_once_complete():
+    text = '```json\n{"current_step": 12, "message": "a \\"quoted\\" word", "step_passed": false}\n```'
+    parser = IncrementalJSONParser()
+    snapshots = feed_chars(parser, text)
+    # the number is not taken while it may still be growing
+    assert {"current_step": 1} not in snapshots
+    assert all(s.get("current_step") in (None, 12) for s in snapshots)
+    assert parser.closed
+    assert parser.fields == {"current_step": 12, "message": 'a "quoted" word', "step_passed": False}
+
+
+def test_nested_values_are_taken_whole():
+    parser = IncrementalJSONParser()
+    parser.feed('{"satisfied_steps": [1, 2], "feedback": {"1": "ok"}}')
+    assert parser.fields == {"satisfied_steps": [1, 2], "feedback": {"1": "ok"}}
+
+
+def test_parse_text_validates_and_fills_defaults():
+    verdict = parse_text(json.dumps(GRADER), GraderVerdict)
+    assert verdict.step_passed is True
+    referee = parse_text('{"referee_grade": "fail", "message": "No."}', RefereeVerdict)
+    assert referee.must_regenerate is True
+
+
+def test_parse_text_rejects_invalid_output():
+    with pytest.raises(StructuredOutputError):
+        parse_text("I think the trainee passed.", GraderVerdict)
+    with pytest.raises(StructuredOutputError):
+        parse_text('{"referee_grade": "maybe"}', RefereeVerdict)
+
+
+class Stream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.read += 1
+        return next(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_read_stream_stops_once_done():
+    text = json.dumps(GRADER)
+    chunks = [AIMessageChunk(content=text[i:i + 4]) for i in range(0, len(text), 4)]
+    stream = Stream(chunks)
+    verdict, usage = read_stream(stream, GraderVerdict, grader_done)
+    assert verdict.message == "Good greeting."
+    assert usage is None
+    assert stream.closed
+    assert stream.read < len(chunks)
+
+
+def test_referee_done_skips_the_message_on_pass():
+    assert referee_done({"referee_grade": "pass"})
+    assert not referee_done({"referee_grade": "fail"})
+    assert referee_done({"referee_grade": "fail", "message": "Regenerate."})
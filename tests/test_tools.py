@@ -0,0 +1,39 @@
+# test_tools.py
+
+import pytest
+from qdrant_client import models
+
+from tools import payload_filter, reciprocal_rank_fusion
+
+
+def test_fusion_rewards_agreement_across_rankings():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "a", "d"], ["b"]], k=60)
+    assert [item for item, _ in fused] == ["b", "a", "c", "d"]
+    scores = dict(fused)
+    assert scores["b"] == pytest.approx(1 / 62 + 1 / 61 + 1 / 61)
+    assert scores["d"] == pytest.approx(1 / 63)
+
+
+def test_fusion_of_nothing_is_empty():
+    assert reciprocal_rank_fusion([]) == []
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+def test_payload_filter_passes_filters_and_none_through():
+    existing = models.Filter(must=[])
+    assert payload_filter(None) is None
+    assert payload_filter(existing) is existing
+
+
+def test_payload_filter_builds_conditions():
+    must = payload_filter({
+        "thread_id": "t-1",
+        "sender": ["a@x", "b@x"],
+        "score": {"gte": 0.5},
+        "date": {"gte": "2024-01-01T00:00:00"},
+    }).must
+    by_key = {condition.key: condition for condition in must}
+    assert by_key["thread_id"].match == models.MatchValue(value="t-1")
+    assert by_key["sender"].match == models.MatchAny(any=["a@x", "b@x"])
+    assert isinstance(by_key["score"].range, models.Range)
+    assert isinstance(by_key["date"].range, models.DatetimeRange)
@@ -0,0 +1,94 @@
+# test_vector_store.py
+
+import numpy as np
+import pytest
+from qdrant_client import models
+
+from vector_store import LocalCollection, LocalVectorStore
+
+
+def make_collection(path, n=400, dim=16, ivf_min=200):
+    vectors = np.random.default_rng(0).normal(size=(n, dim)).astype(np.float32)
+    collection = LocalCollection.create(str(path), dim, models.Distance.COSINE, ivf_min=ivf_min, nprobe=2)
+    collection.upsert(vectors, payloads=[{"thread_id": f"t{i % 4}", "tags": ["a", "b"][: i % 3]} for i in range(n)],
+                      ids=list(range(n)))
+    collection.flush()
+    return collection, vectors
+
+
+def best_id(collection, query, query_filter=None):
+    scores, rows = collection.search(query, limit=1, query_filter=query_filter)[0]
+    return collection.points(rows)[0][0], float(scores[0])
+
+
+def test_ivf_search_finds_indexed_and_appended_points(tmp_path):
+    collection, vectors = make_collection(tmp_path / "c")
+    collection.build_index()
+    assert best_id(collection, vectors[7])[0] == 7
+    assert collection.meta["index"]["rows"] == 400
+    extra = np.random.default_rng(1).normal(size=(1, 16)).astype(np.float32)
+    collection.upsert(extra, ids=[400])
+    assert best_id(collection, extra[0])[0] == 400
+
+
+def test_overwritten_points_are_found_after_the_index_is_built(tmp_path):
+    collection, vectors = make_collection(tmp_path / "c")
+    collection.build_index()
+    collection.upsert(-vectors[:2], ids=[0, 1])
+    collection.flush()
+    for reopened in (collection, LocalCollection(str(tmp_path / "c"), ivf_min=200, nprobe=2)):
+        point_id, score = best_id(reopened, -vectors[0])
+        assert point_id == 0
+        assert score == pytest.approx(1.0, abs=1e-5)
+
+
+def test_search_never_builds_the_index(tmp_path):
+    collection, vectors = make_collection(tmp_path / "c")
+    assert best_id(collection, vectors[3])[0] == 3        # exact scan
+    assert collection.meta["index"] is None
+    assert collection.refresh_index()
+    assert not collection.refresh_index()
+    # past the rebuild threshold the index is due again, and searches scan exactly meanwhile
+    more = np.random.default_rng(2).normal(size=(200, 16)).astype(np.float32)
+    collection.upsert(more, ids=list(range(400, 600)))
+    assert collection._usable_index(collection.count) is None
+    assert best_id(collection, more[5])[0] == 405
+    assert collection.meta["index"]["rows"] == 400
+
+
+def test_upload_collection_flushes_and_builds_the_index(tmp_path):
+    store = LocalVectorStore(str(tmp_path), ivf_min=200, nprobe=2)
+    store.create_collection("c", models.VectorParams(size=16, distance=models.Distance.COSINE))
+    vectors = np.random.default_rng(0).normal(size=(300, 16)).astype(np.float32)
+    store.upload_collection("c", vectors, ids=list(range(300)), batch_size=64)
+    reopened = LocalCollection(str(tmp_path / "c"), ivf_min=200)
+    assert reopened.count == 300
+    assert reopened.meta["index"]["rows"] == 300
+
+
+def test_unflushed_rows_are_dropped_on_reopen(tmp_path):
+    collection, vectors = make_collection(tmp_path / "c")
+    collection.upsert(vectors[:3] * 2, ids=["x", "y", "z"])
+    reopened = LocalCollection(str(tmp_path / "c"), ivf_min=200)
+    assert reopened.count == 400
+    reopened.upsert(vectors[:1], ids=["w"])
+    assert reopened.points([400]) == [("w", {})]
+    assert reopened._id_index()["w"] == 400
+
+
+def test_filtered_search_follows_overwrites(tmp_path):
+    collection, vectors = make_collection(tmp_path / "c")
+    in_thread = models.Filter(must=[models.FieldCondition(key="thread_id", match=models.MatchValue(value="t1"))])
+    assert best_id(collection, vectors[5], in_thread)[0] == 5
+    assert best_id(collection, vectors[4], in_thread)[0] != 4
+
+    collection.upsert(vectors[4:5], payloads=[{"thread_id": "t1"}], ids=[4])
+    collection.upsert(vectors[5:6], payloads=[{"thread_id": "t2"}], ids=[5])
+    assert best_id(collection, vectors[4], in_thread)[0] == 4
+    assert best_id(collection, vectors[5], in_thread)[0] != 5
+
+    tagged = models.Filter(must=[models.FieldCondition(key="tags", match=models.MatchAny(any=["b"])),
+                                 models.FieldCondition(key="thread_id", match=models.MatchAny(any=["t0", "t3"]))],
+                           must_not=[models.HasIdCondition(has_id=[8])])
+    expected = [i for i in range(400) if i % 3 == 2 and i % 4 in (0, 3) and i != 8]
+    assert sorted(collection._filter_rows(tagged, collection.count).tolist()) == expected
@@ -0,0 +1,33 @@
+# tokens.py
+
+import os
+from functools import lru_cache
+from typing import Optional
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def _encoding(name: str):
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        # tiktoken downloads its BPE files on first use; offline boxes fall back to an estimate
+        return None
+
+
+def count_tokens(text: str, encoding: Optional[str] = None) -> int:
+    enc = _encoding(encoding or TOKEN_ENCODING)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, encoding: Optional[str] = None) -> str:
+    enc = _encoding(encoding or TOKEN_ENCODING)
+    if enc is None:
+        return text[: max_tokens * 4]
+    ids = enc.encode(text, disallowed_special=())
+    return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
@@ -1,28 +1,212 @@
 # tools.py
+#
+# Retrieval tools for the research agent.
+#
+# Vector search is batched: `search_many` embeds every query in one forward pass and sends
+# them to Qdrant as one batch request, so query variants cost one round-trip. Each search
+# can take a payload filter, a score threshold and the payload fields to return, and
+# `search_fused` merges the rankings of several variants by reciprocal-rank fusion.
+#
+# Graph lookups go through graph_client.GraphClient: parameterized (ideally registered)
+# queries in read transactions, with `stream_graph` for pulls too large to hold at once.
+# `expand_with_graph` adds each vector hit's email context (sender, thread, the message
+# it replies to) and its thread neighbours, for all hits in one UNWIND query.
+
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
-from typing import List, Dict, Any
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from neo4j import Driver
+from neo4j.exceptions import DriverError, Neo4jError
+
+from graph_client import GraphClient, queries
+from tracing import tracer
+
+DEFAULT_COLLECTION = os.getenv("QDRANT_COLLECTION", "JBAF_LAW_doc_chunks")
+RRF_K = 60      # rank constant from the original RRF paper; damps the weight of the top ranks
+GRAPH_NEIGHBORS = int(os.getenv("GRAPH_NEIGHBORS", "5"))    # neighbour chunks per hit; 0 turns expansion off
+
+# (:Chunk {id})-[:PART_OF]->(:Email {id, subject})-[:SENT_BY]->(:Person {email}),
+# (:Email)-[:REPLY_TO]->(:Email) and (:Email)-[:IN_THREAD]->(:Thread {id}). Register a
+# query under the same name to map a different schema onto the same columns.
+queries.register("chunk_neighborhood", """
+UNWIND $chunk_ids AS chunk_id
+MATCH (c:Chunk {id: chunk_id})-[:PART_OF]->(e:Email)
+OPTIONAL MATCH (e)-[:SENT_BY]->(sender:Person)
+OPTIONAL MATCH (e)-[:REPLY_TO]->(parent:Email)
+OPTIONAL MATCH (e)-[:IN_THREAD]->(thread:Thread)
+OPTIONAL MATCH (parent)<-[:PART_OF]-(parent_chunk:Chunk)
+WITH chunk_id, c, e, sender, parent, thread, collect(DISTINCT parent_chunk) AS parent_chunks
+OPTIONAL MATCH (thread)<-[:IN_THREAD]-(:Email)<-[:PART_OF]-(thread_chunk:Chunk)
+WHERE thread_chunk <> c
+WITH chunk_id, e, sender, parent, thread, parent_chunks, collect(DISTINCT thread_chunk) AS thread_chunks
+RETURN chunk_id, e.id AS email_id, e.subject AS subject, sender.email AS sender,
+       parent.id AS reply_to, thread.id AS thread_id,
+       [n IN (parent_chunks + thread_chunks)[..$per_chunk] | properties(n)] AS neighbors
+""")
+
+# {"thread_id": "t-1"}, {"sender": ["a@x", "b@x"]}, {"date": {"gte": "2024-01-01"}}, or a models.Filter
+PayloadFilter = Union[models.Filter, Dict[str, Any], None]
+_RANGE_KEYS = {"gt", "gte", "lt", "lte"}
+
+
+def payload_filter(conditions: PayloadFilter) -> Optional[models.Filter]:
+    """
+    A Qdrant filter from field -> value conditions (all must hold): a list matches any of
+    its values, a dict of gt/gte/lt/lte is a range.
+    """
+    if conditions is None or isinstance(conditions, models.Filter):
+        return conditions
+    must = []
+    for key, value in conditions.items():
+        if isinstance(value, dict) and set(value) <= _RANGE_KEYS:
+            if all(isinstance(v, (int, float)) for v in value.values()):
+                must.append(models.FieldCondition(key=key, range=models.Range(**value)))
+            else:
+                must.append(models.FieldCondition(key=key, range=models.DatetimeRange(**value)))
+        elif isinstance(value, (list, tuple, set)):
+            must.append(models.FieldCondition(key=key, match=models.MatchAny(any=list(value))))
+        else:
+            must.append(models.FieldCondition(key=key, match=models.MatchValue(value=value)))
+    return models.Filter(must=must)
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[Any]], k: int = RRF_K) -> List[Tuple[Any, float]]:
+    """Fuse ranked id lists: each id scores sum(1 / (k + rank)) over the lists it appears in."""
+    scores: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda kv: -kv[1])
+
+
+def chunk_key(hit: Dict[str, Any]) -> Any:
+    """The id a hit is known by in the graph: its payload "id" / "chunk_id", else the point id."""
+    for key in ("id", "chunk_id", "_id"):
+        if hit.get(key) is not None:
+            return hit[key]
+    return None
+
+
+def _hit(point: models.ScoredPoint, with_scores: bool) -> Dict[str, Any]:
+    payload = dict(point.payload or {})
+    if with_scores:
+        payload["_id"] = point.id
+        payload["_score"] = point.score
+    return payload
+
 
 class ResearchTools:
-    def __init__(self, qdrant_driver: QdrantClient, graph_driver: Driver):
+    def __init__(self, qdrant_driver: QdrantClient, graph_driver: Optional[Driver], collection: str = DEFAULT_COLLECTION):
         self.qdrant = qdrant_driver
         self.graph = graph_driver
+        self.graph_client = GraphClient.from_env(graph_driver) if graph_driver is not None else None
+        self.collection = collection
+
+    def _graph(self) -> GraphClient:
+        if self.graph_client is None:
+            raise RuntimeError("ResearchTools was created without a graph driver")
+        return self.graph_client
 
-    def search_vector_db(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    def _query_batch(self, queries: List[str], top_k: int, filter: PayloadFilter, score_threshold: Optional[float],
+                     fields: Optional[List[str]]) -> List[List[models.ScoredPoint]]:
         from llm import get_embedding
 
-        query_vector = get_embedding(query)[0]
-        search_result = self.qdrant.search(
-            collection_name="JBAF_LAW_doc_chunks",
-            query_vector=query_vector,
-            limit=top_k,
-            with_payload=True
-        )
-        return [point.payload for point in search_result]
-
-    def search_graph(self, cypher_query: str) -> List[Dict[str, Any]]:
-        with self.graph.session() as session:
-            result = session.run(cypher_query)
-            return [record.data() for record in result]
+        if not queries:
+            return []
+        # one forward pass for every query
+        vectors = get_embedding(list(queries))
+        query_filter = payload_filter(filter)
+        requests = [
+            models.QueryRequest(query=vector, limit=top_k, filter=query_filter, score_threshold=score_threshold,
+                                with_payload=list(fields) if fields is not None else True)
+            for vector in vectors
+        ]
+        with tracer.span("qdrant.query_batch_points", "qdrant", queries=len(requests), top_k=top_k):
+            responses = self.qdrant.query_batch_points(collection_name=self.collection, requests=requests)
+        return [response.points for response in responses]
+
+    def search_many(self, queries: List[str], top_k: int = 5, filter: PayloadFilter = None,
+                    score_threshold: Optional[float] = None, fields: Optional[List[str]] = None,
+                    with_scores: bool = False) -> List[List[Dict[str, Any]]]:
+        """
+        Top-k payloads for each query, in one embedding pass and one Qdrant round-trip.
+        `fields` limits the returned payload keys; `with_scores` adds "_id" and "_score".
+        """
+        return [[_hit(point, with_scores) for point in points]
+                for points in self._query_batch(queries, top_k, filter, score_threshold, fields)]
+
+    def search_vector_db(self, query: str, top_k: int = 5, filter: PayloadFilter = None,
+                         score_threshold: Optional[float] = None, fields: Optional[List[str]] = None,
+                         with_scores: bool = False) -> List[Dict[str, Any]]:
+        return self.search_many([query], top_k, filter, score_threshold, fields, with_scores)[0]
+
+    def search_fused(self, queries: List[str], top_k: int = 5, per_query: Optional[int] = None,
+                     filter: PayloadFilter = None, score_threshold: Optional[float] = None,
+                     fields: Optional[List[str]] = None, with_scores: bool = False,
+                     rrf_k: int = RRF_K) -> List[Dict[str, Any]]:
+        """
+        Search a query and its expansions in one batch and merge the rankings by
+        reciprocal-rank fusion; with `with_scores`, "_score" is the fused score.
+        """
+        results = self._query_batch(queries, per_query or top_k * 2, filter, score_threshold, fields)
+        points = {point.id: point for ranking in results for point in ranking}
+        fused = reciprocal_rank_fusion([[point.id for point in ranking] for ranking in results], k=rrf_k)
+        hits = []
+        for point_id, score in fused[:top_k]:
+            hit = _hit(points[point_id], with_scores)
+            if with_scores:
+                hit["_score"] = score
+            hits.append(hit)
+        return hits
+
+    def search_graph(self, query: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Records of a registered graph query (graph_client.queries) or parameterized Cypher."""
+        return self._graph().read(query, params)
+
+    def expand_with_graph(self, hits: List[Dict[str, Any]], per_chunk: int = GRAPH_NEIGHBORS) -> List[Dict[str, Any]]:
+        """
+        Vector hits with their graph context, followed by their neighbour chunks.
+
+        Each hit gains "email_id", "subject", "sender", "thread_id" and "reply_to" (the id
+        of the email it answers, None when it answers nothing) without overwriting payload
+        fields. Neighbours (chunks of the parent email, then of the rest of the thread) come
+        after all the hits, in hit order, each marked with the hit it was reached from
+        ("_neighbor_of"); chunks already present are not repeated. Without a graph, or if
+        the graph can't be reached, the hits come back as they were.
+        """
+        ids = [key for key in (chunk_key(hit) for hit in hits) if key is not None]
+        if self.graph_client is None or not ids or per_chunk <= 0:
+            return hits
+        try:
+            rows = self.graph_client.read("chunk_neighborhood", {"chunk_ids": ids, "per_chunk": per_chunk})
+        except (DriverError, Neo4jError) as e:
+            print(f"⚠️  Graph expansion skipped: {e}")
+            return hits
+
+        context = {row["chunk_id"]: row for row in rows}
+        seen = set(ids)
+        expanded, neighbors = [], []
+        for hit in hits:
+            key = chunk_key(hit)
+            row = context.get(key)
+            if row is None:
+                expanded.append(hit)
+                continue
+            hit = dict(hit)
+            for field in ("email_id", "subject", "sender", "thread_id", "reply_to"):
+                hit.setdefault(field, row.get(field))
+            expanded.append(hit)
+            for neighbor in row.get("neighbors") or []:
+                neighbor_key = chunk_key(neighbor) or neighbor.get("text")
+                if neighbor_key in seen:
+                    continue
+                seen.add(neighbor_key)
+                neighbors.append({"thread_id": row.get("thread_id"), **neighbor, "_neighbor_of": key})
+        return expanded + neighbors
+
+    def stream_graph(self, query: str, params: Optional[Dict[str, Any]] = None,
+                     fetch_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        """`search_graph` for large pulls: records arrive in batches of one server fetch."""
+        return self._graph().stream_batches(query, params, fetch_size)
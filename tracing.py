@@ -0,0 +1,445 @@
+# tracing.py
+#
+# Spans for graph nodes and for the LLM, embedding, Qdrant and Neo4j calls they make.
+#
+# Every span records wall time, time spent queued for a concurrency slot, prompt /
+# completion tokens, cache hits and retries, tagged with the session and SOP step it ran
+# for. Nodes are wrapped with `trace_node`, which takes the session and step from the
+# graph state; anything called inside a node (or inside `session_scope`) inherits them,
+# including calls fanned out to LLMClient's pool.
+#
+# Finished spans go to the sinks listed in TRACE_SINKS (comma separated):
+#   memory  MemoryAggregator: per-stage percentiles and totals, per-session/step breakdown
+#   jsonl   one JSON line per span, appended to TRACE_JSONL_PATH
+#   otel    OpenTelemetry spans (needs opentelemetry-sdk; exported over OTLP when
+#           OTEL_EXPORTER_OTLP_ENDPOINT is set, otherwise to whatever provider the app set up)
+# An empty TRACE_SINKS turns tracing off; spans are then not even created.
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACE_SINKS = os.getenv("TRACE_SINKS", "memory")
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", ".cache/traces.jsonl")
+TRACE_SAMPLE_SIZE = int(os.getenv("TRACE_SAMPLE_SIZE", "10000"))
+TRACE_MAX_SESSIONS = int(os.getenv("TRACE_MAX_SESSIONS", "1000"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "llm_sop_simulation")
+
+
+@dataclass
+class Span:
+    name: str
+    kind: str                               # node | llm | embedding | qdrant | neo4j
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    session_id: Optional[str] = None
+    step: Optional[int] = None
+    start: float = 0.0                      # epoch seconds
+    wall_ms: float = 0.0
+    queue_ms: float = 0.0                   # waiting for a concurrency slot
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hit: Optional[bool] = None        # None: no cache was consulted
+    retries: int = 0
+    error: Optional[str] = None
+    attrs: Dict[str, Any] = field(default_factory=dict)
+    _t0: float = field(default=0.0, repr=False)
+
+    def add_tokens(self, prompt: Optional[int], completion: Optional[int]) -> None:
+        self.prompt_tokens += prompt or 0
+        self.completion_tokens += completion or 0
+
+    def add_usage(self, message: Any) -> None:
+        """Token counts from a LangChain message's usage_metadata, if it has any."""
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            self.add_tokens(usage.get("input_tokens"), usage.get("output_tokens"))
+
+    def as_dict(self) -> Dict[str, Any]:
+        out = asdict(self)
+        del out["_t0"]
+        return out
+
+
+class Sink:
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def emit(self, span: Span) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JSONLSink(Sink):
+    def __init__(self, path: str = TRACE_JSONL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def emit(self, span: Span) -> None:
+        line = json.dumps(span.as_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class _Totals:
+    __slots__ = ("kind", "count", "errors", "wall_ms", "queue_ms", "prompt_tokens", "completion_tokens",
+                 "cache_lookups", "cache_hits", "retries", "samples")
+
+    def __init__(self, kind: str, sample_size: int = 0):
+        self.kind = kind
+        self.count = self.errors = self.prompt_tokens = self.completion_tokens = 0
+        self.cache_lookups = self.cache_hits = self.retries = 0
+        self.wall_ms = self.queue_ms = 0.0
+        self.samples: Optional[Deque[float]] = deque(maxlen=sample_size) if sample_size else None
+
+    def add(self, span: Span) -> None:
+        self.count += 1
+        self.errors += span.error is not None
+        self.wall_ms += span.wall_ms
+        self.queue_ms += span.queue_ms
+        self.prompt_tokens += span.prompt_tokens
+        self.completion_tokens += span.completion_tokens
+        self.retries += span.retries
+        if span.cache_hit is not None:
+            self.cache_lookups += 1
+            self.cache_hits += span.cache_hit
+        if self.samples is not None:
+            self.samples.append(span.wall_ms)
+
+    def as_dict(self) -> Dict[str, Any]:
+        out = {
+            "kind": self.kind,
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.wall_ms, 3),
+            "queue_ms": round(self.queue_ms, 3),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit_rate": round(self.cache_hits / self.cache_lookups, 4) if self.cache_lookups else None,
+            "retries": self.retries,
+        }
+        if self.samples:
+            values = np.asarray(self.samples)
+            out.update({f"p{q}_ms": round(float(np.percentile(values, q)), 3) for q in (50, 95, 99)})
+        return out
+
+
+class MemoryAggregator(Sink):
+    """
+    Running totals per stage (span name), and per session and step. Latency percentiles
+    come from the last TRACE_SAMPLE_SIZE spans of each stage; only the most recent
+    TRACE_MAX_SESSIONS sessions are kept.
+    """
+
+    def __init__(self, sample_size: int = TRACE_SAMPLE_SIZE, max_sessions: int = TRACE_MAX_SESSIONS):
+        self.sample_size = sample_size
+        self.max_sessions = max_sessions
+        self._stages: Dict[str, _Totals] = {}
+        self._sessions: "OrderedDict[str, Dict[Optional[int], Dict[str, _Totals]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def emit(self, span: Span) -> None:
+        with self._lock:
+            stage = self._stages.get(span.name)
+            if stage is None:
+                stage = self._stages[span.name] = _Totals(span.kind, self.sample_size)
+            stage.add(span)
+            if span.session_id is None:
+                return
+            steps = self._sessions.get(span.session_id)
+            if steps is None:
+                steps = self._sessions[span.session_id] = defaultdict(dict)
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            per_step = steps[span.step]
+            totals = per_step.get(span.name)
+            if totals is None:
+                totals = per_step[span.name] = _Totals(span.kind)
+            totals.add(span)
+
+    def stages(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: totals.as_dict() for name, totals in sorted(self._stages.items())}
+
+    def turn_breakdown(self) -> Dict[str, float]:
+        """Share of total node time spent in each node, largest first."""
+        with self._lock:
+            nodes = {name: t.wall_ms for name, t in self._stages.items() if t.kind == "node"}
+        total = sum(nodes.values())
+        return {name: round(ms / total, 4) for name, ms in sorted(nodes.items(), key=lambda kv: -kv[1])} if total else {}
+
+    def session(self, session_id: str) -> Dict[Optional[int], Dict[str, Dict[str, Any]]]:
+        with self._lock:
+            steps = self._sessions.get(session_id, {})
+            return {step: {name: t.as_dict() for name, t in per_step.items()} for step, per_step in steps.items()}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"stages": self.stages(), "turn_breakdown": self.turn_breakdown()}
+
+    def drop_session(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages.clear()
+            self._sessions.clear()
+
+
+class OpenTelemetrySink(Sink):
+    """Mirrors spans into OpenTelemetry, keeping the parent / child structure."""
+
+    def __init__(self, service_name: str = TRACE_SERVICE_NAME):
+        from opentelemetry import trace
+
+        if os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+            provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+            trace.set_tracer_provider(provider)
+        self._trace = trace
+        self._tracer = trace.get_tracer(service_name)
+        self._open: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, span: Span) -> None:
+        with self._lock:
+            parent = self._open.get(span.parent_id) if span.parent_id else None
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self._tracer.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+        with self._lock:
+            self._open[span.span_id] = otel_span
+
+    def emit(self, span: Span) -> None:
+        with self._lock:
+            otel_span = self._open.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        attributes = {
+            "kind": span.kind,
+            "session_id": span.session_id or "",
+            "step": span.step if span.step is not None else -1,
+            "queue_ms": span.queue_ms,
+            "prompt_tokens": span.prompt_tokens,
+            "completion_tokens": span.completion_tokens,
+            "retries": span.retries,
+        }
+        if span.cache_hit is not None:
+            attributes["cache_hit"] = span.cache_hit
+        attributes.update({k: v for k, v in span.attrs.items() if isinstance(v, (str, bool, int, float))})
+        otel_span.set_attributes(attributes)
+        if span.error is not None:
+            from opentelemetry.trace import Status, StatusCode
+            otel_span.set_status(Status(StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int((span.start + span.wall_ms / 1000) * 1e9))
+
+
+SINKS: Dict[str, Callable[[], Sink]] = {
+    "memory": MemoryAggregator,
+    "jsonl": JSONLSink,
+    "otel": OpenTelemetrySink,
+}
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+_session: contextvars.ContextVar[Tuple[Optional[str], Optional[int]]] = contextvars.ContextVar(
+    "trace_session", default=(None, None))
+
+
+def _bubble_up() -> Tuple[type, ...]:
+    # interrupts and parent commands are control flow in LangGraph, not failures
+    try:
+        from langgraph.errors import GraphBubbleUp
+        return (GraphBubbleUp,)
+    except ImportError:
+        return ()
+
+
+class Tracer:
+    def __init__(self, sinks: Optional[List[Sink]] = None):
+        self.sinks: List[Sink] = list(sinks or [])
+        self._control_flow = _bubble_up()
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        names = [name.strip() for name in TRACE_SINKS.split(",") if name.strip()]
+        sinks = []
+        for name in names:
+            try:
+                sinks.append(SINKS[name]())
+            except ImportError as e:
+                print(f"⚠️  Trace sink {name!r} disabled: {e}")
+        return cls(sinks)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks)
+
+    def add_sink(self, sink: Sink) -> Sink:
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink: Sink) -> None:
+        self.sinks.remove(sink)
+
+    def sink(self, kind: type) -> Optional[Sink]:
+        return next((s for s in self.sinks if isinstance(s, kind)), None)
+
+    def start(self, name: str, kind: str, **attrs: Any) -> Optional[Span]:
+        """A started span that is not made current; finish it with `end`. None when tracing is off."""
+        if not self.sinks:
+            return None
+        parent = _current.get()
+        session_id, step = _session.get()
+        span_id = uuid.uuid4().hex[:16]
+        span = Span(name=name, kind=kind, trace_id=parent.trace_id if parent else (session_id or span_id),
+                    span_id=span_id, parent_id=parent.span_id if parent else None,
+                    session_id=session_id, step=step, start=time.time(), attrs=attrs, _t0=time.perf_counter())
+        for sink in self.sinks:
+            sink.on_start(span)
+        return span
+
+    def end(self, span: Optional[Span], error: Optional[BaseException] = None) -> None:
+        if span is None:
+            return
+        span.wall_ms = (time.perf_counter() - span._t0) * 1000
+        if error is not None:
+            if isinstance(error, self._control_flow):
+                span.attrs["interrupted"] = True
+            else:
+                span.error = f"{type(error).__name__}: {error}"
+        for sink in self.sinks:
+            try:
+                sink.emit(span)
+            except Exception as e:
+                print(f"⚠️  Trace sink {type(sink).__name__} failed: {e}")
+
+    @contextlib.contextmanager
+    def span(self, name: str, kind: str, **attrs: Any) -> Iterator[Optional[Span]]:
+        """Time the block as a span, current for everything called inside it."""
+        span = self.start(name, kind, **attrs)
+        if span is None:
+            yield None
+            return
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, e)
+            raise
+        else:
+            self.end(span)
+        finally:
+            _current.reset(token)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+
+tracer = Tracer.from_env()
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def span(name: str, kind: str, **attrs: Any):
+    return tracer.span(name, kind, **attrs)
+
+
+@contextlib.contextmanager
+def session_scope(session_id: Optional[str], step: Optional[int] = None) -> Iterator[None]:
+    """Tag every span started inside the block with this session and step."""
+    token = _session.set((session_id, step))
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def traced(name: str, kind: str) -> Callable[[Callable], Callable]:
+    """Decorator: run every call of the function (sync or async) inside a span."""
+    def decorate(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with tracer.span(name, kind):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with tracer.span(name, kind):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def state_session(state: Any) -> Tuple[Optional[str], Optional[int]]:
+    """Session and step of a graph state: referee states carry conversation_id / current_step."""
+    if not isinstance(state, dict):
+        return None, None
+    return state.get("conversation_id") or state.get("session_id"), state.get("current_step")
+
+
+def trace_node(name: str, fn: Callable, graph: Optional[str] = None) -> Callable:
+    """
+    Wrap a LangGraph node function: the node runs in a "node" span tagged with the
+    session and step of its input state. The signature is kept, so nodes that take
+    `config` still get it; coroutine nodes get an async wrapper.
+    """
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def anode(state: Any, *args: Any, **kwargs: Any) -> Any:
+            session_id, step = state_session(state)
+            if session_id is None:
+                session_id, step = _session.get()
+            with session_scope(session_id, step), tracer.span(name, "node", graph=graph):
+                return await fn(state, *args, **kwargs)
+        return anode
+
+    @functools.wraps(fn)
+    def node(state: Any, *args: Any, **kwargs: Any) -> Any:
+        session_id, step = state_session(state)
+        if session_id is None:
+            session_id, step = _session.get()
+        with session_scope(session_id, step), tracer.span(name, "node", graph=graph):
+            return fn(state, *args, **kwargs)
+    return node
+
+
+def aggregator() -> Optional[MemoryAggregator]:
+    """The in-memory aggregator, when the "memory" sink is on."""
+    return tracer.sink(MemoryAggregator)
+
+
+def snapshot() -> Optional[Dict[str, Any]]:
+    memory = aggregator()
+    return memory.snapshot() if memory is not None else None
@@ -4,43 +4,64 @@ from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langchain_core.runnables import RunnableLambda
 from typing import Dict,List
+import os
+import uuid
 
-from llm import evaluate_customer_response , get_customer_reply
+from conversation import HISTORY_TOKEN_BUDGETS, ConversationLog, HistoryWindow, Message
+from llm import chat_with_llm, get_customer_reply
+from sop import load_sop
+from step_evaluator import StepCheckpoint, StepEvaluator
+from tracing import session_scope, trace_node
+
+TRAINING_SOP = os.getenv("TRAINING_SOP", "sample_simulations/SOP145.json")
+
+def print_token(token: str) -> None:
+    print(token, end="", flush=True)
+
+def stream_customer_reply(history: HistoryWindow) -> str:
+    print("🧑 Customer: ", end="", flush=True)
+    customer_reply = get_customer_reply(history, on_token=print_token)
+    print()
+    return customer_reply
 
 # === Agent Function ===
 def simulate_customer_interaction(state: dict) -> dict:
-    history: List[Dict[str, str]] = []
+    sop = load_sop(state.get("sop_path", TRAINING_SOP))
+    evaluator = StepEvaluator(sop.sop_id)
+    # what the trainee has already satisfied; resumed from the state when present
+    checkpoint = StepCheckpoint.from_dict(state["checkpoint"]) if state.get("checkpoint") else StepCheckpoint(sop.sop_id)
+
+    log = ConversationLog()
+    # prompts see the recent turns verbatim and a rolling summary of the older ones
+    history = HistoryWindow(log, HISTORY_TOKEN_BUDGETS["customer"], summarize=chat_with_llm)
 
     # Initial customer message
     initial_customer = "Hello, I need to return my order. Can you help?"
     print(f"🧑 Customer: {initial_customer}")
-    history.append({"role": "user", "content": initial_customer})
-
-    while True:
-        user_input = input("💬 Your response: ")
-        history.append({"role": "assistant", "content": user_input})
-
-        feedback = evaluate_customer_response(history)
-        print("🤖 Feedback:", feedback["feedback"])
-
-        if feedback.get("complete"):
-            break
-
-        if feedback.get("passed"):
-            customer_reply = get_customer_reply(history)
-            print(f"🧑 Customer: {customer_reply}")
-            history.append({"role": "user", "content": customer_reply})
-        else:
-            step = feedback.get("step")
-            if step:
-                print("⚠️ Please revise your response to meet the current SOP step. ("+step+")")
-            else:
-                print("⚠️ Please revise your response to meet the current SOP step. (Unknown step)")
-
-        # Generate next customer reply based on updated history
-        customer_reply = get_customer_reply(history)
-        print(f"🧑 Customer: {customer_reply}")
-        history.append({"role": "user", "content": customer_reply})
+    log.append(Message("user", initial_customer))
+
+    session_id = state.setdefault("session_id", uuid.uuid4().hex)
+    while not checkpoint.complete(sop):
+        # spans of this turn's LLM calls are tagged with the session and SOP step (tracing.py)
+        with session_scope(session_id, checkpoint.current_step(sop)):
+            customer_message = log.last().content
+            user_input = input("💬 Your response: ")
+            log.append(Message("assistant", user_input))
+
+            # only the new message is graded, against the steps still outstanding
+            feedback = evaluator.evaluate(checkpoint, customer_message, user_input)
+            state["checkpoint"] = checkpoint.as_dict()
+            print("🤖 Feedback:", feedback["feedback"])
+
+            if feedback["complete"]:
+                break
+
+            if not feedback["passed"]:
+                print("⚠️ Please revise your response to meet the current SOP step. ("+feedback["step"]+")")
+
+            # exactly one customer reply per turn
+            customer_reply = stream_customer_reply(history)
+            log.append(Message("user", customer_reply))
 
     return state
 
@@ -48,7 +69,7 @@ def simulate_customer_interaction(state: dict) -> dict:
 def create_graph():
     builder = StateGraph(dict)
 
-    builder.add_node("simulate_customer_interaction", RunnableLambda(simulate_customer_interaction))
+    builder.add_node("simulate_customer_interaction", RunnableLambda(trace_node("simulate_customer_interaction", simulate_customer_interaction, graph="training")))
     builder.set_entry_point("simulate_customer_interaction")
     builder.add_edge("simulate_customer_interaction", END)
 
@@ -57,7 +78,7 @@ def create_graph():
 # === Entrypoint ===
 if __name__ == "__main__":
     user_query = "Handle missing order inquiry."
-    initial_state = {"query": user_query}
+    initial_state = {"query": user_query, "sop_path": TRAINING_SOP}
 
     graph = create_graph()
     final_state: dict = graph.invoke(initial_state)
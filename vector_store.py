@@ -0,0 +1,709 @@
+# vector_store.py
+#
+# Embedded vector store, for dev boxes and CI runners without a Qdrant server.
+#
+# LocalVectorStore answers the part of the QdrantClient API that ingest.py, tools.py and
+# benchmark.py use (create_collection, upload_collection, query_points, query_batch_points),
+# so it drops in for drivers.qdrant_driver with VECTOR_STORE=local. Each collection is a
+# directory under LOCAL_VECTOR_PATH:
+#
+#   meta.json        dimension, distance, dtype, row count and index state
+#   vectors.<dtype>  memory-mapped row matrix: float32, or int8 with one scale per row in scales.f32
+#   payloads.jsonl   append-only payload sidecar; offsets.i64 holds each row's (start, length)
+#   ids.jsonl        point id per row, read back to map ids to rows when a point is re-uploaded
+#   ivf_*.npy        the IVF index; ivf_stale.npy lists indexed rows overwritten since the build
+#
+# Search is exact, vectorized NumPy top-k over the matrix, a block at a time so an int8
+# matrix is never dequantized whole. Past LOCAL_VECTOR_IVF_MIN rows an IVF index (k-means
+# lists over the rows, LOCAL_VECTOR_NPROBE lists scanned per query) narrows the scan to a
+# few percent of the rows. Rows appended or overwritten after the index was built sit outside
+# their list, so they are scanned exactly. Once they add up to a quarter of the index it is
+# due a rebuild: searches scan exactly until it is done, and it is built by the writer, after
+# upload_collection (or with the command below), never by a search. The k-means pass runs
+# outside the collection lock, so searches and writes carry on while it does.
+#
+# Filtered queries are exact over the rows that match. Match conditions in `must` are
+# narrowed through an in-memory field -> rows index, built the first time a field is filtered
+# on and kept up to date by upserts; the rest of the filter is checked on those rows only.
+#
+# Upserts write rows and sidecars straight away; meta.json (the row count) is written by
+# flush(), which upload_collection and close call once per call rather than per batch.
+#
+#   python vector_store.py build-index JBAF_LAW_doc_chunks
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from qdrant_client.http import models
+
+load_dotenv()
+
+DEFAULT_PATH = ".cache/vectors"
+DTYPES = {"float32": np.float32, "int8": np.int8}
+_BLOCK_ROWS = 65536
+_MIN_CAPACITY = 1024
+_REINDEX_RATIO = 0.25       # rebuild the IVF index once appended + overwritten rows are this share of it
+_MISSING = object()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+# ====================  filters  ====================
+
+def _lookup(payload: Dict[str, Any], key: str) -> Any:
+    value: Any = payload
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _as_datetime(value: Any) -> Optional[datetime]:
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _in_range(value: Any, bounds: Any) -> bool:
+    if isinstance(bounds, models.DatetimeRange):
+        value = _as_datetime(value)
+        convert = _as_datetime
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        convert = float
+    else:
+        return False
+    if value is None:
+        return False
+    checks = (("gt", lambda a, b: a > b), ("gte", lambda a, b: a >= b),
+              ("lt", lambda a, b: a < b), ("lte", lambda a, b: a <= b))
+    return all(getattr(bounds, name) is None or check(value, convert(getattr(bounds, name)))
+               for name, check in checks)
+
+
+def _condition_matches(condition: Any, point_id: Any, payload: Dict[str, Any]) -> bool:
+    if isinstance(condition, models.Filter):
+        return filter_matches(condition, point_id, payload)
+    if isinstance(condition, models.HasIdCondition):
+        return point_id in condition.has_id
+    if isinstance(condition, models.FieldCondition):
+        value = _lookup(payload, condition.key)
+        if value is _MISSING:
+            return False
+        # as in Qdrant, a condition on an array field holds if any element satisfies it
+        values = value if isinstance(value, list) else [value]
+        match = condition.match
+        if isinstance(match, models.MatchValue):
+            return match.value in values
+        if isinstance(match, models.MatchAny):
+            return any(v in match.any for v in values)
+        if isinstance(match, models.MatchExcept):
+            return not any(v in match.except_ for v in values)
+        if isinstance(match, models.MatchText):
+            return any(isinstance(v, str) and match.text in v for v in values)
+        if match is None and condition.range is not None:
+            return any(_in_range(v, condition.range) for v in values)
+    raise ValueError(f"Filter condition not supported by the local vector store: {condition!r}")
+
+
+def _as_list(conditions: Any) -> List[Any]:
+    if conditions is None:
+        return []
+    return conditions if isinstance(conditions, list) else [conditions]
+
+
+def _index_values(payload: Dict[str, Any], key: str) -> List[Any]:
+    """The values a field index files this payload under: the field's value, or each element of an array."""
+    value = _lookup(payload, key)
+    if value is _MISSING:
+        return []
+    values = value if isinstance(value, list) else [value]
+    return [v for v in values if not isinstance(v, (dict, list))]
+
+
+def _indexed_condition(condition: Any) -> Optional[Tuple[str, List[Any]]]:
+    """(field, values) of a condition the field index can answer: it holds for rows filed under any of the values."""
+    if isinstance(condition, models.FieldCondition):
+        if isinstance(condition.match, models.MatchValue):
+            return condition.key, [condition.match.value]
+        if isinstance(condition.match, models.MatchAny):
+            return condition.key, list(condition.match.any)
+    return None
+
+
+def filter_matches(query_filter: models.Filter, point_id: Any, payload: Dict[str, Any]) -> bool:
+    """Evaluate a Qdrant filter (must / should / must_not) against one point."""
+    should = _as_list(query_filter.should)
+    return (all(_condition_matches(c, point_id, payload) for c in _as_list(query_filter.must))
+            and (not should or any(_condition_matches(c, point_id, payload) for c in should))
+            and not any(_condition_matches(c, point_id, payload) for c in _as_list(query_filter.must_not)))
+
+
+# ====================  collections  ====================
+
+class LocalCollection:
+    """One collection's memory-mapped rows, payload sidecar and optional IVF index."""
+
+    def __init__(self, path: str, ivf_min: int = 100_000, nprobe: int = 16):
+        self.path = path
+        self.ivf_min = ivf_min
+        self.nprobe = nprobe
+        with open(self._file("meta.json")) as f:
+            self.meta = json.load(f)
+        self.dim: int = self.meta["dim"]
+        self.cosine = self.meta["distance"] == models.Distance.COSINE
+        self.dtype = DTYPES[self.meta["dtype"]]
+        self._lock = threading.RLock()
+        self._ids: Optional[Dict[Any, int]] = None
+        self._payloads: Optional[List[Tuple[Any, Dict[str, Any]]]] = None
+        self._field_rows: Dict[str, Dict[Any, Set[int]]] = {}     # field -> value -> rows; needs _payloads
+        self._build_lock = threading.Lock()
+        self._building: Optional[Set[int]] = None                  # rows overwritten while an index builds
+        self._open_arrays()
+        self._load_index()
+
+    @classmethod
+    def create(cls, path: str, dim: int, distance: str, dtype: str = "float32", **kwargs: Any) -> "LocalCollection":
+        if distance not in (models.Distance.COSINE, models.Distance.DOT):
+            raise ValueError(f"The local vector store supports Cosine and Dot distance, not {distance}")
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown vector dtype {dtype!r}; expected one of {sorted(DTYPES)}")
+        os.makedirs(path, exist_ok=True)
+        meta = {"dim": dim, "distance": str(distance.value if hasattr(distance, "value") else distance),
+                "dtype": dtype, "count": 0, "capacity": _MIN_CAPACITY, "index": None}
+        for name, width, itemsize in cls._layout(dim, dtype):
+            with open(os.path.join(path, name), "wb") as f:
+                f.truncate(_MIN_CAPACITY * width * itemsize)
+        for name in ("payloads.jsonl", "ids.jsonl"):
+            open(os.path.join(path, name), "wb").close()
+        cls._write_json(os.path.join(path, "meta.json"), meta)
+        return cls(path, **kwargs)
+
+    @staticmethod
+    def _layout(dim: int, dtype: str) -> List[Tuple[str, int, int]]:
+        layout = [(f"vectors.{dtype}", dim, np.dtype(DTYPES[dtype]).itemsize), ("offsets.i64", 2, 8)]
+        if dtype == "int8":
+            layout.append(("scales.f32", 1, 4))
+        return layout
+
+    @staticmethod
+    def _write_json(path: str, data: Dict[str, Any]) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def count(self) -> int:
+        return self.meta["count"]
+
+    # ----------------------------------------------------- storage
+
+    def _open_arrays(self) -> None:
+        capacity = self.meta["capacity"]
+        self._vectors = np.memmap(self._file(f"vectors.{self.meta['dtype']}"), dtype=self.dtype, mode="r+",
+                                  shape=(capacity, self.dim))
+        self._offsets = np.memmap(self._file("offsets.i64"), dtype=np.int64, mode="r+", shape=(capacity, 2))
+        self._scales = (np.memmap(self._file("scales.f32"), dtype=np.float32, mode="r+", shape=(capacity,))
+                        if self.dtype == np.int8 else None)
+
+    def _reserve(self, rows: int) -> None:
+        capacity = self.meta["capacity"]
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        self._flush()
+        for name, width, itemsize in self._layout(self.dim, self.meta["dtype"]):
+            with open(self._file(name), "r+b") as f:
+                f.truncate(capacity * width * itemsize)
+        self.meta["capacity"] = capacity
+        self._open_arrays()
+
+    def _flush(self) -> None:
+        for array in (self._vectors, self._offsets, self._scales):
+            if array is not None:
+                array.flush()
+
+    def _write_rows(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        if self._scales is None:
+            self._vectors[rows] = vectors
+            return
+        # symmetric per-row int8 quantization: row ≈ int8 values * scale
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        self._vectors[rows] = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        self._scales[rows] = scales
+
+    def _read_rows(self, rows: Any) -> np.ndarray:
+        """float32 copy of the rows selected by a slice or an index array."""
+        block = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            block *= self._scales[rows][:, None]
+        return block
+
+    def _id_index(self) -> Dict[Any, int]:
+        if self._ids is None:
+            ids, end = {}, 0
+            with open(self._file("ids.jsonl"), "r+b") as f:
+                for row, line in enumerate(f):
+                    if row == self.count:
+                        # ids of rows written after the last flush: drop them, or later rows would be misnumbered
+                        f.truncate(end)
+                        break
+                    ids[json.loads(line)] = row
+                    end += len(line)
+            self._ids = ids
+        return self._ids
+
+    def upsert(self, vectors: Any, payloads: Optional[Sequence[Dict[str, Any]]] = None,
+               ids: Optional[Sequence[Any]] = None) -> None:
+        """
+        Append new points and overwrite the rows of ids already stored. An overwritten row
+        may no longer belong to its IVF list, so it is scanned exactly until the next build.
+        The new row count is only persisted by flush().
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if self.cosine:
+            vectors = _normalize(vectors)
+        ids = [str(i) if isinstance(i, uuid.UUID) else i for i in (ids or [str(uuid.uuid4()) for _ in vectors])]
+        payloads = list(payloads) if payloads is not None else [{} for _ in vectors]
+        if not len(vectors) == len(ids) == len(payloads):
+            raise ValueError("vectors, payloads and ids must have the same length")
+        if not len(ids):
+            return
+
+        with self._lock:
+            index = self._id_index()
+            count = self.count
+            rows, new_ids = [], []
+            for point_id in ids:
+                row = index.get(point_id)
+                if row is None:
+                    row = index[point_id] = count + len(new_ids)
+                    new_ids.append(point_id)
+                rows.append(row)
+            rows = np.asarray(rows, dtype=np.int64)
+            self._reserve(count + len(new_ids))
+            self._write_rows(rows, vectors)
+            self._mark_stale(rows)
+
+            with open(self._file("payloads.jsonl"), "ab") as f:
+                start = f.tell()
+                lines = [json.dumps({"id": i, "payload": p}, ensure_ascii=False).encode("utf-8") + b"\n"
+                         for i, p in zip(ids, payloads)]
+                f.write(b"".join(lines))
+            for row, line in zip(rows, lines):
+                self._offsets[row] = (start, len(line))
+                start += len(line)
+            if new_ids:
+                with open(self._file("ids.jsonl"), "ab") as f:
+                    f.write(b"".join(json.dumps(i).encode("utf-8") + b"\n" for i in new_ids))
+
+            self.meta["count"] = count + len(new_ids)
+            if self._payloads is not None:
+                # read back from the sidecar lines, so the cache holds what a reload would
+                self._cache_payloads(rows, [json.loads(line)["payload"] for line in lines], ids)
+
+    def flush(self) -> None:
+        """Persist the rows, the row count and the stale rows; upload_collection and close call it."""
+        with self._lock:
+            self._flush()
+            self._write_json(self._file("meta.json"), self.meta)
+            if self.meta.get("index"):
+                self._save_stale()
+
+    def _cache_payloads(self, rows: np.ndarray, payloads: List[Dict[str, Any]], ids: List[Any]) -> None:
+        for row, payload, point_id in zip(rows.tolist(), payloads, ids):
+            old = self._payloads[row][1] if row < len(self._payloads) else None
+            for key, index in self._field_rows.items():
+                for value in _index_values(old, key) if old is not None else []:
+                    index.get(value, set()).discard(row)
+                for value in _index_values(payload, key):
+                    index.setdefault(value, set()).add(row)
+            if row < len(self._payloads):
+                self._payloads[row] = (point_id, payload)
+            else:
+                self._payloads.append((point_id, payload))
+
+    def points(self, rows: Sequence[int]) -> List[Tuple[Any, Dict[str, Any]]]:
+        """(id, payload) of each row, read from the sidecar."""
+        if self._payloads is not None:
+            return [self._payloads[row] for row in rows]
+        out = []
+        with open(self._file("payloads.jsonl"), "rb") as f:
+            for row in rows:
+                start, length = self._offsets[row]
+                f.seek(int(start))
+                record = json.loads(f.read(int(length)))
+                out.append((record["id"], record["payload"]))
+        return out
+
+    def _all_points(self, count: int) -> List[Tuple[Any, Dict[str, Any]]]:
+        # loaded once for filtering, then kept up to date by upserts
+        if self._payloads is None or len(self._payloads) < count:
+            self._payloads = self.points(range(count))
+            self._field_rows = {}
+        return self._payloads
+
+    def _field_index(self, key: str, count: int) -> Dict[Any, Set[int]]:
+        index = self._field_rows.get(key)
+        if index is None:
+            index = {}
+            for row, (_, payload) in enumerate(self._all_points(count)):
+                for value in _index_values(payload, key):
+                    index.setdefault(value, set()).add(row)
+            self._field_rows[key] = index
+        return index
+
+    def _filter_rows(self, query_filter: models.Filter, count: int) -> np.ndarray:
+        """Rows matching the filter: narrowed through the field index where `must` allows, then checked in full."""
+        points = self._all_points(count)
+        candidates: Optional[Set[int]] = None
+        for condition in _as_list(query_filter.must):
+            indexed = _indexed_condition(condition)
+            if indexed is None:
+                continue
+            key, values = indexed
+            index = self._field_index(key, count)
+            rows = set().union(*(index.get(value, ()) for value in values))
+            candidates = rows if candidates is None else candidates & rows
+        rows = range(count) if candidates is None else sorted(candidates)
+        return np.asarray([row for row in rows if filter_matches(query_filter, *points[row])], dtype=np.int64)
+
+    # ----------------------------------------------------- IVF index
+
+    def _load_index(self) -> None:
+        index = self.meta.get("index")
+        if not index:
+            self._centroids = self._lists = self._list_offsets = None
+            self._stale = np.empty(0, dtype=np.int64)
+            return
+        self._centroids = np.load(self._file("ivf_centroids.npy"))
+        self._lists = np.load(self._file("ivf_rows.npy"), mmap_mode="r")
+        self._list_offsets = np.load(self._file("ivf_offsets.npy"))
+        stale_path = self._file("ivf_stale.npy")
+        self._stale = np.load(stale_path) if os.path.exists(stale_path) else np.empty(0, dtype=np.int64)
+
+    def _mark_stale(self, rows: np.ndarray) -> None:
+        """Record overwritten rows the IVF index (or the one being built) filed under their old vectors."""
+        if self._building is not None:
+            self._building.update(rows.tolist())
+        index = self.meta.get("index")
+        if not index:
+            return
+        indexed = rows[rows < index["rows"]]
+        if len(indexed):
+            self._stale = np.union1d(self._stale, indexed)
+
+    def _save_stale(self) -> None:
+        if len(self._stale):
+            self._save_array("ivf_stale.npy", self._stale)
+        elif os.path.exists(self._file("ivf_stale.npy")):
+            os.remove(self._file("ivf_stale.npy"))
+
+    def _save_array(self, name: str, array: np.ndarray) -> None:
+        # written aside and renamed, so searches still probing the old (memory-mapped) file keep it
+        tmp_path = self._file(name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, self._file(name))
+
+    def _assign(self, rows: Any, total: int, centroids: np.ndarray) -> np.ndarray:
+        assignments = np.empty(total, dtype=np.int32)
+        for start in range(0, total, _BLOCK_ROWS // 4):
+            end = min(start + _BLOCK_ROWS // 4, total)
+            block = rows(start, end)
+            assignments[start:end] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    def build_index(self, nlist: Optional[int] = None, iterations: int = 10, seed: int = 0) -> None:
+        """
+        Cluster the rows into `nlist` lists (default sqrt(rows)) with spherical k-means,
+        trained on a sample of 64 rows per list, and store each list's rows contiguously.
+        Searches and upserts go on while it runs; rows overwritten meanwhile are marked stale.
+        """
+        with self._build_lock:
+            self._build(nlist, iterations, seed)
+
+    def refresh_index(self) -> bool:
+        """Build or rebuild the IVF index if it is due (and no build is running); True if it did."""
+        with self._lock:
+            if not self._index_due(self.count):
+                return False
+        if not self._build_lock.acquire(blocking=False):
+            return False
+        try:
+            self._build(None, 10, 0)
+        finally:
+            self._build_lock.release()
+        return True
+
+    def _build(self, nlist: Optional[int], iterations: int, seed: int) -> None:
+        with self._lock:
+            count = self.count
+            if count == 0:
+                return
+            self._building = set()
+        try:
+            nlist = max(1, min(nlist or int(np.sqrt(count)), count))
+            rng = np.random.default_rng(seed)
+            sample = self._read_rows(np.sort(rng.choice(count, size=min(count, nlist * 64), replace=False)))
+            centroids = _normalize(sample[rng.choice(len(sample), nlist, replace=False)])
+            for _ in range(iterations):
+                assignments = self._assign(lambda s, e: sample[s:e], len(sample), centroids)
+                order = np.argsort(assignments, kind="stable")
+                sizes = np.bincount(assignments, minlength=nlist)
+                starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+                nonempty = sizes > 0
+                sums = np.add.reduceat(sample[order], starts[nonempty], axis=0)
+                centroids[nonempty] = _normalize(sums)
+
+            # the files only ever grow, so rows below `count` read the same through any mapping
+            assignments = self._assign(lambda s, e: self._read_rows(slice(s, e)), count, centroids)
+            lists = np.argsort(assignments, kind="stable").astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))])
+            with self._lock:
+                self._save_array("ivf_centroids.npy", centroids.astype(np.float32))
+                self._save_array("ivf_rows.npy", lists)
+                self._save_array("ivf_offsets.npy", offsets)
+                self.meta["index"] = {"nlist": nlist, "rows": count}
+                self._write_json(self._file("meta.json"), self.meta)
+                self._load_index()
+                self._stale = np.asarray(sorted(row for row in self._building if row < count), dtype=np.int64)
+                self._save_stale()
+        finally:
+            with self._lock:
+                self._building = None
+
+    def _index_due(self, count: int) -> bool:
+        if not self.ivf_min or count < self.ivf_min:
+            return False
+        index = self.meta.get("index")
+        return not index or count - index["rows"] + len(self._stale) > index["rows"] * _REINDEX_RATIO
+
+    def _usable_index(self, count: int) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]]:
+        """(centroids, lists, list offsets, stale rows, indexed rows), or None while there is no index or it is due a rebuild."""
+        index = self.meta.get("index")
+        if not self.ivf_min or count < self.ivf_min or not index or self._index_due(count):
+            return None
+        return self._centroids, self._lists, self._list_offsets, self._stale, index["rows"]
+
+    # ----------------------------------------------------- search
+
+    def _scan(self, queries: np.ndarray, limit: int, count: int,
+              rows: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Exact top-`limit` (scores, rows) per query over `rows`, or over every row."""
+        best = [(np.empty(0, np.float32), np.empty(0, np.int64)) for _ in queries]
+        total = count if rows is None else len(rows)
+        for start in range(0, total, _BLOCK_ROWS):
+            end = min(start + _BLOCK_ROWS, total)
+            if rows is None:
+                block_rows = np.arange(start, end)
+                block = self._read_rows(slice(start, end))
+            else:
+                block_rows = rows[start:end]
+                block = self._read_rows(block_rows)
+            scores = block @ queries.T
+            for j in range(len(queries)):
+                top = _top_k(scores[:, j], limit)
+                merged_scores = np.concatenate([best[j][0], scores[top, j]])
+                merged_rows = np.concatenate([best[j][1], block_rows[top]])
+                keep = _top_k(merged_scores, limit)
+                best[j] = (merged_scores[keep], merged_rows[keep])
+        return best
+
+    def _probe(self, query: np.ndarray, limit: int, count: int, index: Tuple) -> Tuple[np.ndarray, np.ndarray]:
+        centroids, lists, list_offsets, stale, indexed = index
+        nearest = _top_k(centroids @ query, self.nprobe)
+        candidates = [lists[list_offsets[l]:list_offsets[l + 1]] for l in nearest]
+        candidates.append(np.arange(indexed, count))
+        candidates.append(stale)
+        # unique also sorts, so the memory map is read in file order
+        rows = np.unique(np.concatenate(candidates))
+        return self._scan(query[None, :], limit, count, rows)[0]
+
+    def search(self, queries: Any, limit: int, query_filter: Optional[models.Filter] = None
+               ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Top-`limit` (scores, rows) for each query vector, best first."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self.cosine:
+            queries = _normalize(queries)
+        with self._lock:
+            count = self.count
+            if query_filter is not None:
+                return self._scan(queries, limit, count, self._filter_rows(query_filter, count))
+            index = self._usable_index(count)
+        if index is not None:
+            return [self._probe(query, limit, count, index) for query in queries]
+        return self._scan(queries, limit, count)
+
+
+# ====================  client  ====================
+
+class LocalVectorStore:
+    """
+    Directory of LocalCollections behind the QdrantClient methods the repo calls.
+    Collections are created with the store's dtype; int8 stores a quarter of the bytes
+    at a small loss of score precision.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, dtype: str = "float32", ivf_min: int = 100_000, nprobe: int = 16):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown vector dtype {dtype!r}; expected one of {sorted(DTYPES)}")
+        self.path = path
+        self.dtype = dtype
+        self.ivf_min = ivf_min
+        self.nprobe = nprobe
+        self._collections: Dict[str, LocalCollection] = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, **overrides: Any) -> "LocalVectorStore":
+        settings = dict(
+            path=os.getenv("LOCAL_VECTOR_PATH", DEFAULT_PATH),
+            dtype=os.getenv("LOCAL_VECTOR_DTYPE", "float32"),
+            ivf_min=int(os.getenv("LOCAL_VECTOR_IVF_MIN", "100000")),
+            nprobe=int(os.getenv("LOCAL_VECTOR_NPROBE", "16")),
+        )
+        settings.update(overrides)
+        return cls(**settings)
+
+    def _dir(self, collection_name: str) -> str:
+        return os.path.join(self.path, collection_name)
+
+    def collection(self, collection_name: str) -> LocalCollection:
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            if collection is None:
+                if not self.collection_exists(collection_name):
+                    raise ValueError(f"Collection {collection_name} not found")
+                collection = LocalCollection(self._dir(collection_name), ivf_min=self.ivf_min, nprobe=self.nprobe)
+                self._collections[collection_name] = collection
+            return collection
+
+    def collection_exists(self, collection_name: str) -> bool:
+        return os.path.exists(os.path.join(self._dir(collection_name), "meta.json"))
+
+    def create_collection(self, collection_name: str, vectors_config: models.VectorParams, **kwargs: Any) -> bool:
+        with self._lock:
+            if self.collection_exists(collection_name):
+                raise ValueError(f"Collection {collection_name} already exists")
+            self._collections[collection_name] = LocalCollection.create(
+                self._dir(collection_name), vectors_config.size, vectors_config.distance, self.dtype,
+                ivf_min=self.ivf_min, nprobe=self.nprobe)
+        return True
+
+    def delete_collection(self, collection_name: str, **kwargs: Any) -> bool:
+        with self._lock:
+            self._collections.pop(collection_name, None)
+            if not self.collection_exists(collection_name):
+                return False
+            shutil.rmtree(self._dir(collection_name))
+        return True
+
+    def upload_collection(self, collection_name: str, vectors: Any, payload: Optional[Sequence[Dict[str, Any]]] = None,
+                          ids: Optional[Sequence[Any]] = None, batch_size: int = 64, **kwargs: Any) -> None:
+        collection = self.collection(collection_name)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        payload = list(payload) if payload is not None else None
+        ids = list(ids) if ids is not None else None
+        for start in range(0, len(vectors), max(batch_size, 1)):
+            end = start + max(batch_size, 1)
+            collection.upsert(vectors[start:end], payload[start:end] if payload is not None else None,
+                              ids[start:end] if ids is not None else None)
+        collection.flush()
+        collection.refresh_index()
+
+    def count(self, collection_name: str, **kwargs: Any) -> models.CountResult:
+        return models.CountResult(count=self.collection(collection_name).count)
+
+    def _responses(self, collection: LocalCollection, requests: List[models.QueryRequest]) -> List[models.QueryResponse]:
+        responses: List[Optional[models.QueryResponse]] = [None] * len(requests)
+        # requests sharing a filter are scored together, one matrix pass for all of them
+        groups: Dict[Optional[str], List[int]] = {}
+        for i, request in enumerate(requests):
+            key = request.filter.model_dump_json() if request.filter is not None else None
+            groups.setdefault(key, []).append(i)
+        for members in groups.values():
+            depth = max((requests[i].limit or 10) + (requests[i].offset or 0) for i in members)
+            found = collection.search([requests[i].query for i in members], depth, requests[members[0]].filter)
+            for i, (scores, rows) in zip(members, found):
+                request = requests[i]
+                offset = request.offset or 0
+                scores = scores[offset:offset + (request.limit or 10)]
+                rows = rows[offset:offset + (request.limit or 10)]
+                if request.score_threshold is not None:
+                    keep = scores >= request.score_threshold
+                    scores, rows = scores[keep], rows[keep]
+                with_payload = True if request.with_payload is None else request.with_payload
+                points = []
+                for score, (point_id, data) in zip(scores, collection.points(rows)):
+                    if with_payload is False:
+                        data = None
+                    elif isinstance(with_payload, list):
+                        data = {key: data[key] for key in with_payload if key in data}
+                    points.append(models.ScoredPoint(id=point_id, version=0, score=float(score), payload=data))
+                responses[i] = models.QueryResponse(points=points)
+        return responses
+
+    def query_batch_points(self, collection_name: str, requests: Sequence[models.QueryRequest],
+                           **kwargs: Any) -> List[models.QueryResponse]:
+        return self._responses(self.collection(collection_name), list(requests))
+
+    def query_points(self, collection_name: str, query: Any, limit: int = 10, offset: Optional[int] = None,
+                     query_filter: Optional[models.Filter] = None, score_threshold: Optional[float] = None,
+                     with_payload: Any = True, **kwargs: Any) -> models.QueryResponse:
+        request = models.QueryRequest(query=list(np.asarray(query, dtype=np.float32).tolist()), limit=limit,
+                                      offset=offset, filter=query_filter, score_threshold=score_threshold,
+                                      with_payload=with_payload)
+        return self._responses(self.collection(collection_name), [request])[0]
+
+    def close(self, **kwargs: Any) -> None:
+        with self._lock:
+            for collection in self._collections.values():
+                collection.flush()
+            self._collections.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the embedded vector store.")
+    parser.add_argument("command", choices=["build-index", "info"])
+    parser.add_argument("collection")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (default sqrt(rows))")
+    args = parser.parse_args()
+
+    store = LocalVectorStore.from_env()
+    collection = store.collection(args.collection)
+    if args.command == "build-index":
+        collection.build_index(nlist=args.nlist)
+    print(json.dumps(collection.meta, indent=2))